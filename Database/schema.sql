@@ -49,6 +49,16 @@ CREATE TABLE GeolocationData (
     CreatedAt TIMESTAMP DEFAULT NOW()
 );
 
+-- Raw GPS tracks written by the backend and the import scripts
+CREATE TABLE gps_data (
+    id BIGSERIAL PRIMARY KEY,
+    latitude DOUBLE PRECISION,
+    longitude DOUBLE PRECISION,
+    elevation DOUBLE PRECISION,
+    timestamp TIMESTAMPTZ,
+    Geography GEOGRAPHY(Point, 4326) GENERATED ALWAYS AS (ST_SetSRID(ST_MakePoint(longitude, latitude), 4326)::geography) STORED
+);
+
 -- Address Information
 CREATE TABLE Address (
     AddressID SERIAL PRIMARY KEY,
@@ -164,4 +174,6 @@ CREATE TABLE Routine (
 CREATE INDEX idx_geolocation_profile ON GeolocationData(ProfileID);
 CREATE INDEX idx_geolocation_time ON GeolocationData(EventTime);
 CREATE INDEX idx_geolocation_geo ON GeolocationData USING GIST(Geography);
+CREATE INDEX idx_gps_data_time ON gps_data(timestamp, id);
+CREATE INDEX idx_gps_data_geo ON gps_data USING GIST(Geography);
 CREATE INDEX idx_relationships ON Relationship(Profile1ID, Profile2ID);
\ No newline at end of file
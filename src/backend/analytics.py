@@ -0,0 +1,169 @@
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+from .cache import LRUCache
+from .datastore import Datastore
+from .track import NO_TIMESTAMP, Track, to_iso_strings
+from .util import BoundingBox
+
+EARTH_RADIUS_M = 6_371_008.8
+# Segments slower than this count as standing still
+STOP_SPEED_MPS = 0.5
+# Standing still at least this long is a stop
+MIN_STOP_SECONDS = 300
+# No point for this long ends a trip, e.g. when the logger was switched off
+MAX_GAP_SECONDS = 1800
+# Shorter trips are GPS noise
+MIN_TRIP_METERS = 100.0
+
+
+def haversine(lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray) -> np.ndarray:
+    """Great circle distances in meters between arrays of WGS84 coordinates."""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(a, dtype=np.float64)) for a in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def segment_distances(track: Track) -> np.ndarray:
+    """Distances in meters between consecutive points (length len(track) - 1)."""
+    return haversine(track.latitude[:-1], track.longitude[:-1], track.latitude[1:], track.longitude[1:])
+
+
+def segment_speeds(track: Track, distances: Optional[np.ndarray] = None) -> np.ndarray:
+    """Speed in m/s of every segment; NaN where the time difference is not positive."""
+    distances = segment_distances(track) if distances is None else distances
+    dt = np.diff(track.timestamp).astype(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(dt > 0, distances / dt, np.nan)
+
+
+def elevation_changes(track: Track) -> np.ndarray:
+    """Elevation differences of the segments, 0 where an elevation is missing."""
+    return np.nan_to_num(np.diff(track.elevation), nan=0.0)
+
+
+def runs(mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Start and (exclusive) end indices of the runs of True values in mask."""
+    edges = np.diff(np.r_[0, mask.astype(np.int8), 0])
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def _run_sums(values: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    cumulative = np.r_[0.0, np.cumsum(values)]
+    return cumulative[ends] - cumulative[starts]
+
+
+def _run_max(values: np.ndarray, mask: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """Maximum of the non-negative values selected by mask per run [start, end), 0 for runs without any."""
+    if len(starts) == 0:
+        return np.empty(0)
+    # Reduce over interleaved (start, end) bounds and keep every other result, so nothing between the runs
+    # counts. The padding makes an end at len(values) a valid index
+    selected = np.r_[np.where(mask, np.nan_to_num(values, nan=0.0), 0.0), 0.0]
+    return np.maximum.reduceat(selected, np.column_stack((starts, ends)).ravel())[::2]
+
+
+def dated_track(track: Track) -> Track:
+    """The points with a timestamp, in time order."""
+    track = track[track.timestamp != NO_TIMESTAMP]
+    if np.any(np.diff(track.timestamp) < 0):
+        track = track[np.argsort(track.timestamp, kind="stable")]
+    return track
+
+
+def analyze(track: Track, stop_speed: float = STOP_SPEED_MPS, min_stop_seconds: int = MIN_STOP_SECONDS,
+            max_gap_seconds: int = MAX_GAP_SECONDS, min_trip_meters: float = MIN_TRIP_METERS) -> Dict[str, Any]:
+    """
+    Summarize a track: distance, durations, speeds, elevation gain/loss, stops and trips.
+    A stop is a run of segments slower than stop_speed that lasts at least min_stop_seconds; trips are the
+    stretches between stops and recording gaps longer than max_gap_seconds. Points without a timestamp are ignored.
+    Returns a JSON serializable dict.
+    """
+    track = dated_track(track)
+    ts = track.timestamp
+    distances = segment_distances(track)
+    dt = np.diff(ts)
+    speeds = segment_speeds(track, distances)
+    climb = elevation_changes(track)
+
+    gap = dt > max_gap_seconds
+    slow = (np.nan_to_num(speeds, nan=0.0) < stop_speed) & ~gap
+    stop_starts, stop_ends = runs(slow)
+    # Segment runs [start, end) cover the points start ... end
+    long_enough = ts[stop_ends] - ts[stop_starts] >= min_stop_seconds
+    stop_starts, stop_ends = stop_starts[long_enough], stop_ends[long_enough]
+
+    in_stop = np.zeros(len(distances), dtype=bool)
+    if len(stop_starts):
+        marks = np.zeros(len(distances) + 1, dtype=np.int64)
+        np.add.at(marks, stop_starts, 1)
+        np.add.at(marks, stop_ends, -1)
+        in_stop = np.cumsum(marks[:-1]) > 0
+    moving = ~gap & ~in_stop
+
+    trip_starts, trip_ends = runs(moving)
+    trip_distances = _run_sums(distances, trip_starts, trip_ends)
+    keep = trip_distances >= min_trip_meters
+    trip_starts, trip_ends, trip_distances = trip_starts[keep], trip_ends[keep], trip_distances[keep]
+    trip_durations = ts[trip_ends] - ts[trip_starts]
+    # Segments without elapsed time (duplicate timestamps) have no speed, they only count for distances
+    timed = moving & (dt > 0)
+    trip_max_speed = _run_max(speeds, timed, trip_starts, trip_ends)
+    trip_gain = _run_sums(np.maximum(climb, 0), trip_starts, trip_ends)
+
+    lat_sums = _run_sums(track.latitude, stop_starts, stop_ends + 1)
+    lon_sums = _run_sums(track.longitude, stop_starts, stop_ends + 1)
+    stop_points = stop_ends + 1 - stop_starts
+
+    moving_seconds = int(dt[moving].sum())
+    moving_meters = float(distances[timed].sum())
+    with np.errstate(divide="ignore", invalid="ignore"):
+        trip_avg_speed = np.where(trip_durations > 0, trip_distances / trip_durations, 0.0)
+
+    stop_start_iso, stop_end_iso = to_iso_strings(ts[stop_starts]).tolist(), to_iso_strings(ts[stop_ends]).tolist()
+    trip_start_iso, trip_end_iso = to_iso_strings(ts[trip_starts]).tolist(), to_iso_strings(ts[trip_ends]).tolist()
+    return {
+        "summary": {
+            "points": len(track),
+            "start": str(to_iso_strings(ts[:1])[0]) if len(track) else None,
+            "end": str(to_iso_strings(ts[-1:])[0]) if len(track) else None,
+            "distance_m": float(distances.sum()),
+            "duration_s": int(ts[-1] - ts[0]) if len(track) else 0,
+            "moving_time_s": moving_seconds,
+            "avg_moving_speed_mps": moving_meters / moving_seconds if moving_seconds else 0.0,
+            "max_speed_mps": float(speeds[timed].max()) if timed.any() else 0.0,
+            "elevation_gain_m": float(np.maximum(climb, 0).sum()),
+            "elevation_loss_m": float(-np.minimum(climb, 0).sum()),
+            "stops": len(stop_starts),
+            "trips": len(trip_starts),
+        },
+        "stops": [
+            {"start": start, "end": end, "duration_s": int(duration), "latitude": lat, "longitude": lon}
+            for start, end, duration, lat, lon in zip(
+                stop_start_iso, stop_end_iso, (ts[stop_ends] - ts[stop_starts]).tolist(),
+                (lat_sums / stop_points).tolist(), (lon_sums / stop_points).tolist())
+        ],
+        "trips": [
+            {"start": start, "end": end, "distance_m": distance, "duration_s": int(duration),
+             "avg_speed_mps": avg, "max_speed_mps": top, "elevation_gain_m": gain}
+            for start, end, distance, duration, avg, top, gain in zip(
+                trip_start_iso, trip_end_iso, trip_distances.tolist(), trip_durations.tolist(),
+                trip_avg_speed.tolist(), trip_max_speed.tolist(), trip_gain.tolist())
+        ],
+    }
+
+
+class AnalyticsCache:
+    """Track analyses of datastore query windows, cached per dataset version"""
+
+    def __init__(self, datastore: Datastore, cache_size: int = 32):
+        self.ds = datastore
+        self._results = LRUCache(cache_size)
+
+    def analyze(self, bbox: Optional[BoundingBox] = None, start: Optional[str] = None,
+                end: Optional[str] = None) -> Dict[str, Any]:
+        key = (self.ds.version, bbox, start, end)
+        return self._results.get_or_compute(
+            key, lambda: analyze(self.ds.query_gps_data(bbox=bbox, start=start, end=end))
+        )
@@ -0,0 +1,350 @@
+import json
+import os
+import shutil
+import threading
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .datastore import Datastore, StorageBackend, UnsupportedQueryError
+from .track import NO_TIMESTAMP, Track, to_epoch_seconds
+from .util import BoundingBox
+
+# Column files of a segment, raw little endian values
+SEGMENT_COLUMNS = {"latitude": "<f8", "longitude": "<f8", "elevation": "<f8", "timestamp": "<i8"}
+# Optional sidecar with the original strings of lossy timestamps: count + 1 offsets into the utf8 data,
+# written only for segments that have any ("" for the timestamps the epoch seconds reproduce)
+RAW_OFFSETS = "raw_timestamp.offsets.bin"
+RAW_DATA = "raw_timestamp.utf8"
+INDEX_FILE = "index.json"
+UNDATED = "undated"
+
+
+def partition_key(seconds: np.ndarray, partition: str) -> np.ndarray:
+    """Partition ("2024-01" for month, "2024-01-31" for day) of every epoch-second timestamp."""
+    unit = {"month": "M", "day": "D"}[partition]
+    keys = np.datetime_as_string(np.where(seconds == NO_TIMESTAMP, 0, seconds).astype("datetime64[s]"), unit=unit)
+    keys[seconds == NO_TIMESTAMP] = UNDATED
+    return keys
+
+
+class Segment:
+    """An immutable, time sorted block of points stored as one memory-mapped file per column"""
+
+    def __init__(self, path: Path, meta: Dict[str, Any]):
+        self.path = path
+        self.meta = meta
+        self._columns: Optional[Dict[str, np.ndarray]] = None
+        self._lock = threading.Lock()
+        # Queries reading the segment and whether it was replaced; guarded by the backend's segment lock
+        self.readers = 0
+        self.retired = False
+
+    @classmethod
+    def write(cls, path: Path, track: Track, partition: str) -> 'Segment':
+        """Write a track (sorted by timestamp here) as a new segment directory."""
+        order = np.argsort(track.timestamp, kind="stable")
+        track = track[order]
+        tmp = path.with_name(f"{path.name}.tmp")
+        tmp.mkdir(parents=True)
+        for name, dtype in SEGMENT_COLUMNS.items():
+            getattr(track, name).astype(dtype).tofile(tmp / f"{name}.bin")
+        raw = track.raw_timestamp
+        if raw is not None:
+            encoded = [b"" if value is None else value.encode() for value in raw.tolist()]
+            offsets = np.zeros(len(encoded) + 1, dtype="<i8")
+            np.cumsum([len(value) for value in encoded], out=offsets[1:])
+            offsets.tofile(tmp / RAW_OFFSETS)
+            (tmp / RAW_DATA).write_bytes(b"".join(encoded))
+        os.replace(tmp, path)
+        dated = track.timestamp[track.timestamp != NO_TIMESTAMP]
+        meta = {
+            "name": path.name,
+            "partition": partition,
+            "count": len(track),
+            "start": int(dated[0]) if len(dated) else None,
+            "end": int(dated[-1]) if len(dated) else None,
+            "bbox": [float(track.latitude.min()), float(track.longitude.min()),
+                     float(track.latitude.max()), float(track.longitude.max())],
+            "raw": raw is not None,
+        }
+        return cls(path, meta)
+
+    @property
+    def columns(self) -> Dict[str, np.ndarray]:
+        """The column files, mapped on first use. Only the pages a query touches are read from disk."""
+        if self._columns is None:
+            with self._lock:
+                if self._columns is None:
+                    columns = {
+                        name: np.memmap(self.path / f"{name}.bin", dtype=dtype, mode="r", shape=(self.meta["count"],))
+                        for name, dtype in SEGMENT_COLUMNS.items()
+                    }
+                    if self.meta.get("raw"):
+                        columns[RAW_OFFSETS] = np.memmap(self.path / RAW_OFFSETS, dtype="<i8", mode="r")
+                        columns[RAW_DATA] = np.memmap(self.path / RAW_DATA, dtype=np.uint8, mode="r")
+                    self._columns = columns
+        return self._columns
+
+    def raw_timestamps(self, first: int, last: int) -> Optional[np.ndarray]:
+        """Original strings of the lossy timestamps in rows [first, last), None if there are none."""
+        if not self.meta.get("raw"):
+            return None
+        offsets = self.columns[RAW_OFFSETS][first:last + 1]
+        present = np.flatnonzero(np.diff(offsets))
+        if len(present) == 0:
+            return None
+        data = self.columns[RAW_DATA]
+        raw = np.full(last - first, None, dtype=object)
+        raw[present] = [data[offsets[i]:offsets[i + 1]].tobytes().decode() for i in present]
+        return raw
+
+    def overlaps(self, bbox: Optional[BoundingBox], start: Optional[int], end: Optional[int]) -> bool:
+        """Check the segment index, so segments outside the query window are never opened."""
+        if bbox is not None:
+            min_lat, min_lon, max_lat, max_lon = self.meta["bbox"]
+            if min_lat > bbox.max_lat or max_lat < bbox.min_lat or min_lon > bbox.max_lon or max_lon < bbox.min_lon:
+                return False
+        if start is not None or end is not None:
+            if self.meta["start"] is None:
+                return False
+            if start is not None and self.meta["end"] < start:
+                return False
+            if end is not None and self.meta["start"] > end:
+                return False
+        return True
+
+    def query(self, bbox: Optional[BoundingBox], start: Optional[int], end: Optional[int]) -> Track:
+        """
+        Points of the segment inside the window. The time window is a binary search on the sorted timestamps
+        and gives views of the mapped files; only a bounding box filter copies the selected points.
+        """
+        columns = self.columns
+        ts = columns["timestamp"]
+        first = 0 if start is None else int(np.searchsorted(ts, start, side="left"))
+        if start is None and end is not None:
+            # Undated points sort first and never match a time window
+            first = int(np.searchsorted(ts, NO_TIMESTAMP, side="right"))
+        last = len(ts) if end is None else int(np.searchsorted(ts, end, side="right"))
+        track = Track(*(columns[name][first:last] for name in SEGMENT_COLUMNS),
+                      raw_timestamp=self.raw_timestamps(first, last))
+        if bbox is None:
+            return track
+        lat, lon = track.latitude, track.longitude
+        mask = (lat >= bbox.min_lat) & (lat <= bbox.max_lat) & (lon >= bbox.min_lon) & (lon <= bbox.max_lon)
+        return track[mask]
+
+    def close(self) -> None:
+        self._columns = None
+
+    def delete(self) -> None:
+        """
+        Remove the segment's files once no query reads it any more. Tracks handed out earlier may still be views
+        of the mapped files; the mappings keep the data of unlinked files readable.
+        """
+        self.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class ArchiveBackend(StorageBackend):
+    """
+    Read-mostly storage for cold GPS data: immutable, time-partitioned segments of memory-mapped
+    fixed-width columns with a small index (time range, bbox) per segment in index.json.
+    Queries skip segments by their index entry and return Tracks backed by the mapped files.
+
+    Only gps_data is stored and there is no SQL: inserts are sealed into new segments on commit, and the one
+    statement execute() understands is "DELETE FROM gps_data"; anything else raises UnsupportedQueryError.
+    Points have no ids, so the keyset paginated iter_gps_rows is not supported either.
+
+    Segments replaced by a commit or compaction are deleted only after the queries still reading them are done.
+    """
+    concurrent_reads = True
+
+    def __init__(self, *, archive_dir: str, partition: str = "month"):
+        super().__init__()
+        if partition not in ("month", "day"):
+            raise ValueError("partition must be month or day")
+        self.root = Path(archive_dir)
+        self.partition = partition
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._pending: List[Track] = []
+        self._delete_pending = False
+        self._segments_lock = threading.Lock()
+        self.segments = self._load_index()
+        self.log.info(f"Opened archive {archive_dir} with {len(self.segments)} segments")
+
+    def _load_index(self) -> List[Segment]:
+        index = self.root / INDEX_FILE
+        if not index.exists():
+            return []
+        entries = json.loads(index.read_text())["segments"]
+        return [Segment(self.root / entry["name"], entry) for entry in entries]
+
+    def _save_index(self, segments: List[Segment], removed: Sequence[Segment] = ()) -> None:
+        """Publish the new segment list and delete the removed segments, or leave that to their last reader."""
+        tmp = self.root / f"{INDEX_FILE}.tmp"
+        tmp.write_text(json.dumps({"partition": self.partition, "segments": [s.meta for s in segments]}))
+        os.replace(tmp, self.root / INDEX_FILE)
+        with self._segments_lock:
+            self.segments = segments
+            for segment in removed:
+                segment.retired = True
+            unused = [segment for segment in removed if segment.readers == 0]
+        for segment in unused:
+            segment.delete()
+
+    def _acquire(self) -> List[Segment]:
+        """The current segments, registered as read until _release so they are not deleted under the query."""
+        with self._segments_lock:
+            segments = self.segments
+            for segment in segments:
+                segment.readers += 1
+        return segments
+
+    def _release(self, segments: List[Segment]) -> None:
+        with self._segments_lock:
+            for segment in segments:
+                segment.readers -= 1
+            unused = [segment for segment in segments if segment.retired and segment.readers == 0]
+        for segment in unused:
+            segment.delete()
+
+    def execute(self, query: str):
+        if " ".join(query.split()).upper() != "DELETE FROM GPS_DATA":
+            raise UnsupportedQueryError(f"ArchiveBackend can't execute {query!r}")
+        self._pending.clear()
+        self._delete_pending = True
+
+    def fetch_all_from_query(self, query: str, params: Optional[Dict[str, Any]] = None) -> Sequence[Any]:
+        raise UnsupportedQueryError("ArchiveBackend does not run SQL queries")
+
+    def insert_rows(self, table: str, columns: Sequence[str], rows: Sequence[Sequence[Any]]):
+        if table != "gps_data" or tuple(columns) != ("latitude", "longitude", "elevation", "timestamp"):
+            raise UnsupportedQueryError(f"ArchiveBackend only stores gps_data rows, not {table}{tuple(columns)}")
+        self._pending.append(Track.from_rows(list(rows)))
+
+    def commit(self):
+        """Seal the pending inserts into one new segment per partition and publish them in the index."""
+        segments = [] if self._delete_pending else list(self.segments)
+        removed = self.segments if self._delete_pending else []
+        if self._pending:
+            track = Track()
+            for pending in self._pending:
+                track.append(pending)
+            keys = partition_key(track.timestamp, self.partition)
+            for key in np.unique(keys):
+                path = self.root / f"{key}-{uuid.uuid4().hex[:8]}"
+                segments.append(Segment.write(path, track[keys == key], str(key)))
+            segments.sort(key=lambda s: (s.meta["start"] is not None, s.meta["start"] or 0))
+        if self._pending or self._delete_pending:
+            self._save_index(segments, removed)
+        self._pending = []
+        self._delete_pending = False
+
+    def rollback(self):
+        self._pending = []
+        self._delete_pending = False
+
+    def close_and_cleanup(self):
+        for segment in self.segments:
+            segment.close()
+
+    def compact(self) -> None:
+        """
+        Merge the segments of every partition into one, e.g. after many small inserts. Like the writes it has to
+        run on the DB worker, see compact(datastore).
+        """
+        by_partition: Dict[str, List[Segment]] = {}
+        for segment in self.segments:
+            by_partition.setdefault(segment.meta["partition"], []).append(segment)
+        segments, removed = [], []
+        for key, group in by_partition.items():
+            if len(group) == 1:
+                segments.append(group[0])
+                continue
+            track = Track()
+            for segment in group:
+                track.append(segment.query(None, None, None))
+            segments.append(Segment.write(self.root / f"{key}-{uuid.uuid4().hex[:8]}", track, key))
+            removed.extend(group)
+        segments.sort(key=lambda s: (s.meta["start"] is not None, s.meta["start"] or 0))
+        self._save_index(segments, removed)
+
+    def _window(self, start: Optional[str], end: Optional[str]):
+        bounds = to_epoch_seconds([start, end])
+        return (None if start is None else int(bounds[0]), None if end is None else int(bounds[1]))
+
+    def query_gps_data(self, bbox: Optional[BoundingBox] = None, start: Optional[str] = None,
+                       end: Optional[str] = None) -> Track:
+        """
+        Points inside the window ordered by timestamp, as a Track. A window that falls into a single segment
+        is returned without copying the data out of the mapped files.
+        """
+        start_s, end_s = self._window(start, end)
+        segments = self._acquire()
+        try:
+            parts = [segment.query(bbox, start_s, end_s) for segment in segments
+                     if segment.overlaps(bbox, start_s, end_s)]
+        finally:
+            self._release(segments)
+        parts = [part for part in parts if len(part)]
+        if not parts:
+            return Track()
+        if len(parts) == 1:
+            return parts[0]
+        track = Track()
+        for part in parts:
+            track.append(part)
+        # Segments of one partition may overlap in time until they are compacted
+        if np.any(np.diff(track.timestamp) < 0):
+            track = track[np.argsort(track.timestamp, kind="stable")]
+        return track
+
+    def first_gps_point(self) -> Optional[Sequence[Any]]:
+        """
+        The first dated point in timestamp order, the archive doesn't keep the insertion order. Undated points
+        are only returned if there are no dated ones.
+        """
+        segments = self._acquire()
+        try:
+            for segment in segments:
+                if segment.meta["start"] is None:
+                    continue
+                columns = segment.columns
+                first = int(np.searchsorted(columns["timestamp"], NO_TIMESTAMP, side="right"))
+                if first < segment.meta["count"]:
+                    return columns["latitude"][first], columns["longitude"][first]
+            if segments:
+                columns = segments[0].columns
+                return columns["latitude"][0], columns["longitude"][0]
+            return None
+        finally:
+            self._release(segments)
+
+    def iter_gps_rows(self, bbox: Optional[BoundingBox] = None, start: Optional[str] = None,
+                      end: Optional[str] = None, after: Optional[Tuple[str, int]] = None, limit: Optional[int] = None,
+                      chunk_size: int = 1000) -> Iterator[Sequence[Any]]:
+        raise UnsupportedQueryError("ArchiveBackend points have no ids to page by")
+
+    def iter_gps_data(self, bbox: Optional[BoundingBox] = None, start: Optional[str] = None,
+                      end: Optional[str] = None, chunk_size: int = 100_000) -> Iterator[Track]:
+        """Stream the points segment by segment in chunks of up to chunk_size points."""
+        start_s, end_s = self._window(start, end)
+        segments = self._acquire()
+        try:
+            for segment in segments:
+                if segment.overlaps(bbox, start_s, end_s):
+                    track = segment.query(bbox, start_s, end_s)
+                    for i in range(0, len(track), chunk_size):
+                        yield track[i:i + chunk_size]
+        finally:
+            self._release(segments)
+
+
+def compact(datastore: Datastore) -> None:
+    """Compact the ArchiveBackend of a datastore on its DB worker, between the queued writes."""
+    result = datastore.db_worker.submit(lambda: datastore.db_worker.storage.compact())
+    if isinstance(result, Exception):
+        raise result
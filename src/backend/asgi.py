@@ -0,0 +1,392 @@
+"""
+Description:
+    ASGI serving mode for the Geolocation project.
+    Serves the routes of the Flask app from an asyncio event loop: cache hits and 304s are answered on
+    the loop, database and rendering work runs on bounded executors, so concurrent requests don't need a
+    thread each. Routes without an async handler here run their Flask view on the datastore executor; the
+    chunks of streamed Flask responses are produced on an executor of their own.
+
+Dependencies:
+    - uvicorn (or any other ASGI server), only to run the app:
+        pip install uvicorn
+
+Docs:
+    ASGI specification: https://asgi.readthedocs.io/en/latest/specs/main.html
+"""
+import asyncio
+import json
+import logging
+import os
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+from flask import Response
+from werkzeug.exceptions import ClientDisconnected, HTTPException
+from werkzeug.http import parse_etags
+
+from .datastore import AsyncDatastore
+from .events import KEEPALIVE_SECONDS, _Subscriber
+from .ingest import ingest_ndjson
+from .metrics import CONTENT_TYPE, DB_QUEUE_DEPTH, HTTP_REQUESTS, HTTP_REQUEST_SECONDS, REGISTRY
+from .webservice import WebService
+
+# How often an event stream looks for new events, the subscriber queues are filled from the writer thread
+EVENT_POLL_SECONDS = 0.1
+
+
+class AsgiBodyReader:
+    """
+    Blocking file-like view of an ASGI request body, for handlers that consume it on an executor thread:
+    each read waits for the next body message from the event loop, so the upload is never held in memory.
+    """
+
+    def __init__(self, receive: Callable, loop: asyncio.AbstractEventLoop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = b""
+        self._done = False
+
+    def read(self, size: int = -1) -> bytes:
+        """Raises werkzeug's ClientDisconnected if the client goes away before the end of the body."""
+        while not self._buffer and not self._done:
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            if message["type"] == "http.disconnect":
+                self._done = True
+                raise ClientDisconnected()
+            self._buffer = message.get("body", b"")
+            self._done = not message.get("more_body", False)
+        size = len(self._buffer) if size < 0 else size
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class AsgiRequest:
+    """The parts of an ASGI HTTP request the handlers need"""
+
+    def __init__(self, scope: dict, receive: Callable):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.query_string: bytes = scope.get("query_string", b"")
+        self.args: Dict[str, str] = dict(parse_qsl(self.query_string.decode("latin-1")))
+        self.headers: Dict[str, str] = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+        self.if_none_match = parse_etags(self.headers.get("if-none-match"))
+        self._receive = receive
+
+    def stream(self) -> AsgiBodyReader:
+        """The body as a blocking stream; must be read off the event loop."""
+        return AsgiBodyReader(self._receive, asyncio.get_running_loop())
+
+    async def body(self) -> bytes:
+        chunks = []
+        while True:
+            message = await self._receive()
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                return b"".join(chunks)
+
+    async def disconnected(self) -> None:
+        """Return once the client has gone away."""
+        while (await self._receive())["type"] != "http.disconnect":
+            pass
+
+
+class AsgiResponse:
+    def __init__(self, body: bytes = b"", status: int = 200, content_type: Optional[str] = "text/html; charset=utf-8",
+                 headers: Optional[List[Tuple[str, str]]] = None):
+        self.body = body
+        self.status = status
+        self.headers = list(headers or [])
+        if content_type and status != 304:
+            self.headers.append(("content-type", content_type))
+
+    @classmethod
+    def json(cls, data: Any, status: int = 200) -> 'AsgiResponse':
+        return cls(json.dumps(data).encode(), status=status, content_type="application/json")
+
+    async def send(self, send: Callable, head: bool = False) -> None:
+        """Send the response; for a HEAD request the headers of the full response without the body."""
+        headers = [(k.encode("latin-1"), v.encode("latin-1")) for k, v in self.headers]
+        headers.append((b"content-length", str(len(self.body)).encode()))
+        await send({"type": "http.response.start", "status": self.status, "headers": headers})
+        await send({"type": "http.response.body", "body": b"" if head else self.body})
+
+
+class AsgiStreamingResponse(AsgiResponse):
+    """A response whose body is sent chunk by chunk while it is produced, until it ends or the client leaves."""
+
+    def __init__(self, chunks: AsyncIterator[bytes], request: AsgiRequest, status: int = 200,
+                 content_type: Optional[str] = None, headers: Optional[List[Tuple[str, str]]] = None):
+        super().__init__(b"", status=status, content_type=content_type, headers=headers)
+        self.chunks = chunks
+        self.request = request
+
+    async def send(self, send: Callable, head: bool = False) -> None:
+        headers = [(k.encode("latin-1"), v.encode("latin-1")) for k, v in self.headers]
+        await send({"type": "http.response.start", "status": self.status, "headers": headers})
+        if head:
+            await send({"type": "http.response.body", "body": b""})
+            await self.chunks.aclose()
+            return
+        disconnected = asyncio.ensure_future(self.request.disconnected())
+        try:
+            async for chunk in self.chunks:
+                if disconnected.done():
+                    return
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            disconnected.cancel()
+            await self.chunks.aclose()
+
+
+async def _no_chunks() -> AsyncIterator[bytes]:
+    """The body of a streamed response to a HEAD request"""
+    return
+    yield
+
+
+class AsyncWebService:
+    """
+    ASGI application serving the WebService routes without blocking the event loop.
+    Streamed Flask responses produce their chunks on stream_workers threads, apart from the datastore executor,
+    so long downloads can't starve the other requests; beyond stream_workers streams, chunks wait for a thread.
+    """
+
+    def __init__(self, webservice: WebService, db_workers: int = 8, render_workers: Optional[int] = None,
+                 stream_workers: int = 32):
+        self.ws = webservice
+        self.log = logging.getLogger(__name__)
+        if webservice.profiler is not None:
+            self.log.warning("Request profiling is only supported by the Flask server, ASGI requests are not profiled")
+        self.ads = AsyncDatastore(webservice.ds, max_workers=db_workers)
+        self.render_executor = ThreadPoolExecutor(max_workers=render_workers or os.cpu_count() or 4,
+                                                  thread_name_prefix="render")
+        self.stream_executor = ThreadPoolExecutor(max_workers=stream_workers, thread_name_prefix="stream")
+        # Renders in progress, so concurrent requests for the same uncached page share one render
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+        # The routes are the Flask app's, these endpoints have async handlers, the others run the Flask view
+        self.urls = webservice.app.url_map.bind("")
+        self.handlers: Dict[str, Callable] = {
+            "index": self.index,
+            "editor": self.editor,
+            "vector_tile": self.vector_tile,
+            "heatmap_tile": self.heatmap_tile,
+            "save_manual_data": self.save_manual_data,
+            "api_ingest": self.api_ingest,
+            "metrics": self.metrics,
+            "event_stream": self.event_stream,
+        }
+
+    async def __call__(self, scope: dict, receive: Callable, send: Callable) -> None:
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+        started = time.perf_counter()
+        request = AsgiRequest(scope, receive)
+        endpoint = "unmatched"
+        try:
+            rule, args = self.urls.match(request.path, request.method, return_rule=True)
+            endpoint = rule.rule
+            handler = self.handlers.get(rule.endpoint)
+            response = await (handler(request, **args) if handler is not None else self.flask_view(request))
+        except HTTPException as e:
+            # No such route or method (or a redirect to the canonical URL)
+            response = self._from_flask(e.get_response(), request)
+        except Exception:
+            self.log.error(f"Error handling {request.method} {request.path}", exc_info=True)
+            response = AsgiResponse(b"Internal Server Error", status=500, content_type="text/plain")
+        HTTP_REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - started)
+        HTTP_REQUESTS.labels(endpoint, response.status).inc()
+        await response.send(send, head=request.method == "HEAD")
+
+    async def _lifespan(self, receive: Callable, send: Callable) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _render(self, func: Callable, *args) -> Any:
+        """Run func inside the Flask app context (templates) on the render executor."""
+        def call():
+            with self.ws.app.app_context():
+                return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.render_executor, call)
+
+    async def _render_shared(self, key: tuple) -> str:
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._render(self.ws.render_cached, key))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(future)
+
+    @staticmethod
+    def _conditional(etag: str, body: Optional[bytes], content_type: str) -> AsgiResponse:
+        headers = [("etag", f'"{etag}"'), ("cache-control", "no-cache")]
+        if body is None:
+            return AsgiResponse(status=304, headers=headers)
+        return AsgiResponse(body, content_type=content_type, headers=headers)
+
+    async def flask_view(self, request: AsgiRequest) -> AsgiResponse:
+        """Run the Flask view of the request's route on the datastore executor."""
+        body = await request.body() if request.method not in ("GET", "HEAD") else b""
+
+        def dispatch() -> Response:
+            with self.ws.app.test_request_context(request.path, method=request.method,
+                                                  query_string=request.query_string.decode("latin-1"),
+                                                  headers=list(request.headers.items()), data=body):
+                try:
+                    return self.ws.app.make_response(self.ws.app.dispatch_request())
+                except HTTPException as e:
+                    return e.get_response()
+
+        return self._from_flask(await self.ads.run(dispatch), request)
+
+    def _from_flask(self, response: Response, request: AsgiRequest) -> AsgiResponse:
+        headers = [(key.lower(), value) for key, value in response.headers.items()
+                   if key.lower() not in ("content-type", "content-length")]
+        if response.is_streamed:
+            if request.method == "HEAD":
+                # Nothing of the body is sent, don't start producing it
+                response.close()
+                chunks = _no_chunks()
+            else:
+                chunks = self._iterate(response)
+            return AsgiStreamingResponse(chunks, request, status=response.status_code,
+                                         content_type=response.content_type, headers=headers)
+        return AsgiResponse(response.get_data(), status=response.status_code, content_type=response.content_type,
+                            headers=headers)
+
+    async def _iterate(self, response: Response) -> AsyncIterator[bytes]:
+        """The chunks of a streamed Flask response, each produced on the stream executor."""
+        loop = asyncio.get_running_loop()
+        chunks = response.iter_encoded()
+        end = object()
+        try:
+            while True:
+                chunk = await loop.run_in_executor(self.stream_executor, next, chunks, end)
+                if chunk is end:
+                    return
+                yield chunk
+        finally:
+            await loop.run_in_executor(self.stream_executor, response.close)
+
+    async def index(self, request: AsgiRequest) -> AsgiResponse:
+        """Same parameters, caching and ETags as WebService.index."""
+        if request.args.get("view") == "tiles":
+            return AsgiResponse((await self._render(self.ws.render_tile_view)).encode())
+        if request.args.get("view") == "track":
+            try:
+                return AsgiResponse((await self._render(self.ws.render_track_view, request.args)).encode())
+            except ValueError as e:
+                return AsgiResponse(str(e).encode(), status=400, content_type="text/plain")
+        try:
+            key, etag = self.ws.map_request(request.args)
+        except ValueError as e:
+            return AsgiResponse(str(e).encode(), status=400, content_type="text/plain")
+        if etag in request.if_none_match:
+            return self._conditional(etag, None, "")
+        html = self.ws.render_cache.get(key)
+        if html is None:
+            html = await self._render_shared(key)
+        return self._conditional(etag, html.encode(), "text/html; charset=utf-8")
+
+    async def editor(self, request: AsgiRequest) -> AsgiResponse:
+        return AsgiResponse((await self._render(self.ws.editor)).encode())
+
+    async def _tile(self, request: AsgiRequest, layer: str, get_tile: Callable, content_type: str,
+                    z: int, x: int, y: int) -> AsgiResponse:
+        """A tile of get_tile, revalidated by an ETag of the layer, dataset version and tile coordinates."""
+        etag = self.ws.etag_for((layer, self.ads.version, z, x, y))
+        if etag in request.if_none_match:
+            return self._conditional(etag, None, "")
+        try:
+            data = await self._render(get_tile, z, x, y)
+        except ValueError as e:
+            return AsgiResponse(str(e).encode(), status=404, content_type="text/plain")
+        return self._conditional(etag, data, content_type)
+
+    async def vector_tile(self, request: AsgiRequest, z: int, x: int, y: int) -> AsgiResponse:
+        return await self._tile(request, "tile", self.ws.tiles.get_tile, "application/vnd.mapbox-vector-tile", z, x, y)
+
+    async def heatmap_tile(self, request: AsgiRequest, z: int, x: int, y: int) -> AsgiResponse:
+        return await self._tile(request, "heatmap", self.ws.heatmap.get_tile, "image/png", z, x, y)
+
+    async def save_manual_data(self, request: AsgiRequest) -> AsgiResponse:
+        try:
+            data = json.loads(await request.body())
+        except ValueError as e:
+            return AsgiResponse.json({"status": "error", "message": str(e)}, status=400)
+        return AsgiResponse.json(await self.ads.run(self.ws.save_points, data))
+
+    async def api_ingest(self, request: AsgiRequest) -> AsgiResponse:
+        try:
+            batch_size = self.ws.parse_batch_size(request.args)
+        except ValueError as e:
+            return AsgiResponse(str(e).encode(), status=400, content_type="text/plain")
+        mimetype = request.headers.get("content-type", "").split(";")[0].strip().lower()
+        encoding = self.ws.body_encoding(request.headers.get("content-encoding"), mimetype)
+        try:
+            # The body is read and inserted batch by batch on a datastore thread
+            summary = await self.ads.run(ingest_ndjson, self.ws.ds, request.stream(), encoding, batch_size)
+        except ValueError as e:
+            return AsgiResponse(str(e).encode(), status=415, content_type="text/plain")
+        return AsgiResponse.json(summary.as_dict(), status=200 if summary.complete else 400)
+
+    async def metrics(self, request: AsgiRequest) -> AsgiResponse:
+        DB_QUEUE_DEPTH.set(self.ws.ds.db_worker.queue_depth)
+        return AsgiResponse(REGISTRY.render().encode(), content_type=CONTENT_TYPE)
+
+    async def event_stream(self, request: AsgiRequest) -> AsgiResponse:
+        """Same stream as WebService.event_stream, waiting for events on the event loop instead of a thread."""
+        try:
+            since, bbox = self.ws.parse_event_args(request.args, request.headers.get("last-event-id"))
+        except ValueError as e:
+            return AsgiResponse(str(e).encode(), status=400, content_type="text/plain")
+        # A HEAD request gets the headers only, without subscribing to events it would never receive
+        chunks = _no_chunks() if request.method == "HEAD" else self._events(self.ws.events.subscribe(since, bbox))
+        return AsgiStreamingResponse(chunks, request, content_type="text/event-stream",
+                                     headers=[("cache-control", "no-cache"), ("x-accel-buffering", "no")])
+
+    async def _events(self, subscriber: _Subscriber) -> AsyncIterator[bytes]:
+        try:
+            yield b"retry: 3000\n\n"
+            idle = 0.0
+            while True:
+                try:
+                    message = subscriber.queue.get_nowait()
+                except queue.Empty:
+                    await asyncio.sleep(EVENT_POLL_SECONDS)
+                    idle += EVENT_POLL_SECONDS
+                    if idle >= KEEPALIVE_SECONDS:
+                        idle = 0.0
+                        yield b": keepalive\n\n"
+                    continue
+                if message is None:
+                    return
+                idle = 0.0
+                yield message.encode()
+        finally:
+            self.ws.events.unsubscribe(subscriber)
+
+    def close(self) -> None:
+        self.render_executor.shutdown(wait=False)
+        self.stream_executor.shutdown(wait=False)
+        self.ads.close()
+
+    def run(self, host: str, port: int = 5000) -> None:
+        """Serve the app with uvicorn."""
+        try:
+            import uvicorn
+        except ImportError:
+            raise RuntimeError("The async serving mode needs an ASGI server: pip install uvicorn")
+        uvicorn.run(self, host=host, port=port, log_level="info")
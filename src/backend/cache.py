@@ -0,0 +1,64 @@
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+import threading
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache of at most maxsize entries and, with max_bytes, at most that many bytes
+    of values (which have to be bytes-like then; a value larger than max_bytes is not cached).
+    """
+
+    def __init__(self, maxsize: int = 128, max_bytes: Optional[int] = None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            if key in self._data:
+                self._bytes -= self._size(self._data.pop(key))
+            if self.max_bytes is not None and len(value) > self.max_bytes:
+                return
+            self._data[key] = value
+            self._bytes += self._size(value)
+            while len(self._data) > self.maxsize or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                _, dropped = self._data.popitem(last=False)
+                self._bytes -= self._size(dropped)
+
+    def _size(self, value: Any) -> int:
+        return len(value) if self.max_bytes is not None else 0
+
+    def get_or_compute(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        """
+        Return the cached value for key, computing and storing it on a miss.
+        func runs outside the lock, so concurrent misses may compute the value twice.
+        """
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            value = func()
+            self.put(key, value)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._data
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
@@ -1,22 +1,57 @@
+import asyncio
 import atexit
+import contextlib
 import time
+from concurrent.futures import ThreadPoolExecutor
 from abc import ABC, abstractmethod
 
-try:
-    from sqlalchemy import create_engine, text, Result
-    from sqlalchemy.orm import scoped_session, sessionmaker
-except ImportError:
-    pass
 import sqlite3
 
-from typing import Sequence, Any, Union
+from typing import Sequence, Iterable, Iterator, Any, Union, Optional, Dict, Callable, NamedTuple, Tuple
+from itertools import islice, chain
 import logging
 import threading
 import queue
-from .util import GeoPoint
+from .metrics import DB_EXEC_SECONDS, DB_WAIT_SECONDS, POINTS_INSERTED, QUERY_ROWS
+from .util import GeoPoint, BoundingBox
+from .track import Track
+
+class TimingStats:
+    """Thread-safe count / total / max of measured durations in seconds, optionally also fed into a histogram"""
+
+    def __init__(self, histogram=None):
+        self._lock = threading.Lock()
+        self.histogram = histogram
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+        if self.histogram is not None:
+            self.histogram.observe(seconds)
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "count": self.count,
+                "avg": self.total / self.count if self.count else 0.0,
+                "max": self.max,
+            }
+
+
+class UnsupportedQueryError(Exception):
+    """A storage backend was asked for a query or write it doesn't support."""
+
 
 class StorageBackend(ABC):
     """Interface to database"""
+    # Whether read_all_from_query may be called from any thread while the writer is busy
+    concurrent_reads = False
+
     def __init__(self):
         self.log = logging.getLogger(__name__)
 
@@ -25,7 +60,7 @@ class StorageBackend(ABC):
         pass
 
     @abstractmethod
-    def fetch_all_from_query(self, query: str) -> Sequence[Any]:
+    def fetch_all_from_query(self, query: str, params: Optional[Dict[str, Any]] = None) -> Sequence[Any]:
         pass
 
     @abstractmethod
@@ -40,18 +75,141 @@ class StorageBackend(ABC):
     def close_and_cleanup(self):
         pass
 
+    @abstractmethod
+    def insert_rows(self, table: str, columns: Sequence[str], rows: Sequence[Sequence[Any]]):
+        """Insert one batch of rows using bound parameters."""
+        pass
+
     def execute_and_commit(self, query: str):
         self.execute(query)
         self.commit()
 
+    def read_all_from_query(self, query: str, params: Optional[Dict[str, Any]] = None) -> Sequence[Any]:
+        """
+        Run a read-only query. Backends with concurrent_reads use a separate read connection,
+        otherwise this is the writer connection and must only be used from the DB worker.
+        """
+        return self.fetch_all_from_query(query, params)
+
+    def iter_query(self, query: str, params: Optional[Dict[str, Any]] = None,
+                   chunk_size: int = 1000) -> Iterator[Sequence[Any]]:
+        """
+        Stream the result of a read-only query in chunks of up to chunk_size rows.
+        Backends override this with a server-side cursor; the default loads the whole result.
+        """
+        rows = self.read_all_from_query(query, params)
+        for i in range(0, len(rows), chunk_size):
+            yield rows[i:i + chunk_size]
+
+    def bulk_insert(self, table: str, columns: Sequence[str], rows: Iterable[Sequence[Any]],
+                    batch_size: int = 1000) -> int:
+        """
+        Insert rows in batches of batch_size and commit once at the end.
+        Returns the number of inserted rows and logs the achieved rows/sec.
+        """
+        start = time.perf_counter()
+        total = 0
+        rows = iter(rows)
+        try:
+            while True:
+                batch = list(islice(rows, batch_size))
+                if not batch:
+                    break
+                self.insert_rows(table, columns, batch)
+                total += len(batch)
+            self.commit()
+        except Exception:
+            self.rollback()
+            raise
+        elapsed = time.perf_counter() - start
+        rate = total / elapsed if elapsed > 0 else float("inf")
+        self.log.info(f"Inserted {total} rows into {table} in {elapsed:.3f}s ({rate:.0f} rows/sec)")
+        return total
+
+    def bbox_condition(self, bbox: BoundingBox) -> str:
+        """SQL condition restricting gps_data to bbox (uses the :min_lat ... :max_lon parameters)."""
+        return "latitude BETWEEN :min_lat AND :max_lat AND longitude BETWEEN :min_lon AND :max_lon"
+
+    def query_gps_data(self, bbox: Optional[BoundingBox] = None, start: Optional[str] = None,
+                       end: Optional[str] = None) -> Sequence[Any]:
+        """
+        Fetch (latitude, longitude, elevation, timestamp) rows ordered by timestamp,
+        optionally restricted to a bounding box and a time range (inclusive).
+        """
+        conditions, params = self.gps_conditions(bbox, start, end)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self.read_all_from_query(
+            f"SELECT latitude, longitude, elevation, timestamp FROM gps_data{where} ORDER BY timestamp",
+            params
+        )
+
+    def gps_conditions(self, bbox: Optional[BoundingBox], start: Optional[str],
+                       end: Optional[str]) -> Tuple[list, Dict[str, Any]]:
+        """WHERE conditions and parameters for the bounding box / time window filters."""
+        conditions = []
+        params: Dict[str, Any] = {}
+        if bbox is not None:
+            conditions.append(self.bbox_condition(bbox))
+            params.update(bbox.as_dict())
+        if start is not None:
+            conditions.append("timestamp >= :start")
+            params["start"] = start
+        if end is not None:
+            conditions.append("timestamp <= :end")
+            params["end"] = end
+        return conditions, params
+
+    def first_gps_point(self) -> Optional[Sequence[Any]]:
+        """(latitude, longitude) of the first inserted point, or None if there are no points."""
+        rows = self.read_all_from_query("SELECT latitude, longitude FROM gps_data ORDER BY id LIMIT 1")
+        return rows[0] if rows else None
+
+    def iter_gps_rows(self, bbox: Optional[BoundingBox] = None, start: Optional[str] = None,
+                      end: Optional[str] = None, after: Optional[Tuple[str, int]] = None,
+                      limit: Optional[int] = None, chunk_size: int = 1000) -> Iterator[Sequence[Any]]:
+        """
+        Stream (id, latitude, longitude, elevation, timestamp) rows in chunks, ordered by (timestamp, id).
+        after=(timestamp, id) continues behind that row (keyset pagination).
+        Points without a timestamp have no place in that order and are left out.
+        """
+        conditions, params = self.gps_conditions(bbox, start, end)
+        conditions.append("timestamp IS NOT NULL")
+        if after is not None:
+            conditions.append("(timestamp, id) > (:after_ts, :after_id)")
+            params.update(after_ts=after[0], after_id=after[1])
+        query = (f"SELECT id, latitude, longitude, elevation, timestamp FROM gps_data "
+                 f"WHERE {' AND '.join(conditions)} ORDER BY timestamp, id")
+        if limit is not None:
+            query += " LIMIT :limit"
+            params["limit"] = limit
+        return self.iter_query(query, params, chunk_size)
+
+    def iter_gps_data(self, bbox: Optional[BoundingBox] = None, start: Optional[str] = None,
+                      end: Optional[str] = None, chunk_size: int = 100_000) -> Iterator[Sequence[Any]]:
+        """Stream chunks of (latitude, longitude, elevation, timestamp) rows in insertion order."""
+        conditions, params = self.gps_conditions(bbox, start, end)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self.iter_query(
+            f"SELECT latitude, longitude, elevation, timestamp FROM gps_data{where} ORDER BY id", params, chunk_size
+        )
+
 class SQLiteBackend(StorageBackend):
     """SQLite backend"""
 
-    def __init__(self, *, db_path: str):
+    def __init__(self, *, db_path: str, max_read_connections: int = 8):
         super().__init__()
+        self.db_path = db_path
         self.conn = sqlite3.connect(db_path)
         self.cursor = self.conn.cursor()
         self.log.info(f"Connected to sqlite database: {db_path}")
+        # In WAL mode readers don't block the writer (and vice versa), so reads get their own connections from a
+        # pool of at most max_read_connections. An in-memory database can't be shared and stays on the writer.
+        self.concurrent_reads = db_path != ":memory:" and not db_path.startswith("file::memory:")
+        if self.concurrent_reads:
+            self.execute("PRAGMA journal_mode=WAL")
+        self._read_slots = threading.BoundedSemaphore(max_read_connections)
+        self._idle_read_conns: list = []
+        self._read_conns_lock = threading.Lock()
         self.create_tables()
 
     def create_tables(self):
@@ -66,15 +224,65 @@ class SQLiteBackend(StorageBackend):
             )
             """
         )
+        # Indexes backing the time-window and viewport queries
+        self.execute("CREATE INDEX IF NOT EXISTS idx_gps_data_time ON gps_data(timestamp)")
+        self.execute("CREATE INDEX IF NOT EXISTS idx_gps_data_lat_lon ON gps_data(latitude, longitude)")
         self.commit()
 
     def execute(self, query: str):
         return self.cursor.execute(query)
 
-    def fetch_all_from_query(self, query: str) -> Sequence[Any]:
-        self.cursor.execute(query)
+    def fetch_all_from_query(self, query: str, params: Optional[Dict[str, Any]] = None) -> Sequence[Any]:
+        self.cursor.execute(query, params or {})
         return self.cursor.fetchall()
 
+    @contextlib.contextmanager
+    def read_connection(self) -> Iterator[sqlite3.Connection]:
+        """
+        Read-only connection from the pool for the duration of the with block. Blocks while all
+        max_read_connections are in use, so the number of open connections (and WAL file handles) stays bounded.
+        """
+        with self._read_slots:
+            with self._read_conns_lock:
+                conn = self._idle_read_conns.pop() if self._idle_read_conns else None
+            if conn is None:
+                # Used by one thread at a time, but not always the one that opened it
+                conn = sqlite3.connect(self.db_path, check_same_thread=False)
+                conn.execute("PRAGMA query_only=ON")
+            try:
+                yield conn
+            finally:
+                with self._read_conns_lock:
+                    self._idle_read_conns.append(conn)
+
+    def read_all_from_query(self, query: str, params: Optional[Dict[str, Any]] = None) -> Sequence[Any]:
+        if not self.concurrent_reads:
+            return self.fetch_all_from_query(query, params)
+        with self.read_connection() as conn:
+            return conn.execute(query, params or {}).fetchall()
+
+    def iter_query(self, query: str, params: Optional[Dict[str, Any]] = None,
+                   chunk_size: int = 1000) -> Iterator[Sequence[Any]]:
+        if not self.concurrent_reads:
+            yield from super().iter_query(query, params, chunk_size)
+            return
+        with self.read_connection() as conn:
+            cursor = conn.execute(query, params or {})
+            try:
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield rows
+            finally:
+                cursor.close()
+
+    def insert_rows(self, table: str, columns: Sequence[str], rows: Sequence[Sequence[Any]]):
+        placeholders = ", ".join("?" for _ in columns)
+        self.cursor.executemany(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})", rows
+        )
+
     def commit(self):
         self.conn.commit()
 
@@ -83,15 +291,29 @@ class SQLiteBackend(StorageBackend):
 
     def close_and_cleanup(self):
         self.log.debug(f"Closing sqlite connection...")
+        with self._read_conns_lock:
+            for conn in self._idle_read_conns:
+                conn.close()
+            self._idle_read_conns.clear()
         self.conn.close()
 
+def text(query: str):
+    """sqlalchemy.text; SQLAlchemy is imported on first use, only the Postgres backend needs it."""
+    from sqlalchemy import text as sql_text
+    return sql_text(query)
+
+
 class PostgresBackend(StorageBackend):
     """PostgreSQL backend"""
+    # Reads check out their own connection from the engine pool
+    concurrent_reads = True
 
-    def __init__(self, *, engine_url: str):
+    def __init__(self, *, engine_url: str, pool_size: int = 10):
         super().__init__()
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import scoped_session, sessionmaker
         # 'postgresql://localhost/geolocation_db'
-        self.engine = create_engine(engine_url)
+        self.engine = create_engine(engine_url, pool_size=pool_size, max_overflow=pool_size)
         self.session = scoped_session(sessionmaker(bind=self.engine))
         self.log.info(f"Connected to postgres database: {engine_url}")
 
@@ -99,9 +321,37 @@ class PostgresBackend(StorageBackend):
         query = text(query)
         return self.session.execute(query)
 
-    def fetch_all_from_query(self, query: str) -> Sequence[Any]:
+    def fetch_all_from_query(self, query: str, params: Optional[Dict[str, Any]] = None) -> Sequence[Any]:
         query = text(query)
-        return self.session.execute(query).fetchall()
+        return self.session.execute(query, params or {}).fetchall()
+
+    def read_all_from_query(self, query: str, params: Optional[Dict[str, Any]] = None) -> Sequence[Any]:
+        with self.engine.connect() as conn:
+            return conn.execute(text(query), params or {}).fetchall()
+
+    def iter_query(self, query: str, params: Optional[Dict[str, Any]] = None,
+                   chunk_size: int = 1000) -> Iterator[Sequence[Any]]:
+        # Server-side (named) cursor, only chunk_size rows are held in memory at a time
+        with self.engine.connect() as conn:
+            result = conn.execution_options(stream_results=True, max_row_buffer=chunk_size).execute(
+                text(query), params or {}
+            )
+            yield from result.partitions(chunk_size)
+
+    def bbox_condition(self, bbox: BoundingBox) -> str:
+        # && on the geography column is answered by the GIST index (see Database/schema.sql)
+        return "Geography && ST_MakeEnvelope(:min_lon, :min_lat, :max_lon, :max_lat, 4326)::geography"
+
+    def insert_rows(self, table: str, columns: Sequence[str], rows: Sequence[Sequence[Any]]):
+        # One multi-row VALUES statement per batch, so a batch costs a single round trip
+        values = []
+        params = {}
+        for i, row in enumerate(rows):
+            names = [f"p{i}_{j}" for j in range(len(columns))]
+            values.append(f"({', '.join(':' + n for n in names)})")
+            params.update(zip(names, row))
+        query = text(f"INSERT INTO {table} ({', '.join(columns)}) VALUES {', '.join(values)}")
+        self.session.execute(query, params)
 
     def commit(self):
         self.session.commit()
@@ -112,116 +362,497 @@ class PostgresBackend(StorageBackend):
     def close_and_cleanup(self):
         self.log.debug(f"Closing postgres connection...")
         self.session.close()
+        self.engine.dispose()
+
+
+class _Task(NamedTuple):
+    ticket: int
+    enqueued: float
+    func: Optional[Callable]
+    args: tuple
+    kwargs: dict
+    result_queue: Optional[queue.Queue]
+    # (table, columns, rows, row count) for inserts that may be coalesced with their neighbours
+    insert: Optional[tuple] = None
+
+
+_NO_TASK = object()
 
 
 class DBWorker(threading.Thread):
-    def __init__(self, storage_factory):
-        super().__init__()
+    """
+    Single writer thread owning the storage backend. Tasks run in submission order;
+    every task gets a ticket so readers can wait until the writes submitted before them are done.
+
+    Consecutive insert tasks for the same table are coalesced into one transaction (group commit):
+    whatever is queued, plus what arrives within coalesce_window seconds, up to max_batch_rows rows.
+    If the group's transaction fails, its inserts are retried one by one, so only the failing ones fail.
+    Submitting blocks while max_queue_size tasks are waiting (backpressure).
+    """
+    def __init__(self, storage_factory, batch_size: int = 1000, coalesce_window: float = 0.0,
+                 max_batch_rows: int = 100_000, max_queue_size: int = 10_000):
+        super().__init__(daemon=True)
         self.storage_factory = storage_factory
         self.storage = None
-        self.task_queue = queue.Queue()
+        self.batch_size = batch_size
+        self.coalesce_window = coalesce_window
+        self.max_batch_rows = max_batch_rows
+        self.task_queue = queue.Queue(maxsize=max_queue_size)
         self.stop_event = threading.Event()
+        self.ready = threading.Event()
         self.log = logging.getLogger(__name__)
+        self.wait_stats = TimingStats(DB_WAIT_SECONDS.labels("worker"))
+        self.exec_stats = TimingStats(DB_EXEC_SECONDS.labels("worker"))
+        self._tickets = 0
+        self._completed = 0
+        self._ticket_lock = threading.Lock()
+        self._completed_cond = threading.Condition()
+        # Called as on_insert_done(ticket, exception or None) once an insert nobody waits for committed or failed
+        self.on_insert_done: Optional[Callable[[int, Optional[Exception]], None]] = None
+
+    @property
+    def queue_depth(self) -> int:
+        return self.task_queue.qsize()
+
+    @property
+    def last_ticket(self) -> int:
+        """Ticket of the most recently submitted task."""
+        return self._tickets
 
     def run(self):
-        self.storage = self.storage_factory()
-        while not self.stop_event.is_set():
+        try:
+            self.storage = self.storage_factory()
+        finally:
+            self.ready.set()
+        carry = _NO_TASK
+        while True:
+            # A task taken from the queue while coalescing inserts that could not join the group
+            task = self.task_queue.get() if carry is _NO_TASK else carry
+            carry = _NO_TASK
+            if task is None:
+                self.task_queue.task_done()
+                break
+            if task.insert is not None:
+                group, carry = self._collect_inserts(task)
+                self._run_inserts(group)
+            else:
+                self._run(task)
+        if self.storage:
+            self.storage.close_and_cleanup()
+
+    def _finish(self, tasks: Sequence[_Task]):
+        with self._completed_cond:
+            self._completed = tasks[-1].ticket
+            self._completed_cond.notify_all()
+        for _ in tasks:
+            self.task_queue.task_done()
+
+    def _run(self, task: _Task):
+        started = time.perf_counter()
+        self.wait_stats.record(started - task.enqueued)
+        try:
+            result = task.func(*task.args, **task.kwargs)
+            if task.result_queue:
+                task.result_queue.put(result)
+        except Exception as e:
+            self.log.error("Error executing DB operation", exc_info=True)
+            if task.result_queue:
+                task.result_queue.put(e)
+        finally:
+            self.exec_stats.record(time.perf_counter() - started)
+            self._finish([task])
+
+    def _collect_inserts(self, first: _Task):
+        """Gather the insert tasks following first. Returns the group and the next other task (or _NO_TASK)."""
+        group = [first]
+        rows = first.insert[3]
+        deadline = time.perf_counter() + self.coalesce_window
+        while rows < self.max_batch_rows:
+            timeout = deadline - time.perf_counter()
             try:
-                # Each task is a tuple: (callable, args, kwargs, result_queue)
-                func, args, kwargs, result_queue = self.task_queue.get(timeout=0.1)
-                try:
-                    result = func(*args, **kwargs)
-                    if result_queue:
-                        result_queue.put(result)
-                except Exception as e:
-                    self.log.error("Error executing DB operation", exc_info=True)
-                    if result_queue:
-                        result_queue.put(e)
-                finally:
-                    self.task_queue.task_done()
+                task = self.task_queue.get(timeout=timeout) if timeout > 0 else self.task_queue.get_nowait()
             except queue.Empty:
-                continue
-        self.storage.close_and_cleanup()
+                break
+            if task is None or task.insert is None or task.insert[:2] != first.insert[:2]:
+                return group, task
+            group.append(task)
+            rows += task.insert[3]
+        return group, _NO_TASK
+
+    def _run_inserts(self, group: Sequence[_Task]):
+        started = time.perf_counter()
+        for task in group:
+            self.wait_stats.record(started - task.enqueued)
+        table, columns = group[0].insert[:2]
+        try:
+            self.storage.bulk_insert(table, columns, chain.from_iterable(t.insert[2] for t in group),
+                                     batch_size=self.batch_size)
+            results = [None] * len(group)
+            if len(group) > 1:
+                self.log.debug(f"Coalesced {len(group)} inserts into {table} into one commit")
+        except Exception as e:
+            if len(group) == 1:
+                self.log.error(f"Error inserting into {table}", exc_info=True)
+                results = [e]
+            else:
+                # The rollback took every insert of the group with it, find the bad ones
+                self.log.warning(f"Group commit of {len(group)} inserts into {table} failed, retrying one by one")
+                results = [self._retry_insert(task, e) for task in group]
+        for task, result in zip(group, results):
+            if task.result_queue:
+                task.result_queue.put(result)
+            elif self.on_insert_done is not None:
+                try:
+                    self.on_insert_done(task.ticket, result)
+                except Exception:
+                    self.log.error("Insert completion handler failed", exc_info=True)
+        self.exec_stats.record(time.perf_counter() - started)
+        self._finish(group)
+
+    def _retry_insert(self, task: _Task, group_error: Exception) -> Optional[Exception]:
+        table, columns, rows = task.insert[:3]
+        if iter(rows) is rows:
+            # A one-shot iterator was used up by the failed attempt
+            return group_error
+        try:
+            self.storage.bulk_insert(table, columns, rows, batch_size=self.batch_size)
+            return None
+        except Exception as e:
+            self.log.error(f"Error inserting into {table}", exc_info=True)
+            return e
+
+    def _put(self, func, args, kwargs, result_queue, insert=None) -> int:
+        # Tickets must be handed out in queue order. put() blocks while the queue is full
+        with self._ticket_lock:
+            self._tickets += 1
+            ticket = self._tickets
+            self.task_queue.put(_Task(ticket, time.perf_counter(), func, args, kwargs, result_queue, insert))
+        return ticket
 
     def submit(self, func, *args, **kwargs):
         # Create a queue to retrieve a result if needed
         result_queue = queue.Queue()
-        self.task_queue.put((func, args, kwargs, result_queue))
+        self._put(func, args, kwargs, result_queue)
         # Block until the operation has finished and return the result
         return result_queue.get()
 
-    def submit_and_forget(self, func, *args, **kwargs):
-        self.task_queue.put((func, args, kwargs, None))
+    def submit_and_forget(self, func, *args, **kwargs) -> int:
+        """Queue func without waiting for it. Returns its ticket (see wait_for)."""
+        return self._put(func, args, kwargs, None)
+
+    def submit_insert(self, table: str, columns: Sequence[str], rows: Iterable[Sequence[Any]], row_count: int,
+                      wait: bool = False):
+        """
+        Queue an insert that may share a transaction with neighbouring inserts. rows should be re-iterable
+        (a list, or an object whose __iter__ starts over), so they can be retried alone if the group fails.
+        Returns the ticket, or with wait=True blocks until committed and returns None or the raised exception.
+        """
+        result_queue = queue.Queue() if wait else None
+        ticket = self._put(None, (), {}, result_queue, insert=(table, tuple(columns), rows, row_count))
+        return result_queue.get() if wait else ticket
+
+    def wait_for(self, ticket: int):
+        """Block until the task with the given ticket (and all before it) has run."""
+        with self._completed_cond:
+            self._completed_cond.wait_for(lambda: self._completed >= ticket or not self.is_alive())
+
+    def flush(self):
+        """Block until every task submitted so far has run."""
+        self.wait_for(self.last_ticket)
 
     def stop(self):
-        self.stop_event.set()
+        if not self.stop_event.is_set():
+            self.stop_event.set()
+            self.task_queue.put(None)
+
+
+GPS_COLUMNS = ("latitude", "longitude", "elevation", "timestamp")
+
+
+class _TrackRows:
+    """Re-iterable database rows of a track"""
+
+    def __init__(self, track: Track):
+        self.track = track
+
+    def __iter__(self) -> Iterator[tuple]:
+        return self.track.iter_rows()
 
 
 class Datastore:
     """Interface to storage backend"""
 
-    def __init__(self, storage_factory):
+    def __init__(self, storage_factory, batch_size: int = 1000, coalesce_window: float = 0.0,
+                 max_batch_rows: int = 100_000, max_queue_size: int = 10_000):
         self.log = logging.getLogger(__name__)
-        self.db_worker = DBWorker(storage_factory)
-        self.db_worker.start()
-        atexit.register(self.db_worker.stop)
+        self.batch_size = batch_size
+        self._db_worker = DBWorker(storage_factory, batch_size=batch_size, coalesce_window=coalesce_window,
+                                   max_batch_rows=max_batch_rows, max_queue_size=max_queue_size)
+        self._db_worker.on_insert_done = self._insert_done
+        self._start_lock = threading.Lock()
+        atexit.register(self.close)
         self._cache = {}
+        self._version = 0
+        # Guards the version, the cached track and the count of writes submitted but not yet applied to them
+        self._version_lock = threading.Lock()
+        self._writes_in_flight = 0
+        self._listeners = []
+        # Inserts nobody waits for are announced once committed. The worker may finish one before insert_points
+        # registered it: ticket -> (track, version) registered, ticket -> error (or None) finished first
+        self._announce_lock = threading.Lock()
+        self._unannounced: Dict[int, Tuple[Track, int]] = {}
+        self._done_early: Dict[int, Optional[Exception]] = {}
+        self.read_wait_stats = TimingStats(DB_WAIT_SECONDS.labels("read"))
+        self.read_exec_stats = TimingStats(DB_EXEC_SECONDS.labels("read"))
+
+    @property
+    def db_worker(self) -> DBWorker:
+        """The writer thread. It is started, and the storage backend opened, on first use rather than at startup."""
+        if self._db_worker.ident is None:
+            with self._start_lock:
+                if self._db_worker.ident is None:
+                    self._db_worker.start()
+        return self._db_worker
+
+    @property
+    def version(self) -> int:
+        """Dataset version, bumped on every write. Use it to key caches derived from the GPS data."""
+        return self._version
+
+    def subscribe(self, callback: Callable[[str, Optional[Track], int], None]):
+        """
+        Register callback(event, track, version) to be called after every write, with the dataset version the
+        write was given: ("insert", inserted points) once they are committed, ("delete", None), or
+        ("invalidate", None) when an insert nobody waited for failed to commit, so derived state has to start
+        over. Callbacks may run on the writer thread, and versions of concurrent writes may arrive out of order.
+        """
+        self._listeners.append(callback)
 
-    def load_gps_data(self):
+    def _write(self, submit: Callable[[], Any], update_cache: Callable[[], None]) -> Tuple[Any, int]:
         """
-        Fetch GPS data from the database.
+        Submit a write, then apply it to the cache and bump the version in one step. In between the write is in
+        flight, and fetch_gps_data doesn't cache a load that overlapped it. Returns the result of submit and the
+        version after it; if the result is an exception (or submit raises) the cache and version are left alone.
+        """
+        with self._version_lock:
+            self._writes_in_flight += 1
+        applied = False
+        try:
+            result = submit()
+            applied = not isinstance(result, Exception)
+        finally:
+            with self._version_lock:
+                self._writes_in_flight -= 1
+                if applied:
+                    update_cache()
+                    self._version += 1
+                version = self._version
+        return result, version
+
+    def _announce_when_done(self, ticket: int, track: Track, version: int) -> None:
+        with self._announce_lock:
+            if ticket not in self._done_early:
+                self._unannounced[ticket] = (track, version)
+                return
+            error = self._done_early.pop(ticket)
+        self._announce(ticket, error, track, version)
+
+    def _insert_done(self, ticket: int, error: Optional[Exception]) -> None:
+        # Runs on the writer thread after an insert nobody waits for committed or failed
+        with self._announce_lock:
+            registered = self._unannounced.pop(ticket, None)
+            if registered is None:
+                self._done_early[ticket] = error
+                return
+        self._announce(ticket, error, *registered)
+
+    def _announce(self, ticket: int, error: Optional[Exception], track: Track, version: int) -> None:
+        if error is None:
+            self._notify_write("insert", version, track)
+            return
+        # The cache already holds the points, reload from the database
+        self.log.error(f"Insert {ticket} failed, dropping the cached GPS data: {error}")
+        _, version = self._write(lambda: None, lambda: self._cache.pop("gps_data", None))
+        self._notify_write("invalidate", version)
+
+    def _notify_write(self, event: str, version: int, track: Optional[Track] = None):
+        for callback in list(self._listeners):
+            try:
+                callback(event, track, version)
+            except Exception:
+                self.log.error(f"Write listener failed for {event}", exc_info=True)
+
+    def load_gps_data(self, bbox: Optional[BoundingBox] = None, start: Optional[str] = None,
+                      end: Optional[str] = None):
+        """
+        Fetch GPS data from the database, optionally limited to a bounding box and time range.
         Returns a list of tuples containing latitude, longitude, elevation, and timestamp.
         """
-        def query_func():
-            return self.db_worker.storage.fetch_all_from_query(
-                "SELECT latitude, longitude, elevation, timestamp FROM gps_data ORDER BY timestamp"
-            )
-        result = self.db_worker.submit(query_func)
+        result = self._read(lambda storage: storage.query_gps_data(bbox=bbox, start=start, end=end))
         if not isinstance(result, Exception):
+            window = bbox is not None or start is not None or end is not None
+            QUERY_ROWS.labels("window" if window else "all").observe(len(result))
             return result
         else:
             self.log.error("Failed to fetch GPS data", exc_info=True)
             return []
 
+    def query_gps_data(self, bbox: Optional[BoundingBox] = None, start: Optional[str] = None,
+                       end: Optional[str] = None):
+        """
+        Fetch the GPS points inside a viewport and/or time window straight from the database.
+        Returns a Track; without any filter this is the cached full track.
+        """
+        if bbox is None and start is None and end is None:
+            return self.fetch_gps_data()
+        return Track.from_rows(self.load_gps_data(bbox=bbox, start=start, end=end))
+
+    def first_gps_point(self) -> Optional[Tuple[float, float]]:
+        """Latitude and longitude of the first inserted point, or None if there are none. Reads one row at most."""
+        cached = self.cached_gps_data()
+        if cached is not None:
+            return (float(cached.latitude[0]), float(cached.longitude[0])) if len(cached) else None
+        result = self._read(lambda storage: storage.first_gps_point())
+        if isinstance(result, Exception):
+            self.log.error("Failed to fetch the first GPS point", exc_info=True)
+            return None
+        return (float(result[0]), float(result[1])) if result is not None else None
+
+    def iter_gps_rows(self, bbox: Optional[BoundingBox] = None, start: Optional[str] = None,
+                      end: Optional[str] = None, after: Optional[Tuple[str, int]] = None,
+                      limit: Optional[int] = None, chunk_size: int = 1000) -> Iterator[Sequence[Any]]:
+        """
+        Stream chunks of (id, latitude, longitude, elevation, timestamp) rows ordered by (timestamp, id)
+        from a server-side cursor, see StorageBackend.iter_gps_rows. Memory use is bounded by chunk_size.
+        """
+        return self._iter(lambda storage: storage.iter_gps_rows(
+            bbox=bbox, start=start, end=end, after=after, limit=limit, chunk_size=chunk_size
+        ))
+
+    def iter_gps_data(self, bbox: Optional[BoundingBox] = None, start: Optional[str] = None,
+                      end: Optional[str] = None, chunk_size: int = 100_000) -> Iterator[Track]:
+        """Stream all (matching) points in insertion order as Tracks of up to chunk_size points, for exports."""
+        for rows in self._iter(lambda storage: storage.iter_gps_data(bbox, start, end, chunk_size)):
+            yield Track.from_rows(rows)
+
+    def _iter(self, func: Callable[[StorageBackend], Iterator[Any]]) -> Iterator[Any]:
+        """Streaming counterpart of _read: iterate func(storage) after the pending writes are done."""
+        self.db_worker.ready.wait()
+        self.db_worker.flush()
+        storage = self.db_worker.storage
+        if storage.concurrent_reads:
+            yield from func(storage)
+            return
+        chunks = self.db_worker.submit(lambda: list(func(storage)))
+        if isinstance(chunks, Exception):
+            raise chunks
+        yield from chunks
+
+    def _read(self, func: Callable[[StorageBackend], Any]) -> Any:
+        """
+        Run func(storage) for a read. Reads wait for the writes submitted before them (read-your-writes),
+        but not for each other: with a backend that supports concurrent reads they run in the calling thread
+        on its own connection, otherwise they are queued on the DB worker.
+        Returns the result, or the exception raised by func.
+        """
+        started = time.perf_counter()
+        self.db_worker.ready.wait()
+        self.db_worker.flush()
+        storage = self.db_worker.storage
+        if storage is None or not storage.concurrent_reads:
+            self.read_wait_stats.record(time.perf_counter() - started)
+            return self.db_worker.submit(func, storage)
+        self.read_wait_stats.record(time.perf_counter() - started)
+        started = time.perf_counter()
+        try:
+            return func(storage)
+        except Exception as e:
+            self.log.error("Error executing DB read", exc_info=True)
+            return e
+        finally:
+            self.read_exec_stats.record(time.perf_counter() - started)
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue depth and wait/execution times of the writer and the read path."""
+        return {
+            "queue_depth": self.db_worker.queue_depth,
+            "write_wait": self.db_worker.wait_stats.snapshot(),
+            "write_exec": self.db_worker.exec_stats.snapshot(),
+            "read_wait": self.read_wait_stats.snapshot(),
+            "read_exec": self.read_exec_stats.snapshot(),
+        }
+
+    def cached_gps_data(self) -> Optional[Track]:
+        """The cached full track of fetch_gps_data, or None if it isn't loaded. Never touches the database."""
+        return self._cache.get("gps_data")
+
     def fetch_gps_data(self):
         """
         Fetch GPS data from the database.
-        Returns a list of GeoPoint objects.
+        Returns a columnar Track (indexing it yields GeoPoint objects). The full track is cached and extended by
+        later inserts; a load that overlapped a write is returned but not cached, it may or may not contain it.
         """
-        if not self._cache.get("gps_data"):
-            rows = self.load_gps_data()
-            self._cache["gps_data"] = [
-                GeoPoint(latitude=row[0], longitude=row[1], elevation=row[2], timestamp=row[3])
-                for row in rows
-            ]
-        return self._cache["gps_data"]
+        cached = self.cached_gps_data()
+        if cached is not None:
+            return cached
+        with self._version_lock:
+            version, idle = self._version, self._writes_in_flight == 0
+        track = Track.from_rows(self.load_gps_data())
+        with self._version_lock:
+            if idle and self._writes_in_flight == 0 and self._version == version:
+                self._cache["gps_data"] = track
+        return track
 
     def delete_gps_data(self):
         """Delete all GPS data from the database."""
         def delete_func():
             self.db_worker.storage.execute_and_commit("DELETE FROM gps_data")
 
-        self.db_worker.submit_and_forget(delete_func)
-        del self._cache["gps_data"]
-
-    def insert_points(self, points: Union[GeoPoint, Sequence[GeoPoint]]):
-        """Insert GPS data into the database."""
-        def insert_func(seq):
-            for p in seq:
-                self.db_worker.storage.execute(
-                    f"INSERT INTO gps_data (latitude, longitude, elevation, timestamp) "
-                    f"VALUES ({p.latitude}, {p.longitude}, {p.elevation}, '{p.timestamp}')"
-                )
-            self.db_worker.storage.commit()
+        _, version = self._write(lambda: self.db_worker.submit_and_forget(delete_func),
+                                 lambda: self._cache.pop("gps_data", None))
+        self._notify_write("delete", version)
 
+    def insert_points(self, points: Union[GeoPoint, Sequence[GeoPoint], Track], wait: bool = False):
+        """
+        Insert GPS data into the database.
+        The write is queued and may be committed together with other queued inserts. The points are
+        durable once flush() returns, or when this returns with wait=True (which raises if the commit failed).
+        """
         if isinstance(points, GeoPoint):
             points = [points]
-        self.db_worker.submit_and_forget(insert_func, points)
-        cache_gps_data = self._cache.get("gps_data")
-        if cache_gps_data:
-            cache_gps_data.extend(points)
+        track = Track.from_points(points)
+        POINTS_INSERTED.inc(len(track))
+
+        def extend_cache():
+            # Only extend a loaded cache, an unloaded one will pick the new points up from the database. The cached
+            # track is replaced, not appended to, so readers of the old one never see its columns change length
+            cache_gps_data = self._cache.get("gps_data")
+            if cache_gps_data is not None:
+                self._cache["gps_data"] = cache_gps_data.extended(track)
+
+        result, version = self._write(
+            lambda: self.db_worker.submit_insert("gps_data", GPS_COLUMNS, _TrackRows(track), len(track), wait=wait),
+            extend_cache
+        )
+        if not wait:
+            # result is the ticket, listeners hear of the points once they are committed
+            self._announce_when_done(result, track, version)
+        elif isinstance(result, Exception):
+            raise result
         else:
-            self._cache["gps_data"] = points
+            self._notify_write("insert", version, track)
+
+    def flush(self):
+        """Block until all writes queued so far are committed."""
+        self.db_worker.flush()
+
+    def close(self, timeout: Optional[float] = None):
+        """Stop the DB worker after the queued writes have run."""
+        if self._db_worker.ident is None:
+            # Never used, nothing to close
+            return
+        self.db_worker.stop()
+        self.db_worker.join(timeout)
 
     def revert(self):
         """Roll back the current transaction."""
@@ -232,3 +863,45 @@ class Datastore:
             self.log.error("Failed to revert transaction", exc_info=True)
 
 
+
+
+class AsyncDatastore:
+    """
+    Awaitable facade over a Datastore for asyncio servers.
+    Blocking datastore calls run on a bounded thread pool, so the event loop never waits on the database.
+    """
+
+    def __init__(self, datastore: Datastore, max_workers: int = 8):
+        self.ds = datastore
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="datastore")
+
+    @property
+    def version(self) -> int:
+        return self.ds.version
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        """Run a blocking callable on the datastore executor."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, lambda: func(*args, **kwargs))
+
+    async def fetch_gps_data(self) -> Track:
+        cached = self.ds.cached_gps_data()
+        if cached is not None:
+            return cached
+        return await self.run(self.ds.fetch_gps_data)
+
+    async def query_gps_data(self, bbox: Optional[BoundingBox] = None, start: Optional[str] = None,
+                             end: Optional[str] = None) -> Track:
+        return await self.run(self.ds.query_gps_data, bbox=bbox, start=start, end=end)
+
+    async def insert_points(self, points: Union[GeoPoint, Sequence[GeoPoint], Track], wait: bool = False):
+        return await self.run(self.ds.insert_points, points, wait=wait)
+
+    async def delete_gps_data(self):
+        return await self.run(self.ds.delete_gps_data)
+
+    async def flush(self):
+        return await self.run(self.ds.flush)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
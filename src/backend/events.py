@@ -0,0 +1,181 @@
+import json
+import queue
+import threading
+from collections import deque
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from .datastore import Datastore
+from .track import Track
+from .util import BoundingBox
+
+# Coordinates are sent as integer micro degrees (~11 cm)
+COORDINATE_SCALE = 1_000_000
+# Inserts larger than this are not pushed, clients reload instead
+MAX_EVENT_POINTS = 50_000
+# Points of recent inserts kept to replay to clients that connect (or reconnect) a little late
+MAX_BUFFERED_POINTS = 200_000
+# Events waiting per client before it is considered too slow and told to reload
+MAX_PENDING_EVENTS = 1_000
+KEEPALIVE_SECONDS = 15.0
+
+
+def encode_points(track: Track) -> dict:
+    """
+    Delta-encode the coordinates of a track: integer degrees * COORDINATE_SCALE, the first value absolute and
+    every following one as the difference to its predecessor. Consecutive GPS fixes are close together,
+    so the differences are short numbers.
+    """
+    lat = np.rint(track.latitude * COORDINATE_SCALE).astype(np.int64)
+    lon = np.rint(track.longitude * COORDINATE_SCALE).astype(np.int64)
+    return {
+        "count": len(track),
+        "scale": COORDINATE_SCALE,
+        "lat": np.diff(lat, prepend=0).tolist(),
+        "lon": np.diff(lon, prepend=0).tolist(),
+    }
+
+
+def decode_points(data: dict) -> Tuple[np.ndarray, np.ndarray]:
+    """Latitudes and longitudes of an encode_points payload."""
+    return (np.cumsum(np.asarray(data["lat"], dtype=np.int64)) / data["scale"],
+            np.cumsum(np.asarray(data["lon"], dtype=np.int64)) / data["scale"])
+
+
+def format_event(event: str, data: dict, event_id: Optional[int] = None) -> str:
+    """A Server-Sent Events message."""
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+class _Subscriber:
+    def __init__(self, bbox: Optional[BoundingBox], since: Optional[int]):
+        self.bbox = bbox
+        # Writes up to this version are already on the client's page
+        self.since = -1 if since is None else since
+        self.queue: queue.Queue = queue.Queue(maxsize=MAX_PENDING_EVENTS)
+
+
+class EventBroker:
+    """
+    Pushes the points inserted into a datastore to connected clients as Server-Sent Events.
+    Every write is an event with its dataset version as id, inserts are sent once committed. Inserts are sent
+    as "points" events with the new points only, optionally limited to the client's bbox. Deletes, very large
+    inserts, slow clients and versions that are no longer buffered get a "reset" event instead: the client has
+    to reload.
+    """
+
+    def __init__(self, datastore: Datastore):
+        self.ds = datastore
+        self._lock = threading.Lock()
+        self._subscribers: List[_Subscriber] = []
+        # (version, inserted track or None for a reset), oldest first
+        self._recent: deque = deque()
+        self._buffered_points = 0
+        # Latest version announced by the datastore
+        self._version = datastore.version
+        datastore.subscribe(self.on_write)
+
+    def on_write(self, event: str, track: Optional[Track], version: int) -> None:
+        """Datastore write listener: buffer the write and hand it to every subscriber."""
+        if event != "insert" or track is None or len(track) > MAX_EVENT_POINTS:
+            track = None
+        with self._lock:
+            self._version = max(self._version, version)
+            # Concurrent writes may be announced out of order, keep the buffer sorted
+            index = len(self._recent)
+            while index > 0 and self._recent[index - 1][0] > version:
+                index -= 1
+            self._recent.insert(index, (version, track))
+            self._buffered_points += len(track) if track is not None else 0
+            # Never buffer more than a client queue holds, replays must fit into it
+            while len(self._recent) > 1 and (self._buffered_points > MAX_BUFFERED_POINTS
+                                             or len(self._recent) > MAX_PENDING_EVENTS):
+                _, dropped = self._recent.popleft()
+                self._buffered_points -= len(dropped) if dropped is not None else 0
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            if version <= subscriber.since:
+                continue
+            message = self._message(version, track, subscriber.bbox)
+            if message is None:
+                continue
+            try:
+                subscriber.queue.put_nowait(message)
+            except queue.Full:
+                self._overflow(subscriber)
+
+    def _overflow(self, subscriber: _Subscriber) -> None:
+        # The client can't keep up, make room for a final reset
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+        while True:
+            try:
+                subscriber.queue.get_nowait()
+            except queue.Empty:
+                break
+        subscriber.queue.put_nowait(format_event("reset", {"reason": "overflow"}))
+        subscriber.queue.put_nowait(None)
+
+    @staticmethod
+    def _message(version: int, track: Optional[Track], bbox: Optional[BoundingBox]) -> Optional[str]:
+        if track is None:
+            return format_event("reset", {"version": version}, version)
+        if bbox is not None:
+            track = track[(track.latitude >= bbox.min_lat) & (track.latitude <= bbox.max_lat)
+                          & (track.longitude >= bbox.min_lon) & (track.longitude <= bbox.max_lon)]
+            if len(track) == 0:
+                return None
+        return format_event("points", {"version": version, **encode_points(track)}, version)
+
+    def subscribe(self, since: Optional[int] = None, bbox: Optional[BoundingBox] = None) -> _Subscriber:
+        """
+        Register a client. With since (the dataset version the client has seen), the writes after it are
+        replayed first, or a reset is queued if they are no longer buffered. Writes up to since that are
+        announced later (inserts committed after the page was rendered) are skipped.
+        """
+        subscriber = _Subscriber(bbox, since)
+        with self._lock:
+            missed = []
+            if since is not None and since > self.ds.version:
+                # A version ahead of the dataset's is from before a restart
+                missed = [(self.ds.version, None)]
+            elif since is not None and since < self._version:
+                missed = [(version, track) for version, track in self._recent if version > since]
+                # The buffer has to reach back to the client's version
+                if not self._recent or self._recent[0][0] > since + 1:
+                    missed = [(self._version, None)]
+            for version, track in missed:
+                message = self._message(version, track, bbox)
+                if message is not None:
+                    subscriber.queue.put_nowait(message)
+            self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: _Subscriber) -> None:
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+    def stream(self, since: Optional[int] = None, bbox: Optional[BoundingBox] = None,
+               keepalive: float = KEEPALIVE_SECONDS) -> Iterator[str]:
+        """SSE messages for one client, with a comment every keepalive seconds so proxies keep the connection."""
+        subscriber = self.subscribe(since, bbox)
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    message = subscriber.queue.get(timeout=keepalive)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if message is None:
+                    return
+                yield message
+        finally:
+            self.unsubscribe(subscriber)
+
+    def __len__(self) -> int:
+        return len(self._subscribers)
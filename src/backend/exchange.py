@@ -0,0 +1,394 @@
+"""
+Description:
+    Binary export and import of gps_data as Parquet, Arrow IPC and FlatGeobuf.
+    Points are moved in batches of columns (see Track), so neither side parses text row by row and memory use
+    is bounded by the batch size. The files keep latitude, longitude, elevation and a UTC timestamp column and
+    can be opened directly by pandas, DuckDB, Polars, QGIS and other Arrow / GDAL based tools.
+
+    Command line usage (from the src folder):
+        python -m backend.exchange export <file> [--format <format>] [--db-url <url>] [--batch-size <n>]
+        python -m backend.exchange import <file> [--format <format>] [--db-url <url>] [--batch-size <n>]
+
+Dependencies:
+    - pyarrow, for all formats:
+        pip install pyarrow
+    - pyogrio (bundles GDAL), for FlatGeobuf:
+        pip install pyogrio
+
+Docs:
+    Parquet: https://arrow.apache.org/docs/python/parquet.html
+    Arrow IPC: https://arrow.apache.org/docs/python/ipc.html
+    FlatGeobuf: https://flatgeobuf.org/
+"""
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import BinaryIO, Iterable, Iterator, Optional, Union
+
+import numpy as np
+
+from .datastore import Datastore, PostgresBackend, SQLiteBackend
+from .metrics import IMPORT_POINTS, IMPORT_SECONDS
+from .track import NO_TIMESTAMP, Track
+
+FORMATS = {".parquet": "parquet", ".arrow": "arrow", ".arrows": "arrow", ".feather": "arrow", ".fgb": "fgb"}
+MIMETYPES = {
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "fgb": "application/flatgeobuf",
+}
+DEFAULT_BATCH_SIZE = 100_000
+DEFAULT_DB_URL = os.environ.get("GEOLOCATION_DB_URL", "postgresql://localhost/geolocation_db")
+
+# A little endian 2D WKB point: byte order, geometry type, x, y
+_WKB_POINT = np.dtype([("order", "u1"), ("type", "<u4"), ("x", "<f8"), ("y", "<f8")])
+
+log = logging.getLogger(__name__)
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise RuntimeError("Binary export/import needs pyarrow: pip install pyarrow")
+    return pyarrow
+
+
+def _pyogrio():
+    try:
+        import pyogrio
+    except ImportError:
+        raise RuntimeError("FlatGeobuf export/import needs pyogrio: pip install pyogrio")
+    return pyogrio
+
+
+def format_for_path(path: str) -> str:
+    """Guess the format from the file extension. Raises ValueError for unknown extensions."""
+    fmt = FORMATS.get(os.path.splitext(path)[1].lower())
+    if fmt is None:
+        raise ValueError(f"Unknown file type {path}, use one of {', '.join(sorted(FORMATS))}")
+    return fmt
+
+
+def arrow_schema():
+    pa = _pyarrow()
+    return pa.schema([
+        pa.field("latitude", pa.float64(), nullable=False),
+        pa.field("longitude", pa.float64(), nullable=False),
+        pa.field("elevation", pa.float64()),
+        pa.field("timestamp", pa.timestamp("s", tz="UTC")),
+        pa.field("raw_timestamp", pa.string()),
+    ])
+
+
+def track_to_batch(track: Track):
+    """
+    Columns of a Track as an Arrow record batch; missing elevations and timestamps become nulls. The original
+    strings of timestamps the seconds don't reproduce go into raw_timestamp, which is null everywhere else.
+    """
+    pa = _pyarrow()
+    raw = track.raw_timestamp
+    return pa.record_batch([
+        pa.array(track.latitude),
+        pa.array(track.longitude),
+        pa.array(track.elevation, mask=np.isnan(track.elevation)),
+        pa.array(track.timestamp, type=pa.timestamp("s", tz="UTC"), mask=track.timestamp == NO_TIMESTAMP),
+        pa.array(raw, type=pa.string()) if raw is not None else pa.nulls(len(track), pa.string()),
+    ], schema=arrow_schema())
+
+
+def batch_to_track(batch) -> Track:
+    """
+    Inverse of track_to_batch. Timestamps of any unit are truncated to seconds; the raw_timestamp column,
+    if present, restores the original strings.
+    """
+    pa = _pyarrow()
+    elevation = batch.column("elevation") if "elevation" in batch.schema.names else None
+    timestamp = batch.column("timestamp") if "timestamp" in batch.schema.names else None
+    raw = batch.column("raw_timestamp") if "raw_timestamp" in batch.schema.names else None
+    if raw is not None:
+        raw = raw.cast(pa.string()).to_numpy(zero_copy_only=False).astype(object) if raw.null_count < len(raw) else None
+    if timestamp is not None:
+        if not pa.types.is_timestamp(timestamp.type):
+            timestamp = timestamp.cast(pa.timestamp("s", tz="UTC"))
+        timestamp = timestamp.cast(pa.timestamp("s"), safe=False).cast(pa.int64()).fill_null(NO_TIMESTAMP)
+    return Track(
+        batch.column("latitude").to_numpy(),
+        batch.column("longitude").to_numpy(),
+        elevation.cast(pa.float64()).fill_null(np.nan).to_numpy() if elevation is not None else None,
+        timestamp.to_numpy() if timestamp is not None else None,
+        raw_timestamp=raw,
+    )
+
+
+def _wkb_points(track: Track):
+    """WKB point geometries of a track, built as one buffer without per-point Python objects."""
+    pa = _pyarrow()
+    points = np.empty(len(track), dtype=_WKB_POINT)
+    points["order"] = 1
+    points["type"] = 1
+    points["x"] = track.longitude
+    points["y"] = track.latitude
+    offsets = np.arange(len(track) + 1, dtype=np.int32) * _WKB_POINT.itemsize
+    return pa.Array.from_buffers(pa.binary(), len(track), [None, pa.py_buffer(offsets), pa.py_buffer(points)])
+
+
+def _wkb_coordinates(geometry) -> tuple:
+    """Longitudes and latitudes of a binary array of little endian 2D WKB points."""
+    offsets = np.frombuffer(geometry.buffers()[1], dtype=np.int32)[geometry.offset:geometry.offset + len(geometry) + 1]
+    if len(geometry) and not np.all(np.diff(offsets) == _WKB_POINT.itemsize):
+        raise ValueError("Only 2D point geometries can be imported")
+    data = geometry.buffers()[2]
+    points = np.frombuffer(data, dtype=_WKB_POINT, count=len(geometry), offset=int(offsets[0]))
+    if len(points) and not (np.all(points["order"] == 1) and np.all(points["type"] == 1)):
+        raise ValueError("Only little endian WKB point geometries can be imported")
+    return points["x"], points["y"]
+
+
+def _fgb_schema():
+    """FlatGeobuf features: the coordinates move into a WKB point geometry."""
+    pa = _pyarrow()
+    return arrow_schema().remove(0).remove(0).append(pa.field("geometry", pa.binary()))
+
+
+def _fgb_batches(tracks: Iterable[Track]):
+    pa = _pyarrow()
+    for track in tracks:
+        batch = track_to_batch(track)
+        yield pa.record_batch([batch.column("elevation"), batch.column("timestamp"), batch.column("raw_timestamp"),
+                               _wkb_points(track)], schema=_fgb_schema())
+
+
+def write_tracks(tracks: Iterable[Track], sink: Union[str, BinaryIO], fmt: str, spatial_index: bool = False) -> int:
+    """
+    Write a stream of tracks to a file path or file object as one Parquet row group / Arrow record batch per
+    track. FlatGeobuf is written through GDAL and needs a path; its spatial index is optional because it
+    reorders the points. Returns the number of points written.
+    """
+    pa = _pyarrow()
+    count = 0
+
+    def counted(source):
+        nonlocal count
+        for track in source:
+            count += len(track)
+            yield track
+
+    if fmt == "fgb":
+        pyogrio = _pyogrio()
+        reader = pa.RecordBatchReader.from_batches(_fgb_schema(), _fgb_batches(counted(tracks)))
+        pyogrio.write_arrow(reader, sink, driver="FlatGeobuf", geometry_name="geometry", geometry_type="Point",
+                            crs="EPSG:4326", encoding=None,
+                            layer_options={"SPATIAL_INDEX": "YES" if spatial_index else "NO"})
+        return count
+
+    with _open_writer(sink, fmt) as writer:
+        for track in counted(tracks):
+            if len(track):
+                writer.write_batch(track_to_batch(track))
+    return count
+
+
+def _open_writer(sink: Union[str, BinaryIO], fmt: str):
+    pa = _pyarrow()
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        return pq.ParquetWriter(sink, arrow_schema(), compression="zstd")
+    if fmt == "arrow":
+        return pa.ipc.new_stream(sink, arrow_schema())
+    raise ValueError(f"Unknown format {fmt}")
+
+
+def read_tracks(source: Union[str, BinaryIO], fmt: str, batch_size: int = DEFAULT_BATCH_SIZE) -> Iterator[Track]:
+    """Read a Parquet, Arrow IPC (file or stream) or FlatGeobuf file batch by batch as Tracks."""
+    pa = _pyarrow()
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(source).iter_batches(batch_size=batch_size):
+            yield batch_to_track(batch)
+    elif fmt == "arrow":
+        try:
+            reader = pa.ipc.open_file(source)
+            batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+        except pa.ArrowInvalid:
+            if not isinstance(source, str):
+                source.seek(0)
+            batches = pa.ipc.open_stream(source)
+        for batch in batches:
+            yield batch_to_track(batch)
+    elif fmt == "fgb":
+        from pyogrio.raw import open_arrow
+        _pyogrio()
+        with open_arrow(source, batch_size=batch_size, use_pyarrow=True) as (meta, reader):
+            for batch in reader:
+                lon, lat = _wkb_coordinates(batch.column(batch.schema.names[-1]))
+                columns = {"latitude": pa.array(lat), "longitude": pa.array(lon)}
+                for name in ("elevation", "timestamp", "raw_timestamp"):
+                    if name in batch.schema.names:
+                        columns[name] = batch.column(name)
+                yield batch_to_track(pa.record_batch(list(columns.values()), names=list(columns)))
+    else:
+        raise ValueError(f"Unknown format {fmt}")
+
+
+class _ChunkSink:
+    """Write-only file object that hands out what was written so far, for streaming responses."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def stream_export(tracks: Iterable[Track], fmt: str) -> Iterator[bytes]:
+    """
+    Encode tracks as a byte stream for HTTP responses, yielding after every batch.
+    FlatGeobuf can only be written to a file by GDAL, so it is written to a temporary file first.
+    """
+    if fmt == "fgb":
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "gps_data.fgb")
+            write_tracks(tracks, path, fmt)
+            with open(path, "rb") as f:
+                while True:
+                    data = f.read(1 << 20)
+                    if not data:
+                        return
+                    yield data
+
+    sink = _ChunkSink()
+    with _open_writer(sink, fmt) as writer:
+        for track in tracks:
+            if len(track):
+                writer.write_batch(track_to_batch(track))
+                yield sink.drain()
+    # Footer
+    yield sink.drain()
+
+
+def export_gps_data(datastore: Datastore, path: str, fmt: Optional[str] = None,
+                    batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+    """Export all of gps_data to path. Returns the number of points."""
+    fmt = fmt or format_for_path(path)
+    start = time.perf_counter()
+    count = write_tracks(datastore.iter_gps_data(chunk_size=batch_size), path, fmt)
+    _log_throughput("Exported", count, path, time.perf_counter() - start)
+    return count
+
+
+def import_gps_data(datastore: Datastore, path: str, fmt: Optional[str] = None,
+                    batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+    """
+    Append the points of a file to gps_data. Returns the number of points.
+    Batches are committed one by one; if one fails the error is raised and the batches before it are kept.
+    """
+    fmt = fmt or format_for_path(path)
+    start = time.perf_counter()
+    count = 0
+    for track in read_tracks(path, fmt, batch_size):
+        # Reading waits for the commit, so a failed write stops the import
+        datastore.insert_points(track, wait=True)
+        count += len(track)
+    elapsed = time.perf_counter() - start
+    IMPORT_POINTS.labels(fmt).inc(count)
+    IMPORT_SECONDS.labels(fmt).observe(elapsed)
+    _log_throughput("Imported", count, path, elapsed)
+    return count
+
+
+def _log_throughput(action: str, count: int, path: str, elapsed: float) -> None:
+    if elapsed > 0:
+        size = os.path.getsize(path) / 1e6
+        log.info(f"{action} {count} points ({size:.1f} MB) in {elapsed:.2f}s "
+                 f"({count / elapsed:.0f} points/sec, {size / elapsed:.1f} MB/sec)")
+
+
+def storage_for_url(db_url: str):
+    """Storage factory for a database URL; sqlite:///<path> uses the SQLite backend."""
+    if db_url.startswith("sqlite:///"):
+        path = db_url[len("sqlite:///"):]
+        return lambda: SQLiteBackend(db_path=path)
+    return lambda: PostgresBackend(engine_url=db_url)
+
+
+def validate_arguments(args):
+    """
+    Validate command-line arguments.
+    Returns the command, the file path and the options.
+    """
+    if len(args) < 3 or args[1].lower() not in ("export", "import") or any(a.lower() == "--help" for a in args):
+        print_help()
+        sys.exit(0 if "--help" in (a.lower() for a in args) else 1)
+
+    options = {"fmt": None, "db_url": DEFAULT_DB_URL, "batch_size": DEFAULT_BATCH_SIZE}
+    i = 3
+    while i < len(args):
+        arg = args[i].lower()
+        if arg not in ("--format", "--db-url", "--batch-size") or i + 1 >= len(args):
+            log.error(f"Error: Invalid argument '{args[i]}'. Valid arguments are: --format, --db-url, --batch-size, --help")
+            sys.exit(1)
+        value = args[i + 1]
+        if arg == "--format":
+            if value not in MIMETYPES:
+                log.error(f"Error: --format must be one of {', '.join(MIMETYPES)}.")
+                sys.exit(1)
+            options["fmt"] = value
+        elif arg == "--db-url":
+            options["db_url"] = value
+        else:
+            if not value.isdigit() or int(value) < 1:
+                log.error("Error: --batch-size requires a positive number.")
+                sys.exit(1)
+            options["batch_size"] = int(value)
+        i += 2
+    return args[1].lower(), args[2], options
+
+
+def print_help():
+    """Display usage instructions."""
+    print("Usage: python -m backend.exchange export|import <file> [--format <format>] [--db-url <url>] "
+          "[--batch-size <n>] [--help]")
+    print("\nOptions:")
+    print("  --format       parquet, arrow or fgb (default: from the file extension).")
+    print("  --db-url       Database URL, sqlite:///<path> for SQLite "
+          "(default: $GEOLOCATION_DB_URL or postgresql://localhost/geolocation_db).")
+    print(f"  --batch-size   Number of points per batch (default: {DEFAULT_BATCH_SIZE}).")
+    print("  --help         Display this help message and exit.")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    command, path, options = validate_arguments(sys.argv)
+    datastore = Datastore(storage_for_url(options["db_url"]))
+    try:
+        if command == "export":
+            export_gps_data(datastore, path, options["fmt"], options["batch_size"])
+        else:
+            import_gps_data(datastore, path, options["fmt"], options["batch_size"])
+    finally:
+        datastore.close()
+
+
+if __name__ == "__main__":
+    main()
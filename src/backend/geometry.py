@@ -0,0 +1,73 @@
+import numpy as np
+
+TILE_SIZE = 256
+MAX_LATITUDE = 85.0511287798
+
+
+def mercator_project(lat: np.ndarray, lon: np.ndarray, zoom: float = 0):
+    """
+    Project WGS84 coordinates to Web Mercator pixel coordinates at the given zoom level.
+    At zoom 0 the whole world is a single TILE_SIZE x TILE_SIZE tile.
+    """
+    lat = np.clip(np.asarray(lat, dtype=np.float64), -MAX_LATITUDE, MAX_LATITUDE)
+    lon = np.asarray(lon, dtype=np.float64)
+    scale = TILE_SIZE * 2.0 ** zoom
+    x = (lon + 180.0) / 360.0 * scale
+    sin_lat = np.sin(np.radians(lat))
+    y = (0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * np.pi)) * scale
+    return x, y
+
+
+def mercator_unproject(x: np.ndarray, y: np.ndarray, zoom: float = 0):
+    """Inverse of mercator_project: WGS84 latitude and longitude of Web Mercator pixel coordinates."""
+    scale = TILE_SIZE * 2.0 ** zoom
+    lon = np.asarray(x, dtype=np.float64) / scale * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(y, dtype=np.float64) / scale))))
+    return lat, lon
+
+
+def douglas_peucker(x: np.ndarray, y: np.ndarray, tolerance: float) -> np.ndarray:
+    """
+    Simplify a polyline with the Douglas-Peucker algorithm.
+    Returns the sorted indices of the vertices to keep; the first and last vertex are always kept.
+    Distances are measured to the segment (not the infinite line), so tracks that double back are preserved.
+    """
+    n = len(x)
+    if n < 3 or tolerance <= 0:
+        return np.arange(n)
+
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    tolerance_sq = tolerance * tolerance
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        xs = x[first + 1:last] - x[first]
+        ys = y[first + 1:last] - y[first]
+        dx = x[last] - x[first]
+        dy = y[last] - y[first]
+        seg_len_sq = dx * dx + dy * dy
+        if seg_len_sq > 0:
+            t = np.clip((xs * dx + ys * dy) / seg_len_sq, 0.0, 1.0)
+            xs = xs - t * dx
+            ys = ys - t * dy
+        dist_sq = xs * xs + ys * ys
+        i = int(np.argmax(dist_sq))
+        if dist_sq[i] > tolerance_sq:
+            split = first + 1 + i
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return np.flatnonzero(keep)
+
+
+def simplify_track(lat: np.ndarray, lon: np.ndarray, zoom: float, tolerance_px: float = 1.0) -> np.ndarray:
+    """
+    Zoom-aware simplification: drop vertices that deviate less than tolerance_px screen pixels
+    from the simplified line when rendered at the given zoom level.
+    Returns the indices of the vertices to keep.
+    """
+    x, y = mercator_project(lat, lon, zoom)
+    return douglas_peucker(x, y, tolerance_px)
@@ -0,0 +1,209 @@
+import struct
+import threading
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .cache import LRUCache
+from .datastore import Datastore
+from .geometry import TILE_SIZE, mercator_unproject
+from .spatial import MAX_LEVEL, DatastoreIndex, grid_cells, morton_cells, morton_keys
+from .track import Track
+from .util import BoundingBox
+
+# Heatmap tiles are binned in 2^6 = 64 bins per axis (4 screen pixels per bin)
+HEAT_BIN_BITS = 6
+# folium HeatMap layers get one weighted point per 2^-3 tile (32 screen pixels)
+HEAT_POINT_BITS = 3
+MAX_HEAT_ZOOM = 22
+
+# Gradient of leaflet.heat: position, RGB
+_GRADIENT = ((0.0, (0, 0, 255)), (0.4, (0, 0, 255)), (0.6, (0, 255, 255)), (0.7, (0, 255, 0)),
+             (0.8, (255, 255, 0)), (1.0, (255, 0, 0)))
+
+
+def _color_table() -> np.ndarray:
+    """256 entry RGBA lookup table of the gradient; opacity grows with the density."""
+    positions = np.linspace(0.0, 1.0, 256)
+    stops = np.array([stop for stop, _ in _GRADIENT])
+    colors = np.array([color for _, color in _GRADIENT], dtype=np.float64)
+    table = np.empty((256, 4), dtype=np.uint8)
+    for channel in range(3):
+        table[:, channel] = np.rint(np.interp(positions, stops, colors[:, channel]))
+    table[:, 3] = np.rint(np.clip(positions * 1.5, 0.0, 0.85) * 255)
+    table[0, 3] = 0
+    return table
+
+
+_COLORS = _color_table()
+
+
+def encode_png(rgba: np.ndarray) -> bytes:
+    """Encode an (height, width, 4) uint8 array as an RGBA PNG image."""
+    height, width, _ = rgba.shape
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    # Every scanline starts with its filter type, 0 (none)
+    raw = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    raw[:, 1:] = rgba.reshape(height, width * 4)
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw.tobytes(), 1))
+            + chunk(b"IEND", b""))
+
+
+def _blur(grid: np.ndarray) -> np.ndarray:
+    """Separable [1 4 6 4 1] / 16 binomial blur (roughly a Gaussian with sigma 1)."""
+    kernel = (1, 4, 6, 4, 1)
+    for axis in (0, 1):
+        padded = np.pad(grid, [(2, 2) if a == axis else (0, 0) for a in (0, 1)])
+        length = grid.shape[axis]
+        grid = sum(weight * np.take(padded, np.arange(i, i + length), axis=axis)
+                   for i, weight in enumerate(kernel)) / 16.0
+    return grid
+
+
+class DensityPyramid:
+    """
+    Point counts of the Web Mercator grid cells of every level up to MAX_LEVEL, stored sparsely as sorted
+    Morton keys (see spatial.morton_keys) with a count each. Any square, aligned block of cells is a single
+    key range, so a heatmap tile is a few binary searches away. New points are merged in without a rebuild,
+    by the first read after they were added.
+    """
+
+    def __init__(self, max_level: int = MAX_LEVEL):
+        self.max_level = max_level
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._size = 0
+            # Latitudes and longitudes of the points added since the last merge
+            self._pending: List[Tuple[np.ndarray, np.ndarray]] = []
+            self._levels: Dict[int, Tuple[np.ndarray, np.ndarray]] = {
+                level: (np.empty(0, np.uint64), np.empty(0, np.int64)) for level in range(self.max_level + 1)
+            }
+            self._max: Dict[int, int] = {level: 0 for level in range(self.max_level + 1)}
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, track: Track) -> None:
+        if len(track) == 0:
+            return
+        with self._lock:
+            self._pending.append((track.latitude, track.longitude))
+            self._size += len(track)
+
+    def _merge_pending(self) -> None:
+        """Merge the buffered points into every level. Call with the lock held."""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        lat, lon = (np.concatenate(columns) for columns in zip(*pending))
+        keys = np.sort(morton_keys(*grid_cells(lat, lon, self.max_level)))
+        for level, (cells, counts) in self._levels.items():
+            new_cells = keys >> np.uint64(2 * (self.max_level - level))
+            first = np.r_[0, np.flatnonzero(np.diff(new_cells)) + 1]
+            new_cells, new_counts = new_cells[first], np.diff(np.r_[first, len(new_cells)])
+            pos = np.searchsorted(cells, new_cells)
+            found = pos < len(cells)
+            found[found] = cells[pos[found]] == new_cells[found]
+            counts = counts.copy()
+            counts[pos[found]] += new_counts[found]
+            cells = np.insert(cells, pos[~found], new_cells[~found])
+            counts = np.insert(counts, pos[~found], new_counts[~found])
+            self._levels[level] = (cells, counts)
+            self._max[level] = int(counts.max())
+
+    def max_count(self, level: int) -> int:
+        """Count of the densest cell of a level, to scale colors the same way on every tile."""
+        with self._lock:
+            self._merge_pending()
+            return self._max[level]
+
+    def block(self, level: int, cx0: int, cy0: int, size: int) -> np.ndarray:
+        """Dense (size, size) counts of the cells [cx0, cx0 + size) x [cy0, cy0 + size); size a power of two."""
+        with self._lock:
+            self._merge_pending()
+            cells, counts = self._levels[level]
+        bits = size.bit_length() - 1
+        prefix = int(morton_keys(np.array([cx0 >> bits]), np.array([cy0 >> bits]))[0])
+        first, last = np.searchsorted(cells, np.array([prefix << 2 * bits, (prefix + 1) << 2 * bits], dtype=np.uint64))
+        grid = np.zeros((size, size))
+        cx, cy = morton_cells(cells[first:last])
+        grid[(cy - np.uint64(cy0)).astype(np.intp), (cx - np.uint64(cx0)).astype(np.intp)] = counts[first:last]
+        return grid
+
+    def cells(self, level: int, bbox: Optional[BoundingBox] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Columns, rows and counts of the non-empty cells of a level, optionally only those inside bbox."""
+        with self._lock:
+            self._merge_pending()
+            cells, counts = self._levels[level]
+        cx, cy = morton_cells(cells)
+        if bbox is not None:
+            (x0, x1), (y1, y0) = grid_cells(np.array([bbox.min_lat, bbox.max_lat]),
+                                            np.array([bbox.min_lon, bbox.max_lon]), level)
+            inside = (cx >= x0) & (cx <= x1) & (cy >= y0) & (cy <= y1)
+            cx, cy, counts = cx[inside], cy[inside], counts[inside]
+        return cx, cy, counts
+
+
+def render_heat_tile(pyramid: DensityPyramid, z: int, x: int, y: int) -> bytes:
+    """
+    Render heatmap tile z/x/y as a TILE_SIZE PNG. The counts of the tile and its eight neighbours are blurred
+    together, so the blur is seamless across tile edges; colors are scaled to the densest cell of the zoom level.
+    """
+    bits = min(HEAT_BIN_BITS, pyramid.max_level - z)
+    level, size, n = z + bits, 2 ** bits, 2 ** z
+    grid = np.zeros((3 * size, 3 * size))
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if 0 <= x + dx < n and 0 <= y + dy < n:
+                block = pyramid.block(level, (x + dx) * size, (y + dy) * size, size)
+                grid[(dy + 1) * size:(dy + 2) * size, (dx + 1) * size:(dx + 2) * size] = block
+    density = _blur(grid)[size:2 * size, size:2 * size]
+    peak = pyramid.max_count(level)
+    if peak == 0 or not density.any():
+        intensity = np.zeros((size, size), dtype=np.uint8)
+    else:
+        intensity = np.rint(np.clip(np.log1p(density) / np.log1p(peak), 0.0, 1.0) * 255).astype(np.uint8)
+        intensity[(density > 0) & (intensity == 0)] = 1
+    scale = TILE_SIZE // size
+    return encode_png(_COLORS[np.repeat(np.repeat(intensity, scale, axis=0), scale, axis=1)])
+
+
+class HeatmapCache:
+    """Density pyramid that follows the datastore, plus an LRU of rendered heatmap tiles"""
+
+    def __init__(self, datastore: Datastore, memory_cache_size: int = 256):
+        self.ds = datastore
+        self.pyramid = DensityPyramid()
+        self.follower = DatastoreIndex(datastore, self.pyramid)
+        self._tiles = LRUCache(memory_cache_size)
+
+    def get_tile(self, z: int, x: int, y: int) -> bytes:
+        """Return heatmap tile z/x/y as PNG. Raises ValueError for tile coordinates outside the grid."""
+        if not (0 <= z <= MAX_HEAT_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            raise ValueError(f"Invalid tile {z}/{x}/{y}")
+        version = self.ds.version
+        self.follower.sync()
+        return self._tiles.get_or_compute((version, z, x, y), lambda: render_heat_tile(self.pyramid, z, x, y))
+
+    def heat_points(self, zoom: int, bbox: Optional[BoundingBox] = None) -> np.ndarray:
+        """
+        (N, 3) array of latitude, longitude and weight (0..1] for a folium HeatMap layer:
+        one point per grid cell of 2^-HEAT_POINT_BITS tiles at the given zoom, weighted by its count.
+        """
+        self.follower.sync()
+        level = min(max(zoom, 0) + HEAT_POINT_BITS, self.pyramid.max_level)
+        cx, cy, counts = self.pyramid.cells(level, bbox)
+        if len(counts) == 0:
+            return np.empty((0, 3))
+        scale = TILE_SIZE / 2 ** level
+        lat, lon = mercator_unproject((cx + 0.5) * scale, (cy + 0.5) * scale)
+        return np.column_stack((lat, lon, counts / self.pyramid.max_count(level)))
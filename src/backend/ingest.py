@@ -0,0 +1,248 @@
+import json
+import logging
+import math
+import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import BinaryIO, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from werkzeug.exceptions import BadRequest
+
+from .datastore import Datastore
+from .metrics import IMPORT_POINTS, IMPORT_SECONDS
+from .track import NO_TIMESTAMP, Track, parse_timestamps
+
+# Bytes read from the body (and decompressed) at a time
+READ_SIZE = 64 * 1024
+DEFAULT_BATCH_SIZE = 10_000
+# Points held in memory per batch; two batches at most, one being parsed and one being committed
+MAX_BATCH_SIZE = 100_000
+# Longer lines are rejected without being buffered
+MAX_LINE_BYTES = 64 * 1024
+# Rejected lines listed in the summary, the rest are only counted
+MAX_ERRORS = 20
+ENCODINGS = ("identity", "gzip", "x-gzip", "deflate")
+
+LATITUDE_KEYS = ("latitude", "lat")
+LONGITUDE_KEYS = ("longitude", "lng", "lon")
+
+log = logging.getLogger(__name__)
+
+
+class IngestSummary(NamedTuple):
+    accepted: int
+    rejected: int
+    batches: int
+    duration: float
+    # False if the body ended early, the client disconnected or the body could not be decompressed; the points
+    # before that are kept
+    complete: bool
+    errors: List[str]
+
+    def as_dict(self) -> dict:
+        return {**self._asdict(), "duration": round(self.duration, 3)}
+
+
+def _read(stream: BinaryIO) -> Iterator[bytes]:
+    chunk = stream.read(READ_SIZE)
+    while chunk:
+        yield chunk
+        chunk = stream.read(READ_SIZE)
+
+
+def _inflate(stream: BinaryIO) -> Iterator[bytes]:
+    # Accept zlib wrapped deflate as well as gzip, either header is detected
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)
+    for chunk in _read(stream):
+        # Bounded output per call, a small body may inflate to gigabytes
+        data = decompressor.decompress(chunk, READ_SIZE)
+        while data:
+            yield data
+            data = decompressor.decompress(decompressor.unconsumed_tail, READ_SIZE)
+        if decompressor.eof:
+            return
+    raise zlib.error("Compressed body ended early")
+
+
+def decompress(stream: BinaryIO, encoding: Optional[str] = None) -> Iterator[bytes]:
+    """
+    The body of stream in chunks of at most READ_SIZE bytes, gunzipped / inflated for Content-Encoding gzip
+    and deflate. Raises ValueError for other encodings; iterating raises zlib.error for corrupt data, and the
+    werkzeug BadRequest (ClientDisconnected) of the stream if the client goes away mid-body.
+    """
+    encoding = (encoding or "identity").strip().lower()
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unsupported Content-Encoding {encoding}, use one of {', '.join(ENCODINGS)}")
+    return _read(stream) if encoding == "identity" else _inflate(stream)
+
+
+def iter_lines(chunks: Iterable[bytes]) -> Iterator[Optional[bytes]]:
+    """Lines of a chunked byte stream. A line longer than MAX_LINE_BYTES is yielded as None and skipped."""
+    pending = b""
+    skipping = False
+    for chunk in chunks:
+        start = 0
+        end = chunk.find(b"\n")
+        while end >= 0:
+            if skipping:
+                skipping = False
+            else:
+                line = pending + chunk[start:end]
+                yield line if len(line) <= MAX_LINE_BYTES else None
+            pending = b""
+            start = end + 1
+            end = chunk.find(b"\n", start)
+        if not skipping:
+            pending += chunk[start:]
+            if len(pending) > MAX_LINE_BYTES:
+                yield None
+                pending = b""
+                skipping = True
+    if pending and not skipping:
+        yield pending
+
+
+def _number(point: dict, keys: Tuple[str, ...]) -> Optional[float]:
+    for key in keys:
+        value = point.get(key)
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise ValueError(f"{key} must be a finite number")
+        return float(value)
+    return None
+
+
+def parse_point(line: bytes) -> Tuple[float, float, float, Optional[str]]:
+    """
+    (latitude, longitude, elevation, timestamp) of one JSON object, as written by /api/points or the editor
+    (lat / lng). Raises ValueError if the line is not a valid point; the timestamp is checked per batch.
+    """
+    point = json.loads(line)
+    if not isinstance(point, dict):
+        raise ValueError("not a JSON object")
+    lat = _number(point, LATITUDE_KEYS)
+    lon = _number(point, LONGITUDE_KEYS)
+    if lat is None or lon is None:
+        raise ValueError("latitude and longitude are required")
+    if not (-90.0 <= lat <= 90.0 and -180.0 <= lon <= 180.0):
+        raise ValueError(f"coordinates {lat}, {lon} out of range")
+    ele = _number(point, ("elevation",))
+    timestamp = point.get("timestamp")
+    if timestamp is not None and not isinstance(timestamp, str):
+        raise ValueError("timestamp must be an ISO 8601 string")
+    return lat, lon, ele if ele is not None else math.nan, timestamp or None
+
+
+class _Batch:
+    def __init__(self):
+        self.rows: List[Tuple[float, float, float, Optional[str]]] = []
+        self.line_numbers: List[int] = []
+
+    def add(self, line_number: int, row: Tuple[float, float, float, Optional[str]]) -> None:
+        self.rows.append(row)
+        self.line_numbers.append(line_number)
+
+    def to_track(self) -> Tuple[Track, List[int], List[int]]:
+        """
+        The valid points of the batch, their line numbers and the line numbers of the points with an unparsable
+        timestamp. The points keep their timestamp strings as given.
+        """
+        lat, lon, ele, timestamps = zip(*self.rows)
+        seconds, raw = parse_timestamps(timestamps)
+        invalid = (seconds == NO_TIMESTAMP) & np.array([ts is not None for ts in timestamps])
+        valid = ~invalid
+        track = Track(np.array(lat)[valid], np.array(lon)[valid], np.array(ele)[valid], seconds[valid],
+                      raw[valid] if raw is not None else None)
+        lines = np.array(self.line_numbers)
+        return track, lines[valid].tolist(), lines[invalid].tolist()
+
+
+def ingest_ndjson(datastore: Datastore, stream: BinaryIO, encoding: Optional[str] = None,
+                  batch_size: int = DEFAULT_BATCH_SIZE) -> IngestSummary:
+    """
+    Insert the points of an NDJSON body (one point object per line) into the datastore while it is read.
+    Lines are validated one by one and inserted in batches of batch_size points: a batch is committed while
+    the next one is parsed, and reading waits for the commit before starting a third, so memory use is bounded
+    by the batch size and a slow database pushes back on the client. Invalid lines and the points of batches
+    that fail to commit are rejected, the rest of the body is still read.
+    Returns once the accepted points are committed. Raises ValueError for an unsupported encoding or batch size.
+    """
+    if not 1 <= batch_size <= MAX_BATCH_SIZE:
+        raise ValueError(f"batch_size must be between 1 and {MAX_BATCH_SIZE}")
+    chunks = decompress(stream, encoding)
+    started = time.perf_counter()
+    accepted = rejected = batches = 0
+    complete = True
+    errors: List[str] = []
+    # The batch being committed and the line numbers of its points
+    pending: Optional[Tuple[Future, List[int]]] = None
+
+    def reject(line_number: int, reason: str) -> None:
+        nonlocal rejected
+        rejected += 1
+        if len(errors) < MAX_ERRORS:
+            errors.append(f"line {line_number}: {reason}")
+
+    def settle() -> None:
+        nonlocal pending, accepted, rejected, batches
+        if pending is None:
+            return
+        future, line_numbers = pending
+        pending = None
+        try:
+            future.result()
+        except Exception as e:
+            log.error(f"Failed to insert lines {line_numbers[0]}-{line_numbers[-1]}", exc_info=True)
+            rejected += len(line_numbers)
+            if len(errors) < MAX_ERRORS:
+                errors.append(f"lines {line_numbers[0]}-{line_numbers[-1]}: insert failed: {e}")
+            return
+        accepted += len(line_numbers)
+        batches += 1
+
+    def insert(batch: _Batch) -> None:
+        nonlocal pending
+        track, line_numbers, invalid_timestamps = batch.to_track()
+        for line_number in invalid_timestamps:
+            reject(line_number, "invalid timestamp")
+        if len(track):
+            settle()
+            pending = committer.submit(datastore.insert_points, track, wait=True), line_numbers
+
+    batch = _Batch()
+    line_number = 0
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest") as committer:
+        try:
+            for line in iter_lines(chunks):
+                line_number += 1
+                if line is None:
+                    reject(line_number, f"longer than {MAX_LINE_BYTES} bytes")
+                    continue
+                if not line.strip():
+                    continue
+                try:
+                    batch.add(line_number, parse_point(line))
+                except ValueError as e:
+                    reject(line_number, str(e))
+                    continue
+                if len(batch.rows) >= batch_size:
+                    insert(batch)
+                    batch = _Batch()
+        except zlib.error as e:
+            complete = False
+            errors.append(f"body: {e}")
+        except BadRequest as e:
+            # ClientDisconnected: the upload stopped before the announced length, keep what was read
+            complete = False
+            errors.append(f"body: {e.description}")
+        if batch.rows:
+            insert(batch)
+        settle()
+
+    elapsed = time.perf_counter() - started
+    IMPORT_POINTS.labels("ndjson").inc(accepted)
+    IMPORT_SECONDS.labels("ndjson").observe(elapsed)
+    log.info(f"Ingested {accepted} points ({rejected} rejected) in {elapsed:.2f}s")
+    return IngestSummary(accepted, rejected, batches, elapsed, complete, errors)
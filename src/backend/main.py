@@ -1,9 +1,11 @@
 from .datastore import Datastore, PostgresBackend, SQLiteBackend
 from .webservice import WebService
 from .map import MapUtil
+from importlib.util import find_spec
 import logging
 import sys
 import signal
+import threading
 
 
 def main():
@@ -14,12 +16,12 @@ def main():
     log = logging.getLogger(__name__)
     log.setLevel(logging.DEBUG)
 
-    # Initialize the data source
-    try:
-        import sqlalchemy
+    # Initialize the data source. The connection is only opened on first use, and find_spec checks that
+    # SQLAlchemy is installed without importing it
+    if find_spec("sqlalchemy") is not None:
         engine_url = "postgresql://localhost/geolocation_db"
         storage = lambda: PostgresBackend(engine_url=engine_url)
-    except ImportError:
+    else:
         log.warning(f"SQLAlchemy not found. Using SQLite fallback instead.")
         path = "geolocations.db"
         storage = lambda: SQLiteBackend(db_path=path)
@@ -29,14 +31,43 @@ def main():
     # Initialize the map service
     map_util = MapUtil()
 
+    # Optional local road graph for routing: --osm <extract.osm>
+    router = None
+    matches = None
+    if "--osm" in sys.argv[:-1]:
+        from .mapmatch import MatchStore
+        from .routing import Router
+        router = Router.from_file(sys.argv[sys.argv.index("--osm") + 1])
+        # Map-matched tracks for view=matched, persisted across restarts
+        matches = MatchStore(router.graph, cache_dir="match_cache")
+
+    # Optional profiling of slow requests: --profile <directory>, not with --async
+    profiler = None
+    if "--profile" in sys.argv[:-1]:
+        from .metrics import RequestProfiler
+        profiler = RequestProfiler(sys.argv[sys.argv.index("--profile") + 1], threshold=1.0)
+
     # Initialize the web service
     webservice = WebService(
         datastore=datastore,
-        map_util=map_util
+        map_util=map_util,
+        tile_cache_dir="tile_cache",
+        router=router,
+        matches=matches,
+        profiler=profiler
     )
 
-    # Start the web service
-    webservice.run(host="127.0.0.1")
+    # --warmup renders the default map in the background, so the first visitor gets it from the cache
+    if "--warmup" in sys.argv:
+        threading.Thread(target=webservice.warmup, name="warmup", daemon=True).start()
+
+    # Start the web service, --async serves it as an ASGI app (needs uvicorn)
+    if "--async" in sys.argv:
+        from .asgi import AsyncWebService
+        # Up to 32 streamed downloads (/api/points, exports) produce chunks at once, more wait for a thread
+        AsyncWebService(webservice, stream_workers=32).run(host="127.0.0.1")
+    else:
+        webservice.run(host="127.0.0.1")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,30 +1,76 @@
-import folium
-from folium.plugins import PolyLineTextPath
-from typing import Sequence, Any, Optional
+import json
+import numpy as np
+from pathlib import Path
+from typing import TYPE_CHECKING, Sequence, Any, Optional, Hashable
+from .cache import LRUCache
+from .geometry import simplify_track
+from .spatial import Clusters
+from .track import Track, to_iso_strings
+
+# folium is imported by the map builders on first use, it is slow to import and most requests hit a cache
+if TYPE_CHECKING:
+    import folium
+
+DEFAULT_ZOOM = 13
+# Client of the /events stream, shared with the page templates
+LIVE_POINTS_JS = Path(__file__).resolve().parent / "templates" / "live_points.js"
 
 class MapUtil:
     """Interface to map utilities"""
-    def __init__(self):
-        pass
+    def __init__(self, tolerance_px: float = 1.0, cache_size: int = 32):
+        self.tolerance_px = tolerance_px
+        self._simplified = LRUCache(cache_size)
+
+    @staticmethod
+    def coordinates(gps_data: Sequence[Any]) -> np.ndarray:
+        """Return an (N, 2) array of latitude/longitude pairs for a Track, tuple rows or GeoPoint objects."""
+        if isinstance(gps_data, Track):
+            return np.column_stack((gps_data.latitude, gps_data.longitude))
+        if not gps_data:
+            return np.empty((0, 2))
+        if hasattr(gps_data[0], "latitude"):
+            return np.array([(p.latitude, p.longitude) for p in gps_data], dtype=np.float64)
+        return np.array([(p[0], p[1]) for p in gps_data], dtype=np.float64)
+
+    def simplify(self, gps_data: Sequence[Any], zoom: int = DEFAULT_ZOOM, tolerance_px: Optional[float] = None,
+                 cache_key: Optional[Hashable] = None) -> Sequence[Any]:
+        """
+        Drop points that are not visible at the given zoom level (Douglas-Peucker in screen pixels).
+        Results are cached per (cache_key, zoom, tolerance); pass the dataset version and query
+        window as cache_key so a write to the datastore never serves a stale track.
+        """
+        tolerance = self.tolerance_px if tolerance_px is None else tolerance_px
+        if len(gps_data) < 3 or tolerance <= 0:
+            return gps_data
+
+        def compute():
+            coords = self.coordinates(gps_data)
+            keep = simplify_track(coords[:, 0], coords[:, 1], zoom, tolerance)
+            if isinstance(gps_data, Track):
+                return gps_data[keep]
+            return [gps_data[i] for i in keep]
+
+        if cache_key is None:
+            return compute()
+        return self._simplified.get_or_compute((cache_key, zoom, tolerance), compute)
 
     @staticmethod
-    def create_folium_map(gps_data: Sequence[Any]) -> Optional[folium.Map]:
+    def create_folium_map(gps_data: Sequence[Any], zoom_start: int = DEFAULT_ZOOM,
+                          live_url: Optional[str] = None) -> Optional['folium.Map']:
         """
         Create a Folium map with GPS data displayed as lines.
         Hovering over the line shows the timestamp and shortened coordinates.
+        With live_url (an /events URL) points inserted later are appended to the line as they arrive.
         """
-        if not gps_data:
+        if len(gps_data) == 0:
             return None
+        import folium
+        from folium.plugins import PolyLineTextPath
 
-        # Support both tuple rows and GeoPoint objects
-        first = gps_data[0]
-        if hasattr(first, "latitude"):
-            map_center = [first.latitude, first.longitude]
-            coordinates = [(p.latitude, p.longitude) for p in gps_data]
-        else:
-            map_center = [first[0], first[1]]
-            coordinates = [(p[0], p[1]) for p in gps_data]
-        folium_map = folium.Map(location=map_center, zoom_start=13, tiles="OpenStreetMap")
+        # Support Tracks, tuple rows and GeoPoint objects
+        coordinates = MapUtil.coordinates(gps_data).tolist()
+        map_center = coordinates[0]
+        folium_map = folium.Map(location=map_center, zoom_start=zoom_start, tiles="OpenStreetMap")
 
         # Create a PolyLine
         line = folium.PolyLine(
@@ -47,4 +93,59 @@ class MapUtil:
             attributes={"fill": "blue", "font-size": "12"}
         ).add_to(folium_map)
 
+        if live_url:
+            # Events are handled after the page script has run, so the line is defined by then
+            append = f"points => points.forEach(p => {line.get_name()}.addLatLng(p))"
+            script = f"{LIVE_POINTS_JS.read_text()}\nfollowPoints({json.dumps(live_url)}, {append});\n"
+            folium_map.get_root().script.add_child(folium.Element(script))
+
+        return folium_map
+
+    @staticmethod
+    def create_cluster_map(clusters: Clusters, zoom_start: int = DEFAULT_ZOOM) -> Optional['folium.Map']:
+        """
+        Create a Folium map showing point clusters (see SpatialIndex.clusters) as circle markers sized by
+        their point count.
+        """
+        if len(clusters) == 0:
+            return None
+        import folium
+
+        # Center on the densest cluster
+        densest = int(np.argmax(clusters.count))
+        folium_map = folium.Map(location=[float(clusters.latitude[densest]), float(clusters.longitude[densest])],
+                                zoom_start=zoom_start, tiles="OpenStreetMap")
+
+        starts = to_iso_strings(clusters.start).tolist()
+        ends = to_iso_strings(clusters.end).tolist()
+        radii = (4 + 3 * np.log10(clusters.count)).tolist()
+        for lat, lon, count, radius, start, end in zip(clusters.latitude.tolist(), clusters.longitude.tolist(),
+                                                         clusters.count.tolist(), radii, starts, ends):
+            tooltip = f"{count} points" + (f"<br>{start} – {end}" if start else "")
+            folium.CircleMarker(
+                location=[lat, lon],
+                radius=radius,
+                color="blue",
+                fill=True,
+                fill_opacity=0.6,
+                tooltip=tooltip
+            ).add_to(folium_map)
+
+        return folium_map
+
+    @staticmethod
+    def create_heat_map(heat_points: np.ndarray, zoom_start: int = DEFAULT_ZOOM) -> Optional['folium.Map']:
+        """
+        Create a Folium map with a HeatMap layer of (latitude, longitude, weight) rows,
+        e.g. the pre-aggregated cells of HeatmapCache.heat_points.
+        """
+        if len(heat_points) == 0:
+            return None
+        import folium
+        from folium.plugins import HeatMap
+
+        densest = heat_points[int(np.argmax(heat_points[:, 2]))]
+        folium_map = folium.Map(location=[float(densest[0]), float(densest[1])], zoom_start=zoom_start,
+                                tiles="OpenStreetMap")
+        HeatMap(heat_points.tolist(), radius=25, max_zoom=zoom_start).add_to(folium_map)
         return folium_map
@@ -0,0 +1,385 @@
+import hashlib
+import heapq
+import logging
+import math
+import os
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .analytics import EARTH_RADIUS_M, haversine
+from .routing import RoadGraph
+from .spatial import SpatialIndex
+from .track import NO_TIMESTAMP, Track
+from .util import BoundingBox
+
+# Standard deviation of the GPS position error in meters
+SIGMA_Z = 10.0
+# Scale in meters of the difference between route and straight line distance of two fixes
+BETA = 20.0
+# Roads farther away than this from a fix are no candidates
+SEARCH_RADIUS = 50.0
+MAX_CANDIDATES = 5
+# Edges are indexed by points at most this far apart
+EDGE_SAMPLE_METERS = 25.0
+# Points per independently matched chunk
+CHUNK_POINTS = 1000
+# Fixes of the neighbouring chunks matched along as context, so that both sides agree at the boundary
+CHUNK_OVERLAP = 50
+# Points per candidate lookup
+CANDIDATE_BATCH = 64
+# Total size of the persisted matches, the least recently used are deleted beyond it
+MAX_STORE_BYTES = 256 * 1024 * 1024
+
+# Graph of a worker process, set by _init_worker, and its matchers per (mode, sigma_z, beta, radius)
+_worker_graph = None
+_worker_matchers: Dict[tuple, 'MapMatcher'] = {}
+
+
+class EdgeIndex:
+    """Spatial index over the edges of a mode's graph, via sample points along every edge"""
+
+    def __init__(self, graph: RoadGraph, mode: str):
+        csr = graph.graphs[mode]
+        self.src = np.repeat(np.arange(len(graph), dtype=np.int64), np.diff(csr.indptr))
+        self.dst = csr.indices
+        self.meters = csr.meters
+        self.lat0, self.lon0 = graph.latitude[self.src], graph.longitude[self.src]
+        self.lat1, self.lon1 = graph.latitude[self.dst], graph.longitude[self.dst]
+        samples = np.maximum(np.ceil(self.meters / EDGE_SAMPLE_METERS), 1).astype(np.int64)
+        self.sample_edge = np.repeat(np.arange(len(self.src)), samples)
+        within = np.arange(len(self.sample_edge)) - np.repeat(np.cumsum(samples) - samples, samples)
+        fraction = (within + 0.5) / samples[self.sample_edge]
+        edge = self.sample_edge
+        self.index = SpatialIndex()
+        self.index.add(Track(self.lat0[edge] + fraction * (self.lat1[edge] - self.lat0[edge]),
+                             self.lon0[edge] + fraction * (self.lon1[edge] - self.lon0[edge])))
+
+    def candidates(self, lat: np.ndarray, lon: np.ndarray, radius: float = SEARCH_RADIUS,
+                   limit: int = MAX_CANDIDATES) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        The closest edges within radius of every point: edge ids, position along the edge (0..1) and distance.
+        Consecutive track points are close together, so every CANDIDATE_BATCH points share one index lookup.
+        """
+        result = []
+        for first in range(0, len(lat), CANDIDATE_BATCH):
+            result.extend(self._batch_candidates(lat[first:first + CANDIDATE_BATCH],
+                                                 lon[first:first + CANDIDATE_BATCH], radius, limit))
+        return result
+
+    def _batch_candidates(self, lat: np.ndarray, lon: np.ndarray, radius: float,
+                          limit: int) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        reach = radius + EDGE_SAMPLE_METERS
+        dlat = math.degrees(reach / EARTH_RADIUS_M)
+        dlon = dlat / max(math.cos(math.radians(float(np.abs(lat).max()))), 1e-6)
+        bbox = BoundingBox(max(float(lat.min()) - dlat, -90.0), max(float(lon.min()) - dlon, -180.0),
+                           min(float(lat.max()) + dlat, 90.0), min(float(lon.max()) + dlon, 180.0))
+        edges = np.unique(self.sample_edge[self.index.query(bbox)])
+        # Project the points onto the edges in local equirectangular planes, in meters: (points, edges) arrays
+        scale = math.radians(1) * EARTH_RADIUS_M
+        cos_lat = np.cos(np.radians(lat))[:, None]
+        ax = (self.lon0[edges] - lon[:, None]) * cos_lat * scale
+        ay = (self.lat0[edges] - lat[:, None]) * scale
+        dx = (self.lon1[edges] - self.lon0[edges]) * cos_lat * scale
+        dy = np.broadcast_to((self.lat1[edges] - self.lat0[edges]) * scale, dx.shape)
+        length_sq = dx * dx + dy * dy
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = np.clip(np.where(length_sq > 0, -(ax * dx + ay * dy) / length_sq, 0.0), 0.0, 1.0)
+        distance = np.hypot(ax + t * dx, ay + t * dy)
+        result = []
+        for i in range(len(lat)):
+            keep = np.flatnonzero(distance[i] <= radius)
+            keep = keep[np.argsort(distance[i, keep], kind="stable")[:limit]]
+            result.append((edges[keep], t[i, keep], distance[i, keep]))
+        return result
+
+    def position(self, edges: np.ndarray, t: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        return (self.lat0[edges] + t * (self.lat1[edges] - self.lat0[edges]),
+                self.lon0[edges] + t * (self.lon1[edges] - self.lon0[edges]))
+
+
+def _shortest_distances(indptr: list, indices: list, meters: list, source: int, targets: set,
+                        limit: float) -> Tuple[Dict[int, float], Dict[int, int]]:
+    """Dijkstra on edge lengths from source until all targets are settled or distances exceed limit."""
+    distance = {source: 0.0}
+    previous: Dict[int, int] = {}
+    heap = [(0.0, source)]
+    remaining = set(targets)
+    done = set()
+    while heap and remaining:
+        cost, node = heapq.heappop(heap)
+        if node in done:
+            continue
+        done.add(node)
+        remaining.discard(node)
+        if cost > limit:
+            break
+        for edge in range(indptr[node], indptr[node + 1]):
+            neighbour = indices[edge]
+            new_cost = cost + meters[edge]
+            if new_cost < distance.get(neighbour, math.inf):
+                distance[neighbour] = new_cost
+                previous[neighbour] = node
+                heapq.heappush(heap, (new_cost, neighbour))
+    return distance, previous
+
+
+class MapMatcher:
+    """
+    Snaps GPS tracks onto the road graph of a mode with a hidden Markov model (Newson & Krumm):
+    candidates are the roads near every fix, emissions favour close roads, transitions favour road routes as long
+    as the straight line between the fixes, and Viterbi picks the most likely sequence.
+    """
+
+    def __init__(self, graph: RoadGraph, mode: str = "car", sigma_z: float = SIGMA_Z, beta: float = BETA,
+                 radius: float = SEARCH_RADIUS):
+        self.graph = graph
+        self.mode = mode
+        self.sigma_z = sigma_z
+        self.beta = beta
+        self.radius = radius
+        self.log = logging.getLogger(__name__)
+        self._edges: Optional[EdgeIndex] = None
+        self._lock = threading.Lock()
+
+    @property
+    def edges(self) -> EdgeIndex:
+        with self._lock:
+            if self._edges is None:
+                self._edges = EdgeIndex(self.graph, self.mode)
+            return self._edges
+
+    def match(self, track: Track, workers: int = 1, pool: Optional[ProcessPoolExecutor] = None) -> Track:
+        """
+        Matched geometry of a time ordered track: the snapped fixes (with their timestamps and elevations)
+        joined by the road nodes in between. Fixes without a nearby road are dropped. Chunks of CHUNK_POINTS
+        fixes are matched independently, with CHUNK_OVERLAP fixes of the neighbouring chunks as context, in
+        worker processes if workers > 1 or a pool made by worker_pool for this graph is given.
+        """
+        chunks, firsts, lasts = [], [], []
+        for first in range(0, len(track), CHUNK_POINTS):
+            start = max(first - CHUNK_OVERLAP, 0)
+            last = min(first + CHUNK_POINTS, len(track))
+            chunks.append(track[start:min(last + CHUNK_OVERLAP, len(track))])
+            firsts.append(first - start)
+            lasts.append(last - start)
+        if len(chunks) > 1 and (pool is not None or workers > 1):
+            settings = [(self.mode, self.sigma_z, self.beta, self.radius)] * len(chunks)
+            if pool is not None:
+                parts = list(pool.map(_match_chunk, settings, chunks, firsts, lasts))
+            else:
+                with worker_pool(self.graph, workers) as pool:
+                    parts = list(pool.map(_match_chunk, settings, chunks, firsts, lasts))
+        else:
+            parts = [self.match_chunk(*args) for args in zip(chunks, firsts, lasts)]
+        matched = Track()
+        for part in parts:
+            matched.append(part)
+        self.log.debug(f"Matched {len(track)} points in {len(chunks)} chunks to {len(matched)} points")
+        return matched
+
+    def match_chunk(self, track: Track, first: int = 0, last: Optional[int] = None) -> Track:
+        """
+        Matched geometry of the fixes first ... last - 1 of track and of the route from the fix before them,
+        the other fixes are only context.
+        """
+        edges = self.edges
+        indptr, indices, _, meters, node_lat, node_lon, _ = self.graph.as_lists(self.mode)
+        # Per step: fix index, candidate edges, positions, scores, back pointers, shortest path trees
+        steps: List[tuple] = []
+        lat, lon = track.latitude.tolist(), track.longitude.tolist()
+        for i, (cand, t, distance) in enumerate(edges.candidates(track.latitude, track.longitude, self.radius)):
+            if len(cand) == 0:
+                continue
+            emission = -0.5 * (distance / self.sigma_z) ** 2
+            if not steps:
+                steps.append((i, cand, t, emission, None, None))
+                continue
+            j, prev_cand, prev_t, prev_score, _, _ = steps[-1]
+            straight = float(haversine(lat[j], lon[j], lat[i], lon[i]))
+            limit = 2 * straight + 4 * self.radius + 50
+            route = np.full((len(prev_cand), len(cand)), np.inf)
+            trees = []
+            targets = set(edges.src[cand].tolist())
+            for a, (edge, offset) in enumerate(zip(prev_cand.tolist(), prev_t.tolist())):
+                tree = _shortest_distances(indptr, indices, meters, int(edges.dst[edge]), targets, limit)
+                trees.append(tree)
+                rest = (1 - offset) * edges.meters[edge]
+                reached = np.array([tree[0].get(int(node), np.inf) for node in edges.src[cand]])
+                route[a] = rest + reached + t * edges.meters[cand]
+                same = (cand == edge) & (t >= offset)
+                route[a, same] = (t[same] - offset) * edges.meters[edge]
+            total = prev_score[:, None] - np.abs(route - straight) / self.beta
+            back = np.argmax(total, axis=0)
+            score = total[back, np.arange(len(cand))] + emission
+            if not np.isfinite(score).any():
+                # No candidate is reachable: start a new chain here
+                steps.append((i, cand, t, emission, None, None))
+            else:
+                steps.append((i, cand, t, score, back, trees))
+        return self._geometry(track, steps, node_lat, node_lon, first, len(track) if last is None else last)
+
+    def _geometry(self, track: Track, steps: List[tuple], node_lat: list, node_lon: list, first: int,
+                  last: int) -> Track:
+        """
+        Backtrack the Viterbi path and join the snapped fixes first ... last - 1 with the road nodes between them
+        and the fix before them.
+        """
+        if not steps:
+            return Track()
+        edges = self.edges
+        chosen = [0] * len(steps)
+        chosen[-1] = int(np.argmax(steps[-1][3]))
+        for k in range(len(steps) - 1, 0, -1):
+            back = steps[k][4]
+            chosen[k - 1] = int(back[chosen[k]]) if back is not None else int(np.argmax(steps[k - 1][3]))
+
+        lat, lon, ele, ts = [], [], [], []
+        for k, (i, cand, t, _, back, trees) in enumerate(steps):
+            if not first <= i < last:
+                continue
+            edge, offset = int(cand[chosen[k]]), float(t[chosen[k]])
+            if k > 0 and back is not None:
+                prev_edge, prev_offset = int(steps[k - 1][1][chosen[k - 1]]), float(steps[k - 1][2][chosen[k - 1]])
+                if not (edge == prev_edge and offset >= prev_offset):
+                    _, previous = trees[chosen[k - 1]]
+                    node, start = int(edges.src[edge]), int(edges.dst[prev_edge])
+                    path = [node]
+                    while node != start:
+                        node = previous[node]
+                        path.append(node)
+                    for node in reversed(path):
+                        lat.append(node_lat[node])
+                        lon.append(node_lon[node])
+                        ele.append(np.nan)
+                        ts.append(NO_TIMESTAMP)
+            point_lat, point_lon = edges.position(np.array([edge]), np.array([offset]))
+            lat.append(float(point_lat[0]))
+            lon.append(float(point_lon[0]))
+            ele.append(track.elevation[i])
+            ts.append(track.timestamp[i])
+        return Track(np.array(lat), np.array(lon), np.array(ele), np.array(ts, dtype=np.int64))
+
+
+def worker_pool(graph: RoadGraph, workers: int) -> ProcessPoolExecutor:
+    """Processes for MapMatcher.match; the graph is sent to each of them once, when it starts."""
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(graph,))
+
+
+def _init_worker(graph: RoadGraph) -> None:
+    global _worker_graph
+    _worker_graph = graph
+    _worker_matchers.clear()
+
+
+def _match_chunk(settings: tuple, track: Track, first: int, last: int) -> Track:
+    matcher = _worker_matchers.get(settings)
+    if matcher is None:
+        matcher = _worker_matchers[settings] = MapMatcher(_worker_graph, *settings)
+    return matcher.match_chunk(track, first, last)
+
+
+class MatchStore:
+    """
+    Matched tracks persisted as .npz files named after a hash of the input points, the mode, the matcher
+    settings and the road graph, so a track is only matched once, across restarts too. Beyond max_bytes the
+    least recently used files are deleted. Matching runs in a pool of worker processes that lives as long as
+    the store, so the graph is sent to every worker once.
+    """
+
+    def __init__(self, graph: RoadGraph, cache_dir: str, workers: Optional[int] = None,
+                 max_bytes: int = MAX_STORE_BYTES):
+        self.graph = graph
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.workers = workers or os.cpu_count() or 1
+        self.max_bytes = max_bytes
+        self._matchers: Dict[str, MapMatcher] = {}
+        self._graph_digest: Optional[bytes] = None
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def matcher(self, mode: str) -> MapMatcher:
+        with self._lock:
+            if mode not in self._matchers:
+                self._matchers[mode] = MapMatcher(self.graph, mode)
+            return self._matchers[mode]
+
+    def pool(self) -> Optional[ProcessPoolExecutor]:
+        """The worker processes, started on first use; None with a single worker."""
+        with self._lock:
+            if self._pool is None and self.workers > 1:
+                self._pool = worker_pool(self.graph, self.workers)
+            return self._pool
+
+    def graph_digest(self) -> bytes:
+        """Hash of the graph's coordinates and edges, computed once."""
+        with self._lock:
+            if self._graph_digest is None:
+                digest = hashlib.sha1()
+                for array in (self.graph.latitude, self.graph.longitude):
+                    digest.update(np.ascontiguousarray(array).tobytes())
+                for mode in sorted(self.graph.graphs):
+                    digest.update(mode.encode())
+                    for array in self.graph.graphs[mode]:
+                        digest.update(np.ascontiguousarray(array).tobytes())
+                self._graph_digest = digest.digest()
+            return self._graph_digest
+
+    def key(self, track: Track, mode: str) -> str:
+        matcher = self.matcher(mode)
+        digest = hashlib.sha1(f"{mode}:{matcher.sigma_z}:{matcher.beta}:{matcher.radius}:".encode())
+        digest.update(self.graph_digest())
+        for column in (track.latitude, track.longitude, track.timestamp):
+            digest.update(np.ascontiguousarray(column).tobytes())
+        return digest.hexdigest()
+
+    def get_or_match(self, track: Track, mode: str = "car") -> Track:
+        """The matched geometry of a track, from disk if it was matched before."""
+        path = self.cache_dir / f"{self.key(track, mode)}.npz"
+        try:
+            with np.load(path) as data:
+                matched = Track(data["latitude"], data["longitude"], data["elevation"], data["timestamp"])
+            # The modification time orders the files for eviction
+            os.utime(path)
+            return matched
+        except FileNotFoundError:
+            pass
+        matched = self.matcher(mode).match(track, pool=self.pool())
+        # Write to a temporary name first, so a concurrent reader never sees a partial file
+        tmp = path.with_name(f"{path.stem}.{uuid.uuid4().hex}.tmp.npz")
+        np.savez(tmp, latitude=matched.latitude, longitude=matched.longitude, elevation=matched.elevation,
+                 timestamp=matched.timestamp)
+        os.replace(tmp, path)
+        self._evict()
+        return matched
+
+    def _evict(self) -> None:
+        """Delete the least recently used files until the store fits into max_bytes."""
+        files = []
+        for path in self.cache_dir.glob("*.npz"):
+            if path.name.endswith(".tmp.npz"):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                # Evicted by another thread
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+    def close(self) -> None:
+        """Stop the worker processes."""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
@@ -0,0 +1,324 @@
+"""
+Description:
+    Process wide metrics (counters, gauges, histograms) of the hot paths, rendered in the Prometheus text
+    exposition format for the /metrics endpoint, and an opt-in profiler that dumps profiles of slow requests.
+
+Dependencies:
+    - pyinstrument, only for RequestProfiler(engine="pyinstrument"):
+        pip install pyinstrument
+
+Docs:
+    - Prometheus text format: https://prometheus.io/docs/instrumenting/exposition_formats/
+    - cProfile: https://docs.python.org/3/library/profile.html
+"""
+import contextlib
+import cProfile
+import logging
+import math
+import os
+import re
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Seconds, from a cache hit to a render of millions of points
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+ROW_BUCKETS = (0, 1, 10, 100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)) + "}"
+
+
+class _CounterValue:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        if amount < 0:
+            raise ValueError("Counters can only increase")
+        with self._lock:
+            self.value += amount
+
+    def samples(self) -> List[Tuple[str, Tuple[str, ...], Tuple[str, ...], float]]:
+        return [("_total", (), (), self.value)]
+
+
+class _GaugeValue:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        with self._lock:
+            self.value = float(value)
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.inc(-amount)
+
+    def samples(self) -> List[Tuple[str, Tuple[str, ...], Tuple[str, ...], float]]:
+        return [("", (), (), self.value)]
+
+
+class _HistogramValue:
+    def __init__(self, buckets: Sequence[float]):
+        self._lock = threading.Lock()
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        # Buckets are few, a linear scan beats bisect's call overhead
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    @contextlib.contextmanager
+    def time(self) -> Iterator[None]:
+        """Observe the duration of the with block in seconds."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def samples(self) -> List[Tuple[str, Tuple[str, ...], Tuple[str, ...], float]]:
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        samples, cumulative = [], 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            samples.append(("_bucket", ("le",), (_format_value(bound),), cumulative))
+        samples.append(("_sum", (), (), total))
+        samples.append(("_count", (), (), cumulative))
+        return samples
+
+
+class Metric:
+    """
+    A named metric with optional labels. metric.labels(*values) returns the child for one label combination;
+    a metric without labels forwards inc/set/observe/time to its only child.
+    """
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), **options):
+        if not re.fullmatch(r"[a-zA-Z_:][a-zA-Z0-9_:]*", name):
+            raise ValueError(f"Invalid metric name {name}")
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._options = options
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        if len(values) != len(self.label_names):
+            raise ValueError(f"{self.name} has the labels {self.label_names}, got {values}")
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def __getattr__(self, attr: str):
+        # inc / set / observe / time of unlabelled metrics
+        if attr.startswith("_") or self.label_names:
+            raise AttributeError(attr)
+        return getattr(self.labels(), attr)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            children = sorted(self._children.items())
+        for values, child in children:
+            for suffix, extra_names, extra_values, value in child.samples():
+                labels = _format_labels(self.label_names + extra_names, values + extra_values)
+                lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    """Monotonically increasing count, e.g. of inserted points. Rendered with a _total suffix."""
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterValue()
+
+
+class Gauge(Metric):
+    """Value that goes up and down, e.g. a queue depth."""
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeValue()
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets, plus their sum and count."""
+    kind = "histogram"
+
+    def _new_child(self):
+        return _HistogramValue(self._options.get("buckets", TIME_BUCKETS))
+
+
+class Registry:
+    """Named metrics of the process. Registering a name again returns the existing metric."""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name: str, documentation: str, labels: Sequence[str], **options) -> Metric:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labels, **options)
+            elif not isinstance(metric, cls) or metric.label_names != tuple(labels):
+                raise ValueError(f"Metric {name} is already registered as a different metric")
+            return metric
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter, name, documentation, labels)
+
+    def gauge(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge, name, documentation, labels)
+
+    def histogram(self, name: str, documentation: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = TIME_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, documentation, labels, buckets=tuple(sorted(buckets)))
+
+    def get(self, name: str) -> Optional[Metric]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        return "".join(line + "\n" for metric in metrics for line in metric.render())
+
+
+REGISTRY = Registry()
+
+DB_WAIT_SECONDS = REGISTRY.histogram(
+    "geolocation_db_wait_seconds", "Time database tasks waited before running: queued on the DB worker (worker) "
+    "or for the pending writes before a concurrent read (read).", ("path",))
+DB_EXEC_SECONDS = REGISTRY.histogram(
+    "geolocation_db_exec_seconds", "Execution time of database tasks on the DB worker (worker) "
+    "or of concurrent reads (read).", ("path",))
+DB_QUEUE_DEPTH = REGISTRY.gauge("geolocation_db_queue_depth", "Tasks waiting for the DB worker.")
+QUERY_ROWS = REGISTRY.histogram(
+    "geolocation_query_rows", "Rows returned by GPS data queries, of the full table (all) or a window (window).",
+    ("query",), buckets=ROW_BUCKETS)
+POINTS_INSERTED = REGISTRY.counter("geolocation_points_inserted", "GPS points queued for insertion.")
+MAP_BUILD_SECONDS = REGISTRY.histogram("geolocation_map_build_seconds", "Time to build the folium map of a view.",
+                                       ("view",))
+MAP_SERIALIZE_SECONDS = REGISTRY.histogram(
+    "geolocation_map_serialize_seconds", "Time to serialize the folium map of a view to HTML (_repr_html_).",
+    ("view",))
+IMPORT_POINTS = REGISTRY.counter("geolocation_import_points", "Points imported from files.", ("format",))
+IMPORT_SECONDS = REGISTRY.histogram("geolocation_import_seconds", "Duration of file imports.", ("format",))
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "geolocation_http_request_seconds", "Time to handle a request, until the response (body) is returned.",
+    ("endpoint",))
+HTTP_REQUESTS = REGISTRY.counter("geolocation_http_requests", "Handled requests by route and status.",
+                                 ("endpoint", "status"))
+
+
+def _pyinstrument():
+    try:
+        import pyinstrument
+    except ImportError:
+        raise RuntimeError("Profiling with pyinstrument needs pyinstrument: pip install pyinstrument")
+    return pyinstrument
+
+
+class RequestProfiler:
+    """
+    Opt-in per request profiling: every request runs under a profiler, and the profiles of requests slower than
+    threshold seconds are written to directory (cProfile .prof files for snakeviz / pstats, or pyinstrument HTML).
+    Only one cProfile profiler can be active per interpreter on Python 3.12+, concurrent requests then go unprofiled.
+    Flask only (WebService hooks): the ASGI app serves all requests from one event loop thread and hands the work
+    to executors, so a per request profile of that thread would mix requests and miss the work.
+    """
+
+    ENGINES = ("cprofile", "pyinstrument")
+
+    def __init__(self, directory: str, threshold: float = 1.0, engine: str = "cprofile"):
+        if engine not in self.ENGINES:
+            raise ValueError(f"engine must be one of {', '.join(self.ENGINES)}")
+        if engine == "pyinstrument":
+            _pyinstrument()
+        self.directory = directory
+        self.threshold = threshold
+        self.engine = engine
+        self.log = logging.getLogger(__name__)
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self) -> Optional[tuple]:
+        """Start profiling the current request. Returns the handle for stop, or None if no profiler could start."""
+        if self.engine == "pyinstrument":
+            profiler = _pyinstrument().Profiler()
+            profiler.start()
+        else:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another request is being profiled
+                return None
+        return profiler, time.perf_counter()
+
+    def stop(self, handle: Optional[tuple], name: str) -> Optional[str]:
+        """Stop profiling; if the request was slow, write its profile and return the path."""
+        if handle is None:
+            return None
+        profiler, started = handle
+        if self.engine == "pyinstrument":
+            profiler.stop()
+        else:
+            profiler.disable()
+        elapsed = time.perf_counter() - started
+        if elapsed < self.threshold:
+            return None
+        slug = re.sub(r"[^a-zA-Z0-9]+", "_", name).strip("_") or "root"
+        path = os.path.join(self.directory, f"{time.strftime('%Y%m%dT%H%M%S')}-{int(elapsed * 1000)}ms-{slug}")
+        if self.engine == "pyinstrument":
+            path += ".html"
+            with open(path, "w") as f:
+                f.write(profiler.output_html())
+        else:
+            path += ".prof"
+            profiler.dump_stats(path)
+        self.log.info(f"Slow request {name} took {elapsed:.3f}s, profile written to {path}")
+        return path
@@ -0,0 +1,368 @@
+"""
+Description:
+    Local routing for the Geolocation project, no routing service needed.
+    Roads are read from an OpenStreetMap XML extract (.osm) into one compact CSR (compressed sparse row) graph
+    per transport mode. Routes are A* searches on travel time; legs between consecutive GPS points are batched
+    and memoized in an LRU cache.
+
+Dependencies:
+    - NumPy
+
+Docs:
+    OSM XML: https://wiki.openstreetmap.org/wiki/OSM_XML
+    Road types: https://wiki.openstreetmap.org/wiki/Key:highway
+"""
+import heapq
+import logging
+import math
+import os
+import threading
+import xml.etree.ElementTree as ET
+from array import array
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .analytics import EARTH_RADIUS_M, haversine
+from .cache import LRUCache
+from .spatial import SpatialIndex
+from .track import Track
+from .util import BoundingBox
+
+MODES = ("car", "bicycle", "foot")
+
+# Default speeds in km/h per highway type and mode, road types missing for a mode are not usable by it
+SPEEDS = {
+    "car": {
+        "motorway": 110, "motorway_link": 60, "trunk": 90, "trunk_link": 50, "primary": 70, "primary_link": 40,
+        "secondary": 60, "secondary_link": 40, "tertiary": 50, "tertiary_link": 30, "unclassified": 40,
+        "residential": 30, "living_street": 10, "service": 15, "road": 30,
+    },
+    "bicycle": {
+        "trunk": 16, "trunk_link": 16, "primary": 16, "primary_link": 16, "secondary": 16, "secondary_link": 16,
+        "tertiary": 16, "tertiary_link": 16, "unclassified": 16, "residential": 16, "living_street": 12,
+        "service": 14, "road": 16, "cycleway": 18, "track": 12, "path": 12, "bridleway": 8,
+    },
+    "foot": {
+        "primary": 5, "primary_link": 5, "secondary": 5, "secondary_link": 5, "tertiary": 5, "tertiary_link": 5,
+        "unclassified": 5, "residential": 5, "living_street": 5, "service": 5, "road": 5, "pedestrian": 5,
+        "footway": 5, "path": 5, "track": 5, "steps": 3, "cycleway": 5, "bridleway": 5,
+    },
+}
+# Access tags checked per mode, the first one present decides
+ACCESS_TAGS = {"car": ("motorcar", "motor_vehicle", "vehicle", "access"),
+               "bicycle": ("bicycle", "vehicle", "access"),
+               "foot": ("foot", "access")}
+NO_ACCESS = {"no", "private"}
+# Snapping a point to the road network looks this far at most
+MAX_SNAP_METERS = 2000.0
+# Points routed per request at most, every one is snapped to the graph separately
+MAX_ROUTE_WAYPOINTS = 10_000
+
+
+class CSRGraph(NamedTuple):
+    """Directed graph: the edges leaving node u are indptr[u] ... indptr[u + 1] - 1."""
+    indptr: np.ndarray
+    indices: np.ndarray
+    seconds: np.ndarray
+    meters: np.ndarray
+
+    @classmethod
+    def from_edges(cls, n: int, src: np.ndarray, dst: np.ndarray, seconds: np.ndarray,
+                   meters: np.ndarray) -> 'CSRGraph':
+        order = np.argsort(src, kind="stable")
+        indptr = np.r_[0, np.cumsum(np.bincount(src, minlength=n))].astype(np.int64)
+        return cls(indptr, dst[order].astype(np.int64), seconds[order], meters[order])
+
+
+class Route(NamedTuple):
+    latitude: np.ndarray
+    longitude: np.ndarray
+    meters: float
+    seconds: float
+    legs: int
+    # Legs without a connection in the graph, drawn as straight lines
+    unroutable: int
+
+    def as_dict(self) -> dict:
+        return {
+            "distance_m": self.meters,
+            "duration_s": self.seconds,
+            "legs": self.legs,
+            "unroutable": self.unroutable,
+            "coordinates": np.column_stack((self.longitude, self.latitude)).tolist(),
+        }
+
+
+def _speed(tags: Dict[str, str], mode: str) -> Optional[float]:
+    """Speed in km/h of a way for a mode, None if the mode can't use it."""
+    speed = SPEEDS[mode].get(tags.get("highway"))
+    if speed is None:
+        return None
+    for tag in ACCESS_TAGS[mode]:
+        if tag in tags:
+            if tags[tag] in NO_ACCESS:
+                return None
+            break
+    if mode == "car" and tags.get("maxspeed", "").isdigit():
+        speed = min(speed * 1.5, float(tags["maxspeed"]))
+    return speed
+
+
+def _direction(tags: Dict[str, str], mode: str) -> int:
+    """1 for a oneway along the node order, -1 against it, 0 for both directions."""
+    if mode == "foot":
+        return 0
+    oneway = tags.get(f"oneway:{mode}", tags.get("oneway", ""))
+    if tags.get("junction") == "roundabout" and not oneway:
+        oneway = "yes"
+    if oneway in ("yes", "true", "1"):
+        return 1
+    return -1 if oneway == "-1" else 0
+
+
+class RoadGraph:
+    """Road network of an OSM extract: node coordinates plus a CSRGraph per mode"""
+
+    def __init__(self, latitude: np.ndarray, longitude: np.ndarray, graphs: Dict[str, CSRGraph]):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.graphs = graphs
+        self._indexes: Dict[str, Tuple[SpatialIndex, np.ndarray]] = {}
+        self._lists: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_osm(cls, path: str) -> 'RoadGraph':
+        """Parse the highways of an OSM XML file. The file is streamed, elements are dropped once read."""
+        node_ids, lats, lons = array("q"), array("d"), array("d")
+        edges = {mode: (array("q"), array("q"), array("d")) for mode in MODES}
+        root = None
+        for event, elem in ET.iterparse(path, events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = elem
+                continue
+            if elem.tag == "node":
+                node_ids.append(int(elem.get("id")))
+                lats.append(float(elem.get("lat")))
+                lons.append(float(elem.get("lon")))
+            elif elem.tag == "way":
+                tags = {tag.get("k"): tag.get("v") for tag in elem.iter("tag")}
+                if "highway" in tags:
+                    refs = [int(nd.get("ref")) for nd in elem.iter("nd")]
+                    for mode in MODES:
+                        speed = _speed(tags, mode)
+                        if speed is None or len(refs) < 2:
+                            continue
+                        direction = _direction(tags, mode)
+                        src, dst, kmh = edges[mode]
+                        pairs = list(zip(refs[:-1], refs[1:]))
+                        if direction >= 0:
+                            for u, v in pairs:
+                                src.append(u)
+                                dst.append(v)
+                        if direction <= 0:
+                            for u, v in pairs:
+                                src.append(v)
+                                dst.append(u)
+                        kmh.extend([speed] * (len(pairs) * (2 if direction == 0 else 1)))
+            if elem in root:
+                # Top level elements are done, keep the tree from growing
+                root.remove(elem)
+        return cls._build(np.frombuffer(node_ids, dtype=np.int64), np.frombuffer(lats), np.frombuffer(lons), edges)
+
+    @classmethod
+    def _build(cls, node_ids: np.ndarray, lats: np.ndarray, lons: np.ndarray, edges: dict) -> 'RoadGraph':
+        """Renumber the nodes used by any road to 0 ... n - 1 and build the CSR graphs."""
+        used = np.unique(np.concatenate([np.frombuffer(edges[m][0], dtype=np.int64) for m in MODES]
+                                        + [np.frombuffer(edges[m][1], dtype=np.int64) for m in MODES]))
+        if len(used) == 0:
+            raise ValueError("The OSM file contains no roads")
+        order = np.argsort(node_ids)
+        pos = np.searchsorted(node_ids, used, sorter=order)
+        missing = (pos >= len(node_ids)) | (node_ids[order[np.minimum(pos, len(node_ids) - 1)]] != used)
+        if missing.any():
+            raise ValueError(f"OSM file references {int(missing.sum())} nodes it doesn't contain")
+        coords = order[pos]
+        lat, lon = lats[coords].copy(), lons[coords].copy()
+        graphs = {}
+        for mode in MODES:
+            src = np.searchsorted(used, np.frombuffer(edges[mode][0], dtype=np.int64))
+            dst = np.searchsorted(used, np.frombuffer(edges[mode][1], dtype=np.int64))
+            meters = haversine(lat[src], lon[src], lat[dst], lon[dst])
+            seconds = meters / (np.frombuffer(edges[mode][2]) / 3.6)
+            graphs[mode] = CSRGraph.from_edges(len(used), src, dst, seconds, meters)
+        return cls(lat, lon, graphs)
+
+    def save(self, path: str) -> None:
+        """Store the graph as a .npz file, which loads much faster than the OSM XML."""
+        arrays = {"latitude": self.latitude, "longitude": self.longitude}
+        for mode, graph in self.graphs.items():
+            arrays.update({f"{mode}_{field}": value for field, value in graph._asdict().items()})
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path: str) -> 'RoadGraph':
+        """Load a graph from .npz (see save) or parse an OSM file, caching the parsed graph next to it."""
+        if path.endswith(".npz"):
+            with np.load(path) as data:
+                graphs = {mode: CSRGraph(*(data[f"{mode}_{field}"] for field in CSRGraph._fields)) for mode in MODES}
+                return cls(data["latitude"], data["longitude"], graphs)
+        cached = f"{path}.npz"
+        if os.path.exists(cached) and os.path.getmtime(cached) >= os.path.getmtime(path):
+            return cls.load(cached)
+        graph = cls.from_osm(path)
+        graph.save(cached)
+        return graph
+
+    def __len__(self) -> int:
+        return len(self.latitude)
+
+    def __getstate__(self) -> dict:
+        # Indexes and list copies are rebuilt on demand, e.g. in worker processes
+        return {"latitude": self.latitude, "longitude": self.longitude, "graphs": self.graphs}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state["latitude"], state["longitude"], state["graphs"])
+
+    def _index(self, mode: str) -> Tuple[SpatialIndex, np.ndarray]:
+        """Spatial index over the nodes the mode can leave from, and those nodes (index id -> node)."""
+        with self._lock:
+            if mode not in self._indexes:
+                nodes = np.flatnonzero(np.diff(self.graphs[mode].indptr) > 0)
+                index = SpatialIndex()
+                index.add(Track(self.latitude[nodes], self.longitude[nodes]))
+                self._indexes[mode] = (index, nodes)
+            return self._indexes[mode]
+
+    def nearest_node(self, lat: float, lon: float, mode: str, max_meters: float = MAX_SNAP_METERS) -> Optional[int]:
+        """Closest node of the mode's graph within max_meters, found by growing a bbox around the point."""
+        index, nodes = self._index(mode)
+        radius = 50.0
+        while True:
+            dlat = math.degrees(radius / EARTH_RADIUS_M)
+            dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+            bbox = BoundingBox(max(lat - dlat, -90.0), max(lon - dlon, -180.0),
+                               min(lat + dlat, 90.0), min(lon + dlon, 180.0))
+            candidates = nodes[index.query(bbox)]
+            if len(candidates):
+                distances = haversine(lat, lon, self.latitude[candidates], self.longitude[candidates])
+                best = int(np.argmin(distances))
+                # A node in the bbox corner may be farther away than one just outside the bbox
+                if distances[best] <= radius:
+                    return int(candidates[best])
+            if radius >= max_meters:
+                return None
+            radius = min(radius * 2, max_meters)
+
+    def as_lists(self, mode: str) -> tuple:
+        """
+        The mode's CSR arrays (indptr, indices, seconds, meters), the node coordinates and the mode's top speed
+        in m/s as Python lists, indexing those is much faster in search loops. The top speed is that of the
+        fastest edge, maxspeed tags may exceed the default speeds.
+        """
+        with self._lock:
+            lists = self._lists.get(mode)
+            if lists is None:
+                graph = self.graphs[mode]
+                speeds = np.divide(graph.meters, graph.seconds, out=np.zeros(len(graph.seconds)),
+                                   where=graph.seconds > 0)
+                top_speed = float(speeds.max()) if speeds.any() else max(SPEEDS[mode].values()) / 3.6
+                lists = (graph.indptr.tolist(), graph.indices.tolist(), graph.seconds.tolist(),
+                         graph.meters.tolist(), self.latitude.tolist(), self.longitude.tolist(), top_speed)
+                self._lists[mode] = lists
+            return lists
+
+    def astar(self, source: int, target: int, mode: str) -> Optional[Tuple[List[int], float, float]]:
+        """
+        Fastest path from source to target: the node list, its duration in seconds and length in meters.
+        The heuristic is the straight line distance at the mode's top speed. Returns None if unreachable.
+        """
+        indptr, indices, seconds, meters, lat, lon, top_speed = self.as_lists(mode)
+        target_lat, target_lon = math.radians(lat[target]), math.radians(lon[target])
+        cos_target = math.cos(target_lat)
+
+        def heuristic(node: int) -> float:
+            node_lat = math.radians(lat[node])
+            a = (math.sin((target_lat - node_lat) / 2) ** 2
+                 + math.cos(node_lat) * cos_target * math.sin((target_lon - math.radians(lon[node])) / 2) ** 2)
+            return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a))) / top_speed
+
+        best = {source: 0.0}
+        previous: Dict[int, Tuple[int, int]] = {}
+        heap = [(heuristic(source), 0.0, source)]
+        done = set()
+        while heap:
+            _, cost, node = heapq.heappop(heap)
+            if node == target:
+                path, length = [target], 0.0
+                while node != source:
+                    node, edge = previous[node]
+                    path.append(node)
+                    length += meters[edge]
+                return path[::-1], cost, length
+            if node in done:
+                continue
+            done.add(node)
+            for edge in range(indptr[node], indptr[node + 1]):
+                neighbour = indices[edge]
+                new_cost = cost + seconds[edge]
+                if new_cost < best.get(neighbour, math.inf):
+                    best[neighbour] = new_cost
+                    previous[neighbour] = (node, edge)
+                    heapq.heappush(heap, (new_cost + heuristic(neighbour), new_cost, neighbour))
+        return None
+
+
+class Router:
+    """Routes waypoint sequences on a RoadGraph, with an LRU cache of computed legs"""
+
+    def __init__(self, graph: RoadGraph, cache_size: int = 100_000):
+        self.graph = graph
+        self.log = logging.getLogger(__name__)
+        self._legs = LRUCache(cache_size)
+
+    @classmethod
+    def from_file(cls, path: str, cache_size: int = 100_000) -> 'Router':
+        return cls(RoadGraph.load(path), cache_size)
+
+    def leg(self, source: int, target: int, mode: str) -> Optional[Tuple[List[int], float, float]]:
+        """Memoized RoadGraph.astar."""
+        key = (mode, source, target)
+        result = self._legs.get(key)
+        if result is None and key not in self._legs:
+            result = self.graph.astar(source, target, mode)
+            self._legs.put(key, result)
+        return result
+
+    def route(self, latitude: Sequence[float], longitude: Sequence[float], mode: str = "car") -> Route:
+        """
+        Route through the waypoints in order. Waypoints are snapped to their nearest node; consecutive
+        waypoints on the same node make no leg, so dense GPS tracks collapse to few searches.
+        """
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode {mode}, use one of {', '.join(MODES)}")
+        snapped = [self.graph.nearest_node(lat, lon, mode) for lat, lon in zip(np.asarray(latitude).tolist(),
+                                                                            np.asarray(longitude).tolist())]
+        nodes = [node for i, node in enumerate(snapped) if node is not None and (i == 0 or node != snapped[i - 1])]
+        path: List[int] = nodes[:1]
+        seconds = meters = 0.0
+        unroutable = 0
+        for source, target in zip(nodes[:-1], nodes[1:]):
+            result = self.leg(source, target, mode)
+            if result is None:
+                unroutable += 1
+                path.append(target)
+                continue
+            leg_path, leg_seconds, leg_meters = result
+            path.extend(leg_path[1:])
+            seconds += leg_seconds
+            meters += leg_meters
+        path = np.array(path, dtype=np.int64)
+        return Route(self.graph.latitude[path], self.graph.longitude[path], meters, seconds,
+                     max(len(nodes) - 1, 0), unroutable)
+
+    def route_track(self, track: Track, mode: str = "car") -> Route:
+        """Route along the points of a track, e.g. a day of gps_data."""
+        return self.route(track.latitude, track.longitude, mode)
@@ -0,0 +1,273 @@
+import threading
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from .datastore import Datastore
+from .geometry import TILE_SIZE, mercator_project
+from .track import NO_TIMESTAMP, Track
+from .util import BoundingBox
+
+# Depth of the quadtree grid: level 24 cells are a few centimeters wide, keys fit into 48 bits
+MAX_LEVEL = 24
+# Clusters at zoom z aggregate the cells of level z + CLUSTER_LEVEL_OFFSET, i.e. 64x64 screen pixels
+CLUSTER_LEVEL_OFFSET = 2
+MAX_CLUSTER_ZOOM = MAX_LEVEL - CLUSTER_LEVEL_OFFSET
+# A bbox query looks up at most this many cells per axis
+_QUERY_CELLS = 4
+
+_NO_START = np.iinfo(np.int64).max
+
+
+def _spread_bits(v: np.ndarray) -> np.ndarray:
+    """Insert a zero bit between the lower 32 bits of every value."""
+    v = v.astype(np.uint64) & np.uint64(0xFFFFFFFF)
+    for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333), (1, 0x5555555555555555)):
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+def _compact_bits(v: np.ndarray) -> np.ndarray:
+    """Inverse of _spread_bits: collect every second bit."""
+    v = v & np.uint64(0x5555555555555555)
+    for shift, mask in ((1, 0x3333333333333333), (2, 0x0F0F0F0F0F0F0F0F), (4, 0x00FF00FF00FF00FF),
+                        (8, 0x0000FFFF0000FFFF), (16, 0x00000000FFFFFFFF)):
+        v = (v | (v >> np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+def morton_keys(cx: np.ndarray, cy: np.ndarray) -> np.ndarray:
+    """Z-order keys of grid cells: cells of a quadtree node share a key prefix, so they are contiguous when sorted."""
+    return _spread_bits(cx) | (_spread_bits(cy) << np.uint64(1))
+
+
+def morton_cells(keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Column and row of the cells with the given Morton keys."""
+    keys = np.asarray(keys, dtype=np.uint64)
+    return _compact_bits(keys), _compact_bits(keys >> np.uint64(1))
+
+
+def grid_cells(lat: np.ndarray, lon: np.ndarray, level: int = MAX_LEVEL) -> Tuple[np.ndarray, np.ndarray]:
+    """Column and row of the Web Mercator grid cells of the given level that contain the points."""
+    x, y = mercator_project(lat, lon)
+    n = 2 ** level
+    cx = np.clip(np.floor(x / TILE_SIZE * n), 0, n - 1).astype(np.uint64)
+    cy = np.clip(np.floor(y / TILE_SIZE * n), 0, n - 1).astype(np.uint64)
+    return cx, cy
+
+
+def cluster_level(zoom: int) -> int:
+    return min(max(zoom, 0), MAX_CLUSTER_ZOOM) + CLUSTER_LEVEL_OFFSET
+
+
+class Clusters(NamedTuple):
+    """Points aggregated per grid cell. start/end are NO_TIMESTAMP for cells without timestamps."""
+    latitude: np.ndarray
+    longitude: np.ndarray
+    count: np.ndarray
+    start: np.ndarray
+    end: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.count)
+
+
+class _Aggregates(NamedTuple):
+    cell: np.ndarray
+    count: np.ndarray
+    sum_lat: np.ndarray
+    sum_lon: np.ndarray
+    start: np.ndarray
+    end: np.ndarray
+
+    @classmethod
+    def empty(cls) -> '_Aggregates':
+        return cls(np.empty(0, np.uint64), np.empty(0, np.int64), np.empty(0), np.empty(0),
+                   np.empty(0, np.int64), np.empty(0, np.int64))
+
+    @classmethod
+    def from_sorted(cls, cells: np.ndarray, lat: np.ndarray, lon: np.ndarray, ts: np.ndarray) -> '_Aggregates':
+        """Aggregate points whose cells are sorted, so every cell is one contiguous run."""
+        if len(cells) == 0:
+            return cls.empty()
+        first = np.r_[0, np.flatnonzero(np.diff(cells)) + 1]
+        dated = ts != NO_TIMESTAMP
+        return cls(
+            cells[first],
+            np.diff(np.r_[first, len(cells)]),
+            np.add.reduceat(lat, first),
+            np.add.reduceat(lon, first),
+            np.minimum.reduceat(np.where(dated, ts, _NO_START), first),
+            np.maximum.reduceat(np.where(dated, ts, NO_TIMESTAMP), first),
+        )
+
+    def merge(self, other: '_Aggregates') -> '_Aggregates':
+        """Add the aggregates of new points: matching cells are updated, new cells inserted in key order."""
+        pos = np.searchsorted(self.cell, other.cell)
+        found = pos < len(self.cell)
+        found[found] = self.cell[pos[found]] == other.cell[found]
+        count, sum_lat, sum_lon, start, end = (a.copy() for a in self[1:])
+        hit = pos[found]
+        count[hit] += other.count[found]
+        sum_lat[hit] += other.sum_lat[found]
+        sum_lon[hit] += other.sum_lon[found]
+        start[hit] = np.minimum(start[hit], other.start[found])
+        end[hit] = np.maximum(end[hit], other.end[found])
+        new, at = ~found, pos[~found]
+        return _Aggregates(*(np.insert(mine, at, theirs[new]) for mine, theirs in
+                             zip((self.cell, count, sum_lat, sum_lon, start, end), other)))
+
+
+class SpatialIndex:
+    """
+    Points sorted by the Morton key of their level MAX_LEVEL grid cell, a hierarchical grid like a quadtree:
+    a bbox is covered by a few coarser cells, each of which is one contiguous key range found by binary search.
+    Cluster aggregates (count, centroid, time span) per zoom level are kept as well. Added points are buffered
+    and merged by the next query, so a burst of adds costs one merge of the sorted arrays instead of one each.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._keys = np.empty(0, np.uint64)
+            self._ids = np.empty(0, np.int64)
+            self._lat = np.empty(0)
+            self._lon = np.empty(0)
+            self._size = 0
+            # (lat, lon, ts, first id) of the points added since the last merge
+            self._pending: List[Tuple[np.ndarray, np.ndarray, np.ndarray, int]] = []
+            self._aggregates: Dict[int, _Aggregates] = {
+                cluster_level(zoom): _Aggregates.empty() for zoom in range(MAX_CLUSTER_ZOOM + 1)
+            }
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, track: Track) -> None:
+        """Index the points of a track; they get the ids len(self) ... len(self) + len(track) - 1."""
+        if len(track) == 0:
+            return
+        with self._lock:
+            self._pending.append((track.latitude, track.longitude, track.timestamp, self._size))
+            self._size += len(track)
+
+    def _merge_pending(self) -> None:
+        """Merge the buffered points into the sorted arrays and the aggregates. Call with the lock held."""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        lat, lon, ts = (np.concatenate([p[i] for p in pending]) for i in range(3))
+        ids = np.concatenate([np.arange(first, first + len(added)) for added, _, _, first in pending])
+        keys = morton_keys(*grid_cells(lat, lon))
+        order = np.argsort(keys, kind="stable")
+        keys, ids, lat, lon, ts = keys[order], ids[order], lat[order], lon[order], ts[order]
+        # Merge in O(n + m) instead of re-sorting everything
+        at = np.searchsorted(self._keys, keys, side="right")
+        self._keys = np.insert(self._keys, at, keys)
+        self._ids = np.insert(self._ids, at, ids)
+        self._lat = np.insert(self._lat, at, lat)
+        self._lon = np.insert(self._lon, at, lon)
+        for level, aggregates in self._aggregates.items():
+            cells = keys >> np.uint64(2 * (MAX_LEVEL - level))
+            self._aggregates[level] = aggregates.merge(_Aggregates.from_sorted(cells, lat, lon, ts))
+
+    def _key_ranges(self, bbox: BoundingBox, level: int) -> List[Tuple[int, int]]:
+        """Sorted, merged [first, last) ranges of level-cell keys covering bbox."""
+        (x0, x1), (y1, y0) = grid_cells(np.array([bbox.min_lat, bbox.max_lat]),
+                                        np.array([bbox.min_lon, bbox.max_lon]), level)
+        x0, x1, y0, y1 = int(x0), int(x1), int(y0), int(y1)
+        shift = 0
+        while (x1 >> shift) - (x0 >> shift) >= _QUERY_CELLS or (y1 >> shift) - (y0 >> shift) >= _QUERY_CELLS:
+            shift += 1
+        xs = np.arange(x0 >> shift, (x1 >> shift) + 1, dtype=np.uint64)
+        ys = np.arange(y0 >> shift, (y1 >> shift) + 1, dtype=np.uint64)
+        cells = np.sort(morton_keys(*(a.ravel() for a in np.meshgrid(xs, ys)))).tolist()
+        ranges = []
+        for cell in cells:
+            first, last = cell << (2 * shift), (cell + 1) << (2 * shift)
+            if ranges and ranges[-1][1] == first:
+                ranges[-1] = (ranges[-1][0], last)
+            else:
+                ranges.append((first, last))
+        return ranges
+
+    @staticmethod
+    def _lookup(keys: np.ndarray, ranges: List[Tuple[int, int]]) -> np.ndarray:
+        bounds = np.searchsorted(keys, np.array(ranges, dtype=np.uint64).ravel()).reshape(-1, 2)
+        if len(bounds) == 0:
+            return np.empty(0, np.int64)
+        return np.concatenate([np.arange(first, last) for first, last in bounds])
+
+    def query(self, bbox: BoundingBox) -> np.ndarray:
+        """Sorted ids of the points inside bbox."""
+        with self._lock:
+            self._merge_pending()
+            keys, ids, lat, lon = self._keys, self._ids, self._lat, self._lon
+        candidates = self._lookup(keys, self._key_ranges(bbox, MAX_LEVEL))
+        lat, lon = lat[candidates], lon[candidates]
+        inside = (lat >= bbox.min_lat) & (lat <= bbox.max_lat) & (lon >= bbox.min_lon) & (lon <= bbox.max_lon)
+        return np.sort(ids[candidates[inside]])
+
+    def clusters(self, zoom: int, bbox: Optional[BoundingBox] = None) -> Clusters:
+        """Cluster aggregates of zoom level zoom, optionally only the cells touching bbox."""
+        level = cluster_level(zoom)
+        with self._lock:
+            self._merge_pending()
+            aggregates = self._aggregates[level]
+        if bbox is not None:
+            aggregates = _Aggregates(*(a[self._lookup(aggregates.cell, self._key_ranges(bbox, level))]
+                                       for a in aggregates))
+        start = np.where(aggregates.start == _NO_START, NO_TIMESTAMP, aggregates.start)
+        return Clusters(aggregates.sum_lat / aggregates.count, aggregates.sum_lon / aggregates.count,
+                        aggregates.count, start, aggregates.end)
+
+
+class DatastoreIndex:
+    """
+    SpatialIndex over the cached points of a datastore. It is built on first use and afterwards follows
+    insert_points incrementally: the cached track only ever grows, so every read just catches up on the new tail.
+    Inserts cost the writer nothing, the work happens on the first read after them.
+    Any other structure with add(track), clear() and len() can be kept in sync the same way by passing it as index.
+    """
+
+    def __init__(self, datastore: Datastore, index=None):
+        self.ds = datastore
+        self.index = SpatialIndex() if index is None else index
+        self._track: Optional[Track] = None
+        self._lock = threading.Lock()
+        self.ds.subscribe(self.on_write)
+
+    def on_write(self, event: str, track: Optional[Track], version: int) -> None:
+        """Datastore write listener: start over after a delete; inserted points are picked up by the next sync."""
+        if event != "insert":
+            with self._lock:
+                self._track = None
+                self.index.clear()
+
+    def sync(self) -> Track:
+        """Bring the index up to date with the cached track and return that track."""
+        with self._lock:
+            return self._catch_up()
+
+    def _catch_up(self) -> Track:
+        track = self.ds.fetch_gps_data()
+        if track is not self._track:
+            # Reloaded from the database, the cached track was replaced
+            self._track = track
+            self.index.clear()
+        if len(self.index) < len(track):
+            self.index.add(track[len(self.index):len(track)])
+        return track
+
+    def query(self, bbox: BoundingBox) -> Track:
+        """Points inside bbox, in the order of the cached track."""
+        track = self.sync()
+        return track[self.index.query(bbox)]
+
+    def clusters(self, zoom: int, bbox: Optional[BoundingBox] = None) -> Clusters:
+        self.sync()
+        return self.index.clusters(zoom, bbox)
@@ -0,0 +1,24 @@
+// Follows the points inserted after the page was rendered, pushed as Server-Sent Events by /events.
+// A "points" event carries the new points delta-encoded: integer degrees * scale, the first value absolute,
+// every following one relative to its predecessor.
+function decodePoints(data) {
+    const points = new Array(data.count);
+    let lat = 0, lon = 0;
+    for (let i = 0; i < data.count; i++) {
+        lat += data.lat[i];
+        lon += data.lon[i];
+        points[i] = [lat / data.scale, lon / data.scale];
+    }
+    return points;
+}
+
+function followPoints(url, onPoints) {
+    const source = new EventSource(url);
+    source.addEventListener('points', e => onPoints(decodePoints(JSON.parse(e.data))));
+    // Data was deleted, bulk imported or missed: only a reload shows the current state
+    source.addEventListener('reset', () => {
+        source.close();
+        window.top.location.reload();
+    });
+    return source;
+}
@@ -0,0 +1,60 @@
+// Decoders of the /api/track formats (see backend/wire.py), the browser undoes the gzip / brotli compression
+function unzigzag(value) {
+    return value % 2 ? -(value + 1) / 2 : value / 2;
+}
+
+// [[lat, lon], ...] of a varint payload: precision, point count, then zigzag lat / lon differences
+function decodeTrack(buffer) {
+    const bytes = new Uint8Array(buffer);
+    let pos = 0;
+    function next() {
+        // Multiplication instead of shifts, the point count may not fit 32 bits
+        let value = 0, scale = 1, byte;
+        do {
+            byte = bytes[pos++];
+            value += (byte & 0x7f) * scale;
+            scale *= 128;
+        } while (byte & 0x80);
+        return value;
+    }
+    const factor = Math.pow(10, next());
+    const points = new Array(next());
+    let lat = 0, lon = 0;
+    for (let i = 0; i < points.length; i++) {
+        lat += unzigzag(next());
+        lon += unzigzag(next());
+        points[i] = [lat / factor, lon / factor];
+    }
+    return points;
+}
+
+// [[lat, lon], ...] of a Google encoded polyline
+function decodePolyline(text, precision = 5) {
+    const factor = Math.pow(10, precision);
+    const points = [];
+    let pos = 0, lat = 0, lon = 0;
+    function next() {
+        let value = 0, shift = 0, byte;
+        do {
+            byte = text.charCodeAt(pos++) - 63;
+            value |= (byte & 0x1f) << shift;
+            shift += 5;
+        } while (byte & 0x20);
+        return unzigzag(value >>> 0);
+    }
+    while (pos < text.length) {
+        lat += next();
+        lon += next();
+        points.push([lat / factor, lon / factor]);
+    }
+    return points;
+}
+
+// [[lat, lon], ...] of an /api/track url, format and precision are the ones it asks for
+function loadTrack(url, format = "varint", precision = 5) {
+    return fetch(url).then(response => {
+        if (!response.ok) throw new Error(`Loading ${url} failed: ${response.status}`);
+        if (format === "polyline") return response.text().then(text => decodePolyline(text, precision));
+        return response.arrayBuffer().then(decodeTrack);
+    });
+}
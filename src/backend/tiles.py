@@ -0,0 +1,251 @@
+import logging
+import os
+import shutil
+import threading
+import uuid
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+
+from .cache import LRUCache
+from .datastore import Datastore
+from .geometry import TILE_SIZE, douglas_peucker, mercator_project
+from .track import Track
+
+MVT_EXTENT = 4096
+# Extra extent units drawn around each tile so lines and points don't get cut off at tile edges
+TILE_BUFFER = 64
+# Below this zoom only the track lines are put into tiles, individual points are not visible anyway
+POINTS_MIN_ZOOM = 12
+MAX_ZOOM = 22
+
+_MOVE_TO = 1
+_LINE_TO = 2
+_GEOM_POINT = 1
+_GEOM_LINESTRING = 2
+
+
+def _write_varint(out: bytearray, value: int) -> None:
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _write_key(out: bytearray, field: int, wire_type: int) -> None:
+    _write_varint(out, (field << 3) | wire_type)
+
+
+def _write_bytes(out: bytearray, field: int, data: bytes) -> None:
+    _write_key(out, field, 2)
+    _write_varint(out, len(data))
+    out += data
+
+
+def _zigzag(values: np.ndarray) -> np.ndarray:
+    return (values << 1) ^ (values >> 63)
+
+
+def _command(command: int, count: int) -> int:
+    return (command & 0x7) | (count << 3)
+
+
+def _encode_geometry(parts: List[np.ndarray], command: int) -> List[int]:
+    """
+    Encode integer coordinate parts as MVT geometry commands with delta-encoded, zigzagged parameters.
+    For lines every part becomes MoveTo(1) + LineTo(n - 1), for points a single MoveTo(n) is written.
+    """
+    geometry = []
+    cursor = np.zeros(2, dtype=np.int64)
+    for part in parts:
+        deltas = np.diff(part, axis=0, prepend=cursor[None, :])
+        params = _zigzag(deltas).ravel().tolist()
+        cursor = part[-1]
+        if command == _LINE_TO:
+            geometry.append(_command(_MOVE_TO, 1))
+            geometry.extend(params[:2])
+            geometry.append(_command(_LINE_TO, len(part) - 1))
+            geometry.extend(params[2:])
+        else:
+            geometry.append(_command(_MOVE_TO, len(part)))
+            geometry.extend(params)
+    return geometry
+
+
+def _encode_layer(name: str, geom_type: int, geometry: List[int]) -> bytes:
+    """Encode a layer holding a single (multi) geometry feature without attributes."""
+    feature = bytearray()
+    _write_key(feature, 3, 0)
+    _write_varint(feature, geom_type)
+    packed = bytearray()
+    for value in geometry:
+        _write_varint(packed, value)
+    _write_bytes(feature, 4, packed)
+
+    layer = bytearray()
+    _write_key(layer, 15, 0)
+    _write_varint(layer, 2)
+    _write_bytes(layer, 1, name.encode())
+    _write_bytes(layer, 2, feature)
+    _write_key(layer, 5, 0)
+    _write_varint(layer, MVT_EXTENT)
+    return bytes(layer)
+
+
+def _clip_segments(x: np.ndarray, y: np.ndarray, lo: float, hi: float):
+    """
+    Liang-Barsky clipping of the segments (x[i], y[i]) -> (x[i + 1], y[i + 1]) against the square [lo, hi].
+    Returns the indices of the visible segments, their clipped end points and whether start/end were clipped.
+    """
+    x0, y0, dx, dy = x[:-1], y[:-1], np.diff(x), np.diff(y)
+    t0 = np.zeros(len(dx))
+    t1 = np.ones(len(dx))
+    visible = np.ones(len(dx), dtype=bool)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for p, q in ((-dx, x0 - lo), (dx, hi - x0), (-dy, y0 - lo), (dy, hi - y0)):
+            ratio = q / p
+            t0 = np.where(p < 0, np.maximum(t0, ratio), t0)
+            t1 = np.where(p > 0, np.minimum(t1, ratio), t1)
+            visible &= ~((p == 0) & (q < 0))
+    visible &= t0 <= t1
+    idx = np.flatnonzero(visible)
+    t0, t1 = t0[idx], t1[idx]
+    start = np.column_stack((x0[idx] + t0 * dx[idx], y0[idx] + t0 * dy[idx]))
+    end = np.column_stack((x0[idx] + t1 * dx[idx], y0[idx] + t1 * dy[idx]))
+    return idx, start, end, t0 > 0, t1 < 1
+
+
+def _line_parts(x: np.ndarray, y: np.ndarray, tolerance: float) -> List[np.ndarray]:
+    """Cut the track into the polylines visible in the (buffered) tile and simplify them."""
+    if len(x) < 2:
+        return []
+    idx, start, end, start_clipped, end_clipped = _clip_segments(x, y, -TILE_BUFFER, MVT_EXTENT + TILE_BUFFER)
+    if len(idx) == 0:
+        return []
+    # A new part begins wherever the chain of visible segments is interrupted
+    breaks = np.flatnonzero((np.diff(idx) > 1) | end_clipped[:-1] | start_clipped[1:]) + 1
+    parts = []
+    for first, last in zip(np.r_[0, breaks], np.r_[breaks, len(idx)]):
+        coords = np.vstack((start[first:first + 1], end[first:last]))
+        coords = coords[douglas_peucker(coords[:, 0], coords[:, 1], tolerance)]
+        coords = np.rint(coords).astype(np.int64)
+        keep = np.r_[True, np.any(np.diff(coords, axis=0) != 0, axis=1)]
+        coords = coords[keep]
+        if len(coords) >= 2:
+            parts.append(coords)
+    return parts
+
+
+def render_tile(x0: np.ndarray, y0: np.ndarray, z: int, x: int, y: int, tolerance_px: float = 1.0) -> bytes:
+    """
+    Encode the track given in zoom 0 Web Mercator pixel coordinates (see mercator_project)
+    as a Mapbox Vector Tile with a "track" line layer and, from POINTS_MIN_ZOOM, a "points" layer.
+    """
+    scale = 2.0 ** z * MVT_EXTENT / TILE_SIZE
+    tx = x0 * scale - x * MVT_EXTENT
+    ty = y0 * scale - y * MVT_EXTENT
+    tolerance = tolerance_px * MVT_EXTENT / TILE_SIZE
+
+    tile = bytearray()
+    parts = _line_parts(tx, ty, tolerance)
+    if parts:
+        _write_bytes(tile, 3, _encode_layer("track", _GEOM_LINESTRING, _encode_geometry(parts, _LINE_TO)))
+
+    if z >= POINTS_MIN_ZOOM:
+        lo, hi = -TILE_BUFFER, MVT_EXTENT + TILE_BUFFER
+        inside = (tx >= lo) & (tx <= hi) & (ty >= lo) & (ty <= hi)
+        if inside.any():
+            # Points closer than a screen pixel collapse into one
+            pixel = MVT_EXTENT // TILE_SIZE
+            coords = np.unique(np.rint(np.column_stack((tx[inside], ty[inside])) / pixel).astype(np.int64), axis=0)
+            geometry = _encode_geometry([coords * pixel], _MOVE_TO)
+            _write_bytes(tile, 3, _encode_layer("points", _GEOM_POINT, geometry))
+    return bytes(tile)
+
+
+class VectorTileCache:
+    """
+    Serves gps_data as Mapbox Vector Tiles, cached in memory and optionally on disk.
+    Disk tiles live in a directory per dataset version and are purged whenever the datastore is written to.
+    """
+
+    def __init__(self, datastore: Datastore, cache_dir: Optional[str] = None, tolerance_px: float = 1.0,
+                 memory_cache_size: int = 256):
+        self.log = logging.getLogger(__name__)
+        self.ds = datastore
+        self.tolerance_px = tolerance_px
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self._salt = uuid.uuid4().hex[:8]
+        self._tiles = LRUCache(memory_cache_size)
+        self._projected = LRUCache(1)
+        # Newest dataset version whose generation the purge thread has yet to keep, and whether it runs
+        self._purge_lock = threading.Lock()
+        self._purge_version: Optional[int] = None
+        self._purging = False
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self._purge(keep=None)
+        self.ds.subscribe(self.on_write)
+
+    def _generation_dir(self, version: int) -> Path:
+        return self.cache_dir / f"gen-{self._salt}-{version}"
+
+    def _purge(self, keep: Optional[Path]) -> None:
+        for path in self.cache_dir.glob("gen-*"):
+            if path != keep:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def _purge_until_current(self) -> None:
+        """Purge thread: runs while writes come in, each pass keeps only the newest version seen so far."""
+        while True:
+            with self._purge_lock:
+                version, self._purge_version = self._purge_version, None
+                if version is None:
+                    self._purging = False
+                    return
+            self._purge(keep=self._generation_dir(version))
+
+    def on_write(self, event: str, track: Optional[Track], version: int) -> None:
+        """
+        Datastore write listener: drop tiles of older dataset versions. Disk purges run on one thread at a time,
+        writes during a purge are coalesced into one more pass.
+        """
+        self._tiles.clear()
+        if self.cache_dir:
+            with self._purge_lock:
+                self._purge_version = max(version, self._purge_version or version)
+                if self._purging:
+                    return
+                self._purging = True
+            threading.Thread(target=self._purge_until_current, daemon=True).start()
+
+    def _projection(self, version: int):
+        def compute():
+            track = self.ds.fetch_gps_data()
+            return mercator_project(track.latitude, track.longitude)
+        return self._projected.get_or_compute(version, compute)
+
+    def get_tile(self, z: int, x: int, y: int) -> bytes:
+        """Return the encoded tile z/x/y. Raises ValueError for tile coordinates outside the grid."""
+        if not (0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            raise ValueError(f"Invalid tile {z}/{x}/{y}")
+        version = self.ds.version
+        key = (version, z, x, y)
+        data = self._tiles.get(key)
+        if data is not None:
+            return data
+
+        path = self._generation_dir(version) / str(z) / str(x) / f"{y}.mvt" if self.cache_dir else None
+        if path and path.exists():
+            data = path.read_bytes()
+        else:
+            x0, y0 = self._projection(version)
+            data = render_tile(x0, y0, z, x, y, self.tolerance_px)
+            if path:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                tmp = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+                tmp.write_bytes(data)
+                os.replace(tmp, path)
+        self._tiles.put(key, data)
+        return data
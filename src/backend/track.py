@@ -0,0 +1,282 @@
+import re
+from datetime import datetime, timezone
+
+import numpy as np
+from typing import Any, Iterable, Iterator, Optional, Sequence, Tuple, Union
+from .util import GeoPoint
+
+# Marks points without a timestamp in the int64 timestamp column
+NO_TIMESTAMP = np.iinfo(np.int64).min
+# A time of day followed by an explicit UTC offset (or Z); without one a timestamp is taken as UTC
+_UTC_OFFSET = re.compile(r"\d{2}:\d{2}(?::\d{2}(?:[.,]\d+)?)?\s*(?:[zZ]|[+-]\d{2}(?::?\d{2})?)$")
+
+
+def _timestamp_strings(values: Sequence[Any]) -> np.ndarray:
+    """The timestamps as an object array of strings (None for missing), datetimes in ISO format (naive = UTC)."""
+    import pandas as pd
+    strings = np.array(values, dtype=object) if len(values) else np.empty(0, dtype=object)
+    if pd.api.types.infer_dtype(strings, skipna=True) != "string":
+        def normalize(value):
+            if isinstance(value, datetime):
+                if value.tzinfo is not None:
+                    value = value.astimezone(timezone.utc)
+                fraction = f".{value.microsecond:06d}" if value.microsecond else ""
+                return f"{value.strftime('%Y-%m-%dT%H:%M:%S')}{fraction}Z"
+            return value if isinstance(value, str) else None
+        strings = np.array([normalize(v) for v in strings], dtype=object)
+    strings[strings == ""] = None
+    return strings
+
+
+def _parse_timestamps(strings: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Epoch seconds of timestamp strings, and the mask of those in the YYYY-MM-DDTHH:MM:SSZ form of to_iso_strings."""
+    n = len(strings)
+    seconds = np.full(n, NO_TIMESTAMP, dtype=np.int64)
+    # Fast path for the form this module writes, numpy parses it in C
+    canonical = np.fromiter((s is not None and len(s) == 20 and s[19] == "Z" and s[10] == "T" for s in strings),
+                            dtype=bool, count=n)
+    if canonical.any():
+        try:
+            seconds[canonical] = np.array([s[:19] for s in strings[canonical]], dtype="datetime64[s]").astype(np.int64)
+        except ValueError:
+            canonical[:] = False
+    rest = (strings != None) & ~canonical  # noqa: E711
+    if not rest.any():
+        return seconds, canonical
+
+    import pandas as pd
+    aware = np.zeros(n, dtype=bool)
+    aware[rest] = [_UTC_OFFSET.search(s) is not None for s in strings[rest]]
+    # Parse timestamps with and without offset separately: pandas infers one format per call, so mixing them
+    # would make the result of a value depend on the rest of the batch
+    for group in (rest & aware, rest & ~aware):
+        if not group.any():
+            continue
+        parsed = pd.to_datetime(pd.Series(strings[group], dtype=object), utc=True, errors="coerce", format="ISO8601")
+        ns = parsed.to_numpy(dtype="datetime64[ns]").astype(np.int64)
+        group_seconds = ns // 1_000_000_000
+        group_seconds[parsed.isna().to_numpy()] = NO_TIMESTAMP
+        seconds[group] = group_seconds
+    return seconds, canonical
+
+
+def to_epoch_seconds(values: Sequence[Any]) -> np.ndarray:
+    """
+    Convert ISO 8601 strings / datetimes (None or "" for missing) to int64 epoch seconds, rounded down.
+    Each value is converted on its own: without a UTC offset it is UTC. Unparsable values are NO_TIMESTAMP.
+    """
+    if len(values) == 0:
+        return np.empty(0, dtype=np.int64)
+    return _parse_timestamps(_timestamp_strings(values))[0]
+
+
+def parse_timestamps(values: Sequence[Any]) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    to_epoch_seconds, plus the original strings of the timestamps the epoch seconds don't reproduce exactly
+    (sub-second precision, UTC offsets, other formats) as an object array with None for the rest,
+    or None if the seconds reproduce them all.
+    """
+    if len(values) == 0:
+        return np.empty(0, dtype=np.int64), None
+    strings = _timestamp_strings(values)
+    seconds, canonical = _parse_timestamps(strings)
+    candidates = np.flatnonzero((strings != None) & ~canonical)  # noqa: E711
+    lossy = candidates[strings[candidates] != to_iso_strings(seconds[candidates]).astype(object)]
+    if len(lossy) == 0:
+        return seconds, None
+    raw = np.full(len(strings), None, dtype=object)
+    raw[lossy] = strings[lossy]
+    return seconds, raw
+
+
+def to_iso_strings(seconds: np.ndarray) -> np.ndarray:
+    """Convert int64 epoch seconds back to ISO 8601 UTC strings ("" for missing timestamps)."""
+    missing = seconds == NO_TIMESTAMP
+    strings = np.char.add(np.datetime_as_string(np.where(missing, 0, seconds).astype("datetime64[s]"), unit="s"), "Z")
+    strings[missing] = ""
+    return strings
+
+
+class Track:
+    """
+    Columnar GPS track: float64 latitude/longitude/elevation and int64 epoch-second timestamps.
+    Missing elevations are NaN, missing timestamps NO_TIMESTAMP. Timestamps have second resolution; the original
+    strings of timestamps the seconds don't reproduce (fractions, UTC offsets, other formats) are kept in an
+    optional raw column, so writing a track stores its timestamps unchanged.
+
+    Slicing with a slice returns a zero-copy view, integer indexing returns a GeoPoint so that
+    code written against lists of GeoPoint keeps working.
+    """
+    __slots__ = ("_lat", "_lon", "_ele", "_ts", "_raw", "_size")
+
+    def __init__(self, latitude: Optional[np.ndarray] = None, longitude: Optional[np.ndarray] = None,
+                 elevation: Optional[np.ndarray] = None, timestamp: Optional[np.ndarray] = None,
+                 raw_timestamp: Optional[np.ndarray] = None):
+        self._lat = np.asarray(latitude if latitude is not None else [], dtype=np.float64)
+        self._size = len(self._lat)
+        self._lon = np.asarray(longitude if longitude is not None else [], dtype=np.float64)
+        self._ele = (np.asarray(elevation, dtype=np.float64) if elevation is not None
+                     else np.full(self._size, np.nan))
+        self._ts = (np.asarray(timestamp, dtype=np.int64) if timestamp is not None
+                    else np.full(self._size, NO_TIMESTAMP, dtype=np.int64))
+        # Original timestamp strings where the seconds are lossy, None elsewhere; no column if there are none
+        self._raw = np.asarray(raw_timestamp, dtype=object) if raw_timestamp is not None else None
+        if not (len(self._lon) == len(self._ele) == len(self._ts) == self._size):
+            raise ValueError("Track columns must have the same length")
+        if self._raw is not None and len(self._raw) != self._size:
+            raise ValueError("Track columns must have the same length")
+
+    @classmethod
+    def from_rows(cls, rows: Sequence[Sequence[Any]]) -> 'Track':
+        """Build a track from (latitude, longitude, elevation, timestamp) rows as returned by the database."""
+        if isinstance(rows, Track):
+            # Columnar backends return tracks directly
+            return rows
+        if len(rows) == 0:
+            return cls()
+        lat, lon, ele, ts = zip(*rows)
+        seconds, raw = parse_timestamps(ts)
+        return cls(
+            np.array(lat, dtype=np.float64),
+            np.array(lon, dtype=np.float64),
+            np.array([np.nan if e is None else e for e in ele], dtype=np.float64),
+            seconds,
+            raw
+        )
+
+    @classmethod
+    def from_points(cls, points: Iterable[GeoPoint]) -> 'Track':
+        if isinstance(points, Track):
+            return points
+        return cls.from_rows([(p.latitude, p.longitude, p.elevation, p.timestamp) for p in points])
+
+    @property
+    def latitude(self) -> np.ndarray:
+        return self._lat[:self._size]
+
+    @property
+    def longitude(self) -> np.ndarray:
+        return self._lon[:self._size]
+
+    @property
+    def elevation(self) -> np.ndarray:
+        return self._ele[:self._size]
+
+    @property
+    def timestamp(self) -> np.ndarray:
+        return self._ts[:self._size]
+
+    @property
+    def raw_timestamp(self) -> Optional[np.ndarray]:
+        """Original timestamp strings the epoch seconds don't reproduce, None elsewhere (None if there are none)."""
+        return self._raw[:self._size] if self._raw is not None else None
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes held by the column buffers (including spare capacity)."""
+        raw = self._raw.nbytes if self._raw is not None else 0
+        return self._lat.nbytes + self._lon.nbytes + self._ele.nbytes + self._ts.nbytes + raw
+
+    def append(self, other: Union['Track', Iterable[GeoPoint]]) -> None:
+        """Append points in place. Storage grows geometrically, so repeated appends are amortized O(1) per point."""
+        other = Track.from_points(other)
+        needed = self._size + len(other)
+        if needed > len(self._lat):
+            capacity = max(needed, 2 * len(self._lat), 16)
+            self._lat, self._lon, self._ele, self._ts = (
+                self._grow(column, capacity) for column in (self._lat, self._lon, self._ele, self._ts)
+            )
+            if self._raw is not None:
+                self._raw = self._grow(self._raw, capacity)
+        if other._raw is not None and self._raw is None:
+            self._raw = np.full(len(self._lat), None, dtype=object)
+        end = self._size + len(other)
+        self._lat[self._size:end] = other.latitude
+        self._lon[self._size:end] = other.longitude
+        self._ele[self._size:end] = other.elevation
+        self._ts[self._size:end] = other.timestamp
+        if self._raw is not None:
+            self._raw[self._size:end] = other.raw_timestamp if other._raw is not None else None
+        self._size = end
+
+    def extended(self, other: Union['Track', Iterable[GeoPoint]]) -> 'Track':
+        """
+        A new track with other appended, leaving this one unchanged for the readers that hold it. The new track
+        takes over the spare capacity of the columns, so extending the latest track again stays amortized O(1);
+        this one keeps exact-size views of the shared columns and copies them if it is ever appended to itself.
+        """
+        track = Track.__new__(Track)
+        track._lat, track._lon, track._ele, track._ts, track._raw = self._lat, self._lon, self._ele, self._ts, self._raw
+        track._size = self._size
+        self._lat, self._lon, self._ele, self._ts = self.latitude, self.longitude, self.elevation, self.timestamp
+        self._raw = self.raw_timestamp
+        track.append(other)
+        return track
+
+    def _grow(self, column: np.ndarray, capacity: int) -> np.ndarray:
+        grown = np.empty(capacity, dtype=column.dtype) if column.dtype != object else np.full(capacity, None)
+        grown[:self._size] = column[:self._size]
+        return grown
+
+    def iter_rows(self) -> Iterator[tuple]:
+        """Yield (latitude, longitude, elevation, timestamp) tuples for database writes (None for missing values)."""
+        elevation = [None if np.isnan(e) else e for e in self.elevation.tolist()]
+        timestamps = [s or None for s in self.timestamp_strings().tolist()]
+        return zip(self.latitude.tolist(), self.longitude.tolist(), elevation, timestamps)
+
+    def timestamp_strings(self) -> np.ndarray:
+        """ISO 8601 UTC strings of the timestamps ("" for missing), the original string where it was lossy."""
+        strings = to_iso_strings(self.timestamp)
+        raw = self.raw_timestamp
+        if raw is None:
+            return strings
+        strings = strings.astype(object)
+        lossy = raw != None  # noqa: E711
+        strings[lossy] = raw[lossy]
+        return strings
+
+    def to_points(self) -> list:
+        timestamps = self.timestamp_strings().tolist()
+        return [
+            GeoPoint(latitude=lat, longitude=lon, elevation=None if np.isnan(ele) else ele, timestamp=ts)
+            for lat, lon, ele, ts in zip(self.latitude.tolist(), self.longitude.tolist(),
+                                         self.elevation.tolist(), timestamps)
+        ]
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self) -> Iterator[GeoPoint]:
+        return iter(self.to_points())
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += self._size
+            if not 0 <= key < self._size:
+                raise IndexError("Track index out of range")
+            ele = self._ele[key]
+            return GeoPoint(
+                latitude=float(self._lat[key]),
+                longitude=float(self._lon[key]),
+                elevation=None if np.isnan(ele) else float(ele),
+                timestamp=str(self[key:key + 1].timestamp_strings()[0])
+            )
+        # Slices give views into the columns, index arrays and boolean masks give copies
+        raw = self.raw_timestamp
+        return Track(self.latitude[key], self.longitude[key], self.elevation[key], self.timestamp[key],
+                     raw[key] if raw is not None else None)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, Track):
+            return (len(self) == len(other)
+                    and np.array_equal(self.latitude, other.latitude)
+                    and np.array_equal(self.longitude, other.longitude)
+                    and np.array_equal(self.elevation, other.elevation, equal_nan=True)
+                    and np.array_equal(self.timestamp, other.timestamp))
+        if isinstance(other, (list, tuple)):
+            return self.to_points() == list(other)
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"Track({self._size} points)"
@@ -19,9 +19,30 @@ class GeoPoint:
 
     @classmethod
     def from_dict(cls, data: dict) -> 'GeoPoint':
+        # The editor sends Leaflet's lat / lng
         return cls(
-            data.get('latitude', 0.0),
-            data.get('longitude', 0.0),
+            data.get('latitude', data.get('lat', 0.0)),
+            data.get('longitude', data.get('lng', 0.0)),
             data.get('elevation', 0.0),
             data.get('timestamp', "")
         )
+
+
+@dataclass(frozen=True)
+class BoundingBox:
+    min_lat: float
+    min_lon: float
+    max_lat: float
+    max_lon: float
+
+    def __post_init__(self):
+        if self.min_lat > self.max_lat or self.min_lon > self.max_lon:
+            raise ValueError(f"Invalid bounding box: {self}")
+
+    def as_dict(self) -> dict:
+        return {
+            "min_lat": self.min_lat,
+            "min_lon": self.min_lon,
+            "max_lat": self.max_lat,
+            "max_lon": self.max_lon,
+        }
@@ -14,19 +14,63 @@ Docs:
     To Serve Folium Maps with Flask: https://python-visualization.github.io/folium/latest/advanced_guide/flask.html
 
 """
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify, abort, make_response, g
+from .analytics import AnalyticsCache
+from .cache import LRUCache
 from .datastore import Datastore
-from .map import MapUtil
-from .util import get_templates_from_json, GeoPoint
+from .events import EventBroker
+from .exchange import MIMETYPES, stream_export
+from .heatmap import HeatmapCache
+from .ingest import DEFAULT_BATCH_SIZE, MAX_BATCH_SIZE, ingest_ndjson
+from .map import MapUtil, DEFAULT_ZOOM
+from .mapmatch import MatchStore
+from .metrics import (CONTENT_TYPE, DB_QUEUE_DEPTH, HTTP_REQUESTS, HTTP_REQUEST_SECONDS, MAP_BUILD_SECONDS,
+                      MAP_SERIALIZE_SECONDS, REGISTRY, RequestProfiler)
+from .routing import MAX_ROUTE_WAYPOINTS, MODES, Router
+from .spatial import DatastoreIndex
+from .tiles import VectorTileCache
+from .util import get_templates_from_json, GeoPoint, BoundingBox
+from .wire import (DEFAULT_PRECISION, FORMATS as WIRE_FORMATS, MAX_PRECISION, available_encodings, compress,
+                   encode_polyline, encode_varint)
+from datetime import datetime, timezone
+from typing import Any, Callable, Iterator, Optional, Tuple
+from urllib.parse import urlencode
+import hashlib
+import json
 import logging
+import time
+import uuid
+
+# Page size of /api/points when no limit is given, and the largest page a client may ask for
+DEFAULT_PAGE_SIZE = 10_000
+MAX_PAGE_SIZE = 1_000_000
+# Compressed /api/track payloads kept in memory
+TRACK_CACHE_BYTES = 128 * 1024 * 1024
 
 class WebService:
 
-    def __init__(self, datastore: Datastore, map_util: MapUtil):
+    def __init__(self, datastore: Datastore, map_util: MapUtil, render_cache_size: int = 64,
+                 tile_cache_dir: Optional[str] = None, router: Optional[Router] = None,
+                 matches: Optional[MatchStore] = None, profiler: Optional[RequestProfiler] = None):
         self.ds = datastore
         self.map = map_util
+        self.router = router
+        self.matches = matches
+        # Opt-in: dump profiles of slow requests
+        self.profiler = profiler
+        self.tiles = VectorTileCache(datastore, tile_cache_dir)
+        self.spatial = DatastoreIndex(datastore)
+        self.heatmap = HeatmapCache(datastore)
+        self.analytics = AnalyticsCache(datastore)
+        self.events = EventBroker(datastore)
         self.app = Flask(__name__)
         self.log = logging.getLogger(__name__)
+        # Rendered map HTML keyed by (dataset version, query parameters)
+        self.render_cache = LRUCache(render_cache_size)
+        # Compressed /api/track payloads keyed the same way, plus format, precision and encoding
+        self.track_cache = LRUCache(render_cache_size, max_bytes=TRACK_CACHE_BYTES)
+        # Dataset versions restart at 0 with the process, so ETags from an earlier run must not match
+        self._etag_salt = uuid.uuid4().hex
         self.register_routes()
         self.templates: dict = get_templates_from_json("templates/templates.json")
 
@@ -35,9 +79,23 @@ class WebService:
         if not self.app:
             raise Exception("Flask app not initialized.")
 
+        self.app.before_request(self.before_request)
+        self.app.after_request(self.after_request)
+        self.app.teardown_request(self.teardown_request)
+
         self.app.route('/')(self.index)
         self.app.route('/editor')(self.editor)
+        self.app.route('/tiles/<int:z>/<int:x>/<int:y>.mvt')(self.vector_tile)
+        self.app.route('/heatmap/<int:z>/<int:x>/<int:y>.png')(self.heatmap_tile)
         self.app.route('/save_manual_data', methods=['POST'])(self.save_manual_data)
+        self.app.route('/api/points')(self.api_points)
+        self.app.route('/api/track')(self.api_track)
+        self.app.route('/api/ingest', methods=['POST'])(self.api_ingest)
+        self.app.route('/api/export.<fmt>')(self.api_export)
+        self.app.route('/api/analytics')(self.api_analytics)
+        self.app.route('/api/route')(self.api_route)
+        self.app.route('/metrics')(self.metrics)
+        self.app.route('/events')(self.event_stream)
 
     def run(self, host: str) -> None:
         """
@@ -48,33 +106,462 @@ class WebService:
         do_log = True if self.log.getEffectiveLevel() <= logging.DEBUG else False
         self.app.run(host=host, debug=do_log)
 
-    def index(self) -> str:
+    def warmup(self) -> None:
+        """Pre-render the default map (the index page without parameters) into the render cache."""
+        started = time.perf_counter()
+        key, _ = self.map_request({})
+        with self.app.app_context():
+            self.render_cached(key)
+        self.log.info(f"Pre-rendered the default map in {time.perf_counter() - started:.2f}s")
+
+    def before_request(self) -> None:
+        g.request_started = time.perf_counter()
+        if self.profiler is not None:
+            g.profile = self.profiler.start()
+
+    def after_request(self, response: Response) -> Response:
+        """Record the request duration per route; streamed bodies are only timed until the handler returns."""
+        elapsed = time.perf_counter() - g.request_started
+        endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        HTTP_REQUEST_SECONDS.labels(endpoint).observe(elapsed)
+        HTTP_REQUESTS.labels(endpoint, response.status_code).inc()
+        self.log.debug(f"{request.method} {request.full_path} {response.status_code} in {elapsed:.3f}s")
+        return response
+
+    def teardown_request(self, exc: Optional[BaseException]) -> None:
+        """Stop the request's profiler; runs even if the handler raised and after_request was skipped."""
+        if self.profiler is not None:
+            self.profiler.stop(g.pop("profile", None), f"{request.method} {request.path}")
+
+    def metrics(self) -> Response:
+        """Prometheus metrics of the process."""
+        DB_QUEUE_DEPTH.set(self.ds.db_worker.queue_depth)
+        return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+    @staticmethod
+    def parse_window_args(args) -> Tuple[Optional[BoundingBox], Optional[str], Optional[str]]:
+        """
+        Read the viewport (min_lat, min_lon, max_lat, max_lon) and time window (start, end)
+        query parameters. The bounding box is only applied if all four values are given.
+        Raises ValueError on malformed values.
+        """
+        bbox_keys = ("min_lat", "min_lon", "max_lat", "max_lon")
+        bbox = None
+        if any(key in args for key in bbox_keys):
+            if not all(key in args for key in bbox_keys):
+                raise ValueError(f"Bounding box requires all of {', '.join(bbox_keys)}")
+            bbox = BoundingBox(*(float(args[key]) for key in bbox_keys))
+        return bbox, args.get("start"), args.get("end")
+
+    def etag_for(self, key: tuple) -> str:
+        """ETag of a cached render; it only depends on the cache key, so it can be checked without rendering."""
+        return hashlib.sha1(f"{self._etag_salt}:{key!r}".encode()).hexdigest()
+
+    def map_request(self, args) -> Tuple[tuple, str]:
+        """
+        Turn the index query parameters into the render cache key
+        (view, dataset version, bbox, start, end, zoom, tolerance) and its ETag. Raises ValueError on malformed values.
+        """
+        view = args.get("view", "map")
+        if view not in ("map", "clusters", "heatmap", "matched"):
+            raise ValueError(f"Unknown view {view}")
+        if view == "matched" and self.matches is None:
+            raise ValueError("No road graph loaded to match the track to")
+        bbox, start, end = self.parse_window_args(args)
+        zoom = int(args.get("zoom", DEFAULT_ZOOM))
+        tolerance = float(args["tolerance"]) if args.get("tolerance") else None
+        if view not in ("map", "matched"):
+            if start is not None or end is not None:
+                raise ValueError(f"The {view} view can't be limited to a time window")
+            tolerance = None
+        key = (view, self.ds.version, bbox, start, end, zoom, tolerance)
+        return key, self.etag_for(key)
+
+    @staticmethod
+    def revalidate(etag: str, build: Callable[[], Response]) -> Response:
+        """
+        A 304 if the client already has the ETag, else the response of build(). Either way browsers may keep
+        the response but have to revalidate it on every use.
+        """
+        response = Response(status=304) if etag in request.if_none_match else build()
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
+    def render_cached(self, key: tuple) -> str:
+        """Rendered index page for a key from map_request, served from the render cache when possible."""
+        render = {"map": self.render_map, "clusters": self.render_cluster_map, "heatmap": self.render_heat_map,
+                  "matched": self.render_matched_map}[key[0]]
+        return self.render_cache.get_or_compute(key, lambda: render(*key[1:]))
+
+    def index(self) -> Response:
         """
         Render the Folium map in the Flask app.
+        Accepts optional viewport (min_lat, min_lon, max_lat, max_lon) and time window (start, end) parameters,
+        the zoom level the track is simplified for (zoom) and the simplification tolerance in pixels (tolerance).
+        With view=clusters the points are drawn as cluster markers of the spatial index instead of a line,
+        with view=heatmap as a density heatmap and with view=matched snapped onto the roads of the loaded road graph.
+        Renders are cached per dataset version, and If-None-Match requests for an unchanged map get a 304.
+        With view=tiles a plain Leaflet map is served that loads the track as vector tiles instead,
+        with view=track one that loads it in the compact format of /api/track.
         """
+        if request.args.get("view") == "tiles":
+            return make_response(self.render_tile_view())
+        if request.args.get("view") == "track":
+            try:
+                return make_response(self.render_track_view(request.args))
+            except ValueError as e:
+                abort(400, description=str(e))
+
+        try:
+            key, etag = self.map_request(request.args)
+        except ValueError as e:
+            abort(400, description=str(e))
+
+        return self.revalidate(etag, lambda: make_response(self.render_cached(key)))
+
+    def render_tile_view(self) -> str:
+        """Index page variant that loads the track as vector tiles."""
+        return render_template(self.templates['index'], tile_view=True, center=self.default_center(), zoom=DEFAULT_ZOOM,
+                               events_url=self.events_url(self.ds.version))
+
+    def render_track_view(self, args) -> str:
+        """Index page variant that loads the track of the query window from /api/track."""
+        bbox, start, end = self.parse_window_args(args)
+        fmt = args.get("format", "varint")
+        if fmt not in WIRE_FORMATS:
+            raise ValueError(f"format must be one of {', '.join(WIRE_FORMATS)}")
+        precision = int(args.get("precision", DEFAULT_PRECISION))
+        if not 0 <= precision <= MAX_PRECISION:
+            raise ValueError(f"precision must be between 0 and {MAX_PRECISION}")
+        track_url = "/api/track?" + urlencode({key: value for key, value in args.items() if key != "view"})
+        # Like the folium map, only views without a time window follow new points
+        events_url = self.events_url(self.ds.version, bbox) if start is None and end is None else None
+        return render_template(self.templates['index'], track_url=track_url, track_format=fmt,
+                               track_precision=precision, center=self.default_center(),
+                               zoom=int(args.get("zoom", DEFAULT_ZOOM)), events_url=events_url)
+
+    def render_map(self, version: int, bbox: Optional[BoundingBox], start: Optional[str], end: Optional[str],
+                   zoom: int, tolerance: Optional[float]) -> str:
+        """Build the folium map for the given query window and render the index page around it."""
         # Fetch GPS data from the database
-        gps_data = self.ds.fetch_gps_data()
+        gps_data = self.ds.query_gps_data(bbox=bbox, start=start, end=end)
+
+        # Drop points that would not be visible at this zoom level
+        gps_data = self.map.simplify(gps_data, zoom=zoom, tolerance_px=tolerance,
+                                     cache_key=(version, bbox, start, end))
 
-        # Create the Folium map
-        folium_map = self.map.create_folium_map(gps_data)
+        # Open views follow new points, unless they show a time window the new points may not belong to
+        live_url = self.events_url(version, bbox) if start is None and end is None else None
 
-        if folium_map:
-            # Save the map to an HTML string
-            map_html = folium_map._repr_html_()
-        else:
-            map_html = "<p>No GPS data available.</p>"
+        # Create the Folium map and render it in the template
+        return self.render_folium("map", lambda: self.map.create_folium_map(gps_data, zoom_start=zoom,
+                                                                            live_url=live_url))
 
-        # Render the map in the template
+    def render_cluster_map(self, version: int, bbox: Optional[BoundingBox], start: Optional[str],
+                           end: Optional[str], zoom: int, tolerance: Optional[float]) -> str:
+        """Render the index page with the point clusters of the zoom level (render_map parameters)."""
+        return self.render_folium("clusters", lambda: self.map.create_cluster_map(self.spatial.clusters(zoom, bbox),
+                                                                                 zoom_start=zoom))
+
+    def render_heat_map(self, version: int, bbox: Optional[BoundingBox], start: Optional[str],
+                        end: Optional[str], zoom: int, tolerance: Optional[float]) -> str:
+        """Render the index page with a heatmap layer of the point density (render_map parameters)."""
+        return self.render_folium("heatmap", lambda: self.map.create_heat_map(self.heatmap.heat_points(zoom, bbox),
+                                                                             zoom_start=zoom))
+
+    def render_matched_map(self, version: int, bbox: Optional[BoundingBox], start: Optional[str],
+                           end: Optional[str], zoom: int, tolerance: Optional[float]) -> str:
+        """Render the index page with the track map-matched onto the road graph (render_map parameters)."""
+        # Matching is persisted per input track, so only the first render of a window does the work
+        gps_data = self.matches.get_or_match(self.ds.query_gps_data(bbox=bbox, start=start, end=end))
+        gps_data = self.map.simplify(gps_data, zoom=zoom, tolerance_px=tolerance,
+                                     cache_key=("matched", version, bbox, start, end))
+        return self.render_folium("matched", lambda: self.map.create_folium_map(gps_data, zoom_start=zoom))
+
+    def render_folium(self, view: str, build: Callable[[], Any]) -> str:
+        """Build a folium map, render the index page around it and record the build and serialization times."""
+        started = time.perf_counter()
+        folium_map = build()
+        built = time.perf_counter()
+        # Save the map to an HTML string
+        map_html = folium_map._repr_html_() if folium_map else "<p>No GPS data available.</p>"
+        serialized = time.perf_counter()
+        MAP_BUILD_SECONDS.labels(view).observe(built - started)
+        MAP_SERIALIZE_SECONDS.labels(view).observe(serialized - built)
+        self.log.debug(f"Built the {view} map in {built - started:.3f}s, serialized it in {serialized - built:.3f}s")
         return render_template(self.templates['index'], map_html=map_html)
 
+    def default_center(self) -> list:
+        """Map center for pages that load the track lazily: the first recorded point, if any."""
+        first = self.ds.first_gps_point()
+        return list(first) if first is not None else [37.7749, -122.4194]
+
+    def vector_tile(self, z: int, x: int, y: int) -> Response:
+        """Serve the GPS data of tile z/x/y as a Mapbox Vector Tile."""
+        def build():
+            try:
+                data = self.tiles.get_tile(z, x, y)
+            except ValueError as e:
+                abort(404, description=str(e))
+            return Response(data, mimetype="application/vnd.mapbox-vector-tile")
+
+        return self.revalidate(self.etag_for(("tile", self.ds.version, z, x, y)), build)
+
+    @staticmethod
+    def parse_page_args(args) -> Tuple[int, Optional[Tuple[str, int]]]:
+        """
+        Read the page size (limit) and the keyset cursor (after=<timestamp>,<id>) of a /api/points request.
+        Raises ValueError on malformed values.
+        """
+        limit = int(args.get("limit", DEFAULT_PAGE_SIZE))
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+        after = None
+        if args.get("after"):
+            timestamp, _, point_id = args["after"].rpartition(",")
+            if not timestamp:
+                raise ValueError("after must be <timestamp>,<id>")
+            after = (timestamp, int(point_id))
+        return limit, after
+
+    @staticmethod
+    def _iso_timestamp(value) -> str:
+        """Timestamps come back as strings from SQLite and as datetimes from PostgreSQL."""
+        if isinstance(value, datetime):
+            if value.tzinfo is not None:
+                value = value.astimezone(timezone.utc).replace(tzinfo=None)
+            return value.isoformat() + "Z"
+        return value
+
+    def api_points(self) -> Response:
+        """
+        Stream GPS points as NDJSON (format=ndjson, the default) or as a JSON document (format=json),
+        ordered by (timestamp, id). Accepts the viewport and time window parameters of the index page,
+        a page size (limit) and the cursor of the previous page (after).
+        The cursor of the next page is "<timestamp>,<id>" of the last point received; the JSON document
+        also carries it as "next" if the page is full. Points without a timestamp are not listed.
+        """
+        fmt = request.args.get("format", "ndjson")
+        if fmt not in ("ndjson", "json"):
+            abort(400, description="format must be ndjson or json")
+        try:
+            bbox, start, end = self.parse_window_args(request.args)
+            limit, after = self.parse_page_args(request.args)
+        except ValueError as e:
+            abort(400, description=str(e))
+
+        chunks = self.ds.iter_gps_rows(bbox=bbox, start=start, end=end, after=after, limit=limit)
+        if fmt == "ndjson":
+            return Response(self._ndjson_points(chunks), mimetype="application/x-ndjson")
+        return Response(self._json_points(chunks, limit), mimetype="application/json")
+
+    def api_ingest(self) -> Response:
+        """
+        Insert the points of a streamed NDJSON body (the format of /api/points, optionally gzip or deflate
+        Content-Encoding) in batches of batch_size while it is uploaded. Returns the ingest summary: accepted and
+        rejected counts, the first errors and the duration; with status 400 if the body was cut off or corrupt.
+        """
+        try:
+            batch_size = self.parse_batch_size(request.args)
+        except ValueError as e:
+            abort(400, description=str(e))
+        encoding = self.body_encoding(request.headers.get("Content-Encoding"), request.mimetype)
+        try:
+            summary = ingest_ndjson(self.ds, request.stream, encoding, batch_size)
+        except ValueError as e:
+            abort(415, description=str(e))
+        return make_response(jsonify(summary.as_dict()), 200 if summary.complete else 400)
+
+    @staticmethod
+    def parse_batch_size(args) -> int:
+        batch_size = int(args.get("batch_size", DEFAULT_BATCH_SIZE))
+        if not 1 <= batch_size <= MAX_BATCH_SIZE:
+            raise ValueError(f"batch_size must be between 1 and {MAX_BATCH_SIZE}")
+        return batch_size
+
+    @staticmethod
+    def body_encoding(content_encoding: Optional[str], mimetype: str) -> Optional[str]:
+        """Content-Encoding of an upload; a plain application/gzip upload counts as gzip encoded."""
+        if content_encoding is None and mimetype in ("application/gzip", "application/x-gzip"):
+            return "gzip"
+        return content_encoding
+
+    def api_track(self) -> Response:
+        """
+        The points in the viewport / time window (same parameters as the index page) as a compact track:
+        format=varint (binary, the default) or polyline (Google encoded polyline), rounded to precision decimals
+        (default 5, ~1 m). With zoom (and tolerance) the track is simplified like the folium map. The payload is
+        compressed with brotli or gzip if the client accepts it, cached per dataset version and revalidated by ETag.
+        """
+        fmt = request.args.get("format", "varint")
+        if fmt not in WIRE_FORMATS:
+            abort(400, description=f"format must be one of {', '.join(WIRE_FORMATS)}")
+        try:
+            bbox, start, end = self.parse_window_args(request.args)
+            precision = int(request.args.get("precision", DEFAULT_PRECISION))
+            if not 0 <= precision <= MAX_PRECISION:
+                raise ValueError(f"precision must be between 0 and {MAX_PRECISION}")
+            zoom = int(request.args["zoom"]) if request.args.get("zoom") else None
+            tolerance = float(request.args["tolerance"]) if request.args.get("tolerance") else None
+        except ValueError as e:
+            abort(400, description=str(e))
+
+        encoding = request.accept_encodings.best_match(available_encodings(), default="identity")
+        key = (self.ds.version, bbox, start, end, zoom, tolerance, fmt, precision)
+
+        def build():
+            data = self.track_cache.get_or_compute(key + (encoding,),
+                                                   lambda: compress(self.encode_track(*key), encoding))
+            response = Response(data, content_type=WIRE_FORMATS[fmt])
+            if encoding != "identity":
+                response.headers["Content-Encoding"] = encoding
+            return response
+
+        response = self.revalidate(self.etag_for(("track",) + key + (encoding,)), build)
+        response.headers["Vary"] = "Accept-Encoding"
+        return response
+
+    def encode_track(self, version: int, bbox: Optional[BoundingBox], start: Optional[str], end: Optional[str],
+                     zoom: Optional[int], tolerance: Optional[float], fmt: str, precision: int) -> bytes:
+        """Uncompressed /api/track payload of a query window."""
+        gps_data = self.ds.query_gps_data(bbox=bbox, start=start, end=end)
+        if zoom is not None:
+            gps_data = self.map.simplify(gps_data, zoom=zoom, tolerance_px=tolerance,
+                                         cache_key=(version, bbox, start, end))
+        if fmt == "polyline":
+            return encode_polyline(gps_data.latitude, gps_data.longitude, precision).encode("ascii")
+        return encode_varint(gps_data.latitude, gps_data.longitude, precision)
+
+    def _encode_points(self, rows) -> Tuple[list, Optional[str]]:
+        """JSON lines of a chunk of (id, latitude, longitude, elevation, timestamp) rows and the chunk's last cursor."""
+        lines = []
+        timestamp = None
+        for point_id, lat, lon, ele, ts in rows:
+            timestamp = self._iso_timestamp(ts)
+            lines.append(json.dumps({"id": point_id, "latitude": lat, "longitude": lon,
+                                     "elevation": ele, "timestamp": timestamp}))
+        return lines, f"{timestamp},{point_id}" if lines else None
+
+    def _ndjson_points(self, chunks) -> Iterator[str]:
+        for rows in chunks:
+            lines, _ = self._encode_points(rows)
+            yield "\n".join(lines) + "\n"
+
+    def _json_points(self, chunks, limit: int) -> Iterator[str]:
+        yield '{"points": ['
+        count = 0
+        cursor = None
+        for rows in chunks:
+            lines, cursor = self._encode_points(rows)
+            yield ("," if count else "") + ",".join(lines)
+            count += len(lines)
+        yield f'], "next": {json.dumps(cursor if count == limit else None)}}}'
+
+    def api_export(self, fmt: str) -> Response:
+        """
+        Stream gps_data as a Parquet, Arrow IPC stream or FlatGeobuf file (/api/export.parquet, .arrow, .fgb),
+        optionally limited by the viewport and time window parameters of the index page.
+        """
+        if fmt not in MIMETYPES:
+            abort(404, description=f"Unknown export format {fmt}")
+        try:
+            bbox, start, end = self.parse_window_args(request.args)
+        except ValueError as e:
+            abort(400, description=str(e))
+        tracks = self.ds.iter_gps_data(bbox=bbox, start=start, end=end)
+        response = Response(stream_export(tracks, fmt), mimetype=MIMETYPES[fmt])
+        response.headers["Content-Disposition"] = f"attachment; filename=gps_data.{fmt}"
+        return response
+
+    def heatmap_tile(self, z: int, x: int, y: int) -> Response:
+        """Serve the point density of tile z/x/y as a transparent PNG heatmap overlay."""
+        def build():
+            try:
+                data = self.heatmap.get_tile(z, x, y)
+            except ValueError as e:
+                abort(404, description=str(e))
+            return Response(data, mimetype="image/png")
+
+        return self.revalidate(self.etag_for(("heatmap", self.ds.version, z, x, y)), build)
+
+    def api_analytics(self) -> Response:
+        """
+        Distance, speed, elevation, stop and trip analysis of the points in the viewport / time window
+        (same parameters as the index page), cached per dataset version.
+        """
+        try:
+            bbox, start, end = self.parse_window_args(request.args)
+        except ValueError as e:
+            abort(400, description=str(e))
+        return jsonify(self.analytics.analyze(bbox=bbox, start=start, end=end))
+
+    def api_route(self) -> Response:
+        """
+        Route along the recorded points in the viewport / time window (same parameters as the index page)
+        on the local road graph, for mode=car (default), bicycle or foot. Returns the route as JSON, or 400 if the
+        window holds more than MAX_ROUTE_WAYPOINTS points.
+        """
+        if self.router is None:
+            abort(404, description="No road graph loaded")
+        mode = request.args.get("mode", "car")
+        if mode not in MODES:
+            abort(400, description=f"mode must be one of {', '.join(MODES)}")
+        try:
+            bbox, start, end = self.parse_window_args(request.args)
+        except ValueError as e:
+            abort(400, description=str(e))
+        track = self.ds.query_gps_data(bbox=bbox, start=start, end=end)
+        if len(track) > MAX_ROUTE_WAYPOINTS:
+            abort(400, description=f"{len(track)} points in the window, at most {MAX_ROUTE_WAYPOINTS} can be routed: "
+                                   f"narrow the viewport or time window")
+        return jsonify(self.router.route_track(track, mode).as_dict())
+
+    @staticmethod
+    def events_url(version: int, bbox: Optional[BoundingBox] = None) -> str:
+        """URL of the event stream for a page showing the data of the given version (and viewport)."""
+        args = {"since": version}
+        if bbox is not None:
+            args.update(min_lat=bbox.min_lat, min_lon=bbox.min_lon, max_lat=bbox.max_lat, max_lon=bbox.max_lon)
+        return f"/events?{urlencode(args)}"
+
+    @classmethod
+    def parse_event_args(cls, args, last_event_id: Optional[str]) -> Tuple[Optional[int], Optional[BoundingBox]]:
+        """Read the version (since, or the Last-Event-ID header) and viewport of an /events request."""
+        bbox, start, end = cls.parse_window_args(args)
+        if start is not None or end is not None:
+            raise ValueError("Live updates can't be limited to a time window")
+        since = last_event_id or args.get("since")
+        return int(since) if since else None, bbox
+
+    def event_stream(self) -> Response:
+        """
+        Server-Sent Events stream of the points inserted after dataset version since, optionally only those in
+        the viewport (min_lat, min_lon, max_lat, max_lon). A reconnecting client resumes after its Last-Event-ID.
+        """
+        try:
+            since, bbox = self.parse_event_args(request.args, request.headers.get("Last-Event-ID"))
+        except ValueError as e:
+            abort(400, description=str(e))
+        response = Response(self.events.stream(since, bbox), mimetype="text/event-stream")
+        response.headers["Cache-Control"] = "no-cache"
+        # Don't let nginx buffer the stream
+        response.headers["X-Accel-Buffering"] = "no"
+        return response
+
     def editor(self):
         """Render the manual map editor page."""
-        # Remove Folium map initialization here
-        return render_template(self.templates['editor'])  # No map_html passed
+        # Existing data is shown as vector tiles, no folium map needed
+        return render_template(self.templates['editor'], center=self.default_center(), zoom=DEFAULT_ZOOM,
+                               events_url=self.events_url(self.ds.version))
 
     def save_manual_data(self):
         """Save manually added markers to the database."""
-        data = request.get_json()
+        status = self.save_points(request.get_json())
+        return jsonify(status)
+
+    def save_points(self, data: dict) -> dict:
+        """Store the points of a save_manual_data payload, optionally replacing all existing data."""
         overwrite = data.get('overwrite', False)
 
         try:
@@ -86,8 +573,8 @@ class WebService:
             points = [GeoPoint.from_dict(point) for point in data['points']]
             self.ds.insert_points(points)
 
-            return jsonify({"status": "success"})
+            return {"status": "success"}
         except Exception as e:
             self.ds.revert()
             self.log.error(f"Failed to save manual data", exc_info=True)
-            return jsonify({"status": "error", "message": str(e)})
\ No newline at end of file
+            return {"status": "error", "message": str(e)}
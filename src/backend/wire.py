@@ -0,0 +1,152 @@
+"""
+Description:
+    Compact encodings of track coordinates for the browser (/api/track), in place of JavaScript number literals.
+    Coordinates are rounded to 10^-precision degrees and sent as differences to the previous point, which are
+    small numbers for consecutive GPS fixes:
+        - varint: binary, the zigzag encoded differences as LEB128 varints (lat, lon interleaved), after a header
+          of two varints, the precision and the point count.
+        - polyline: text, the Google encoded polyline algorithm format, readable by most mapping libraries.
+    The payload is compressed with the best encoding the client accepts (brotli if installed, gzip).
+    The browser side decoder is templates/track_decoder.js.
+
+Dependencies:
+    - brotli, optional, only to serve brotli compressed payloads:
+        pip install brotli
+
+Docs:
+    Encoded polyline: https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+    Varints: https://protobuf.dev/programming-guides/encoding/#varints
+"""
+import gzip
+from typing import List, Tuple
+
+import numpy as np
+
+FORMATS = {"varint": "application/octet-stream", "polyline": "text/plain; charset=ascii"}
+DEFAULT_PRECISION = 5
+# 10^-6 degrees is ~11 cm; the differences of coarser positions also stay within the 32 bit integers of
+# the JavaScript decoder
+MAX_PRECISION = 6
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def _brotli():
+    # Optional: without it, clients asking for br get gzip
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def _deltas(latitude: np.ndarray, longitude: np.ndarray, precision: int) -> np.ndarray:
+    """Interleaved (lat, lon) differences of the rounded coordinates, the first point relative to 0, 0."""
+    if not 0 <= precision <= MAX_PRECISION:
+        raise ValueError(f"precision must be between 0 and {MAX_PRECISION}")
+    scale = 10 ** precision
+    lat = np.rint(np.asarray(latitude, dtype=np.float64) * scale).astype(np.int64)
+    lon = np.rint(np.asarray(longitude, dtype=np.float64) * scale).astype(np.int64)
+    return np.column_stack((np.diff(lat, prepend=0), np.diff(lon, prepend=0))).ravel()
+
+
+def _coordinates(deltas: np.ndarray, precision: int) -> Tuple[np.ndarray, np.ndarray]:
+    if len(deltas) % 2:
+        raise ValueError("Odd number of coordinate values")
+    pairs = np.cumsum(deltas.reshape(-1, 2), axis=0) / 10 ** precision
+    return pairs[:, 0], pairs[:, 1]
+
+
+def _zigzag(values: np.ndarray) -> np.ndarray:
+    # Small negative numbers become small positive ones: 0, -1, 1, -2 -> 0, 1, 2, 3
+    return ((values << 1) ^ (values >> 63)).astype(np.uint64)
+
+
+def _unzigzag(values: np.ndarray) -> np.ndarray:
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+
+
+def _pack(values: np.ndarray, bits: int, continuation: int) -> np.ndarray:
+    """
+    Split unsigned values into groups of bits, least significant first, one byte each; all but the last
+    group of a value have the continuation bit set. Vectorized over the values, looping over group positions.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(bits)
+    while rest.any():
+        lengths += rest > 0
+        rest >>= np.uint64(bits)
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    out = np.zeros(int(ends[-1]) if len(values) else 0, dtype=np.uint8)
+    mask = np.uint64((1 << bits) - 1)
+    for k in range(int(lengths.max()) if len(values) else 0):
+        has = lengths > k
+        group = ((values[has] >> np.uint64(bits * k)) & mask).astype(np.uint8)
+        more = (lengths[has] > k + 1).astype(np.uint8) * np.uint8(continuation)
+        out[starts[has] + k] = group | more
+    return out
+
+
+def _unpack(data: np.ndarray, bits: int, continuation: int) -> np.ndarray:
+    """Inverse of _pack. Raises ValueError if the last value is cut off."""
+    if len(data) == 0:
+        return np.empty(0, dtype=np.uint64)
+    last = (data & continuation) == 0
+    if not last[-1]:
+        raise ValueError("Truncated value")
+    ends = np.flatnonzero(last)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    value_index = np.concatenate(([0], np.cumsum(last)[:-1]))
+    position = np.arange(len(data)) - starts[value_index]
+    groups = (data & (continuation - 1)).astype(np.uint64) << (position * bits).astype(np.uint64)
+    return np.bitwise_or.reduceat(groups, starts)
+
+
+def encode_varint(latitude: np.ndarray, longitude: np.ndarray, precision: int = DEFAULT_PRECISION) -> bytes:
+    """Binary varint encoding of a track's coordinates (see the module docstring)."""
+    header = _pack(np.array([precision, len(latitude)], dtype=np.uint64), 7, 0x80)
+    return header.tobytes() + _pack(_zigzag(_deltas(latitude, longitude, precision)), 7, 0x80).tobytes()
+
+
+def decode_varint(data: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    """Latitudes and longitudes of an encode_varint payload. Raises ValueError if it is malformed."""
+    values = _unpack(np.frombuffer(data, dtype=np.uint8), 7, 0x80)
+    if len(values) < 2 or len(values) != 2 + 2 * int(values[1]):
+        raise ValueError("Point count does not match the payload")
+    return _coordinates(_unzigzag(values[2:]), int(values[0]))
+
+
+def encode_polyline(latitude: np.ndarray, longitude: np.ndarray, precision: int = DEFAULT_PRECISION) -> str:
+    """Google encoded polyline of a track's coordinates; precision 5 is the format's usual precision."""
+    # 5 bit groups with 0x20 as continuation bit, shifted into printable ASCII by 63
+    packed = _pack(_zigzag(_deltas(latitude, longitude, precision)), 5, 0x20) + np.uint8(63)
+    return packed.tobytes().decode("ascii")
+
+
+def decode_polyline(text: str, precision: int = DEFAULT_PRECISION) -> Tuple[np.ndarray, np.ndarray]:
+    """Latitudes and longitudes of an encoded polyline. Raises ValueError if it is malformed."""
+    data = np.frombuffer(text.encode("ascii"), dtype=np.uint8)
+    if np.any((data < 63) | (data > 126)):
+        raise ValueError("Invalid polyline character")
+    return _coordinates(_unzigzag(_unpack(data - np.uint8(63), 5, 0x20)), precision)
+
+
+def available_encodings() -> List[str]:
+    """Content-Encodings compress supports, preferred first."""
+    return (["br"] if _brotli() is not None else []) + ["gzip"]
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """Compress a payload for the negotiated Content-Encoding (br, gzip or identity)."""
+    if encoding == "br":
+        brotli = _brotli()
+        if brotli is None:
+            raise RuntimeError("brotli compression needs brotli: pip install brotli")
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+    if encoding == "identity":
+        return data
+    raise ValueError(f"Unsupported encoding {encoding}")
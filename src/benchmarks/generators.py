@@ -0,0 +1,83 @@
+from typing import Iterable, Iterator, Union
+
+import numpy as np
+import pandas as pd
+
+from backend.track import Track, to_iso_strings
+
+# Zurich main station
+START_LAT = 47.3779
+START_LON = 8.5403
+START_TIME = 1_700_000_000
+EARTH_RADIUS_M = 6_371_008.8
+# Points generated (and written) at a time, keeps memory flat for 10M point files
+CHUNK_POINTS = 1_000_000
+
+
+def iter_random_walk(n: int, seed: int = 0, step_m: float = 5.0, interval_s: int = 1,
+                     chunk_size: int = CHUNK_POINTS) -> Iterator[Track]:
+    """
+    Synthetic track of n points in chunks of up to chunk_size: a walk with a slowly drifting heading, one point
+    every interval_s seconds about step_m meters apart, with a smooth elevation profile.
+    Deterministic for a given seed, whatever the chunk size.
+    """
+    # One random stream per quantity, so the values don't depend on how they are split into chunks
+    heading_rng, step_rng, elevation_rng = (np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(3))
+    heading = north = east = elevation = 0.0
+    for first in range(0, n, chunk_size):
+        size = min(chunk_size, n - first)
+        headings = heading + np.cumsum(heading_rng.normal(0.0, 0.1, size))
+        step = step_m * step_rng.uniform(0.5, 1.5, size)
+        norths = north + np.cumsum(step * np.cos(headings))
+        easts = east + np.cumsum(step * np.sin(headings))
+        elevations = elevation + np.cumsum(elevation_rng.normal(0.0, 0.2, size))
+        heading, north, east, elevation = headings[-1], norths[-1], easts[-1], elevations[-1]
+        latitude = START_LAT + np.degrees(norths / EARTH_RADIUS_M)
+        longitude = START_LON + np.degrees(easts / (EARTH_RADIUS_M * np.cos(np.radians(latitude))))
+        timestamp = START_TIME + np.arange(first, first + size, dtype=np.int64) * interval_s
+        yield Track(latitude, longitude, 400.0 + elevations, timestamp)
+
+
+def random_walk(n: int, seed: int = 0, step_m: float = 5.0, interval_s: int = 1) -> Track:
+    """The whole iter_random_walk track in memory."""
+    track = Track()
+    for chunk in iter_random_walk(n, seed, step_m, interval_s):
+        track.append(chunk)
+    return track
+
+
+def iter_chunks(track: Track, size: int = CHUNK_POINTS) -> Iterator[Track]:
+    for first in range(0, len(track), size):
+        yield track[first:first + size]
+
+
+def _chunks(track: Union[Track, Iterable[Track]]) -> Iterable[Track]:
+    return iter_chunks(track) if isinstance(track, Track) else track
+
+
+def write_csv(track: Union[Track, Iterable[Track]], path: str) -> None:
+    """
+    Write a track, or the chunks of one (see iter_random_walk), as a CSV file with a
+    latitude,longitude,elevation,timestamp header.
+    """
+    with open(path, "w", newline="") as f:
+        for i, chunk in enumerate(_chunks(track)):
+            pd.DataFrame({
+                "latitude": chunk.latitude, "longitude": chunk.longitude,
+                "elevation": chunk.elevation, "timestamp": to_iso_strings(chunk.timestamp),
+            }).to_csv(f, index=False, header=i == 0)
+
+
+def write_gpx(track: Union[Track, Iterable[Track]], path: str) -> None:
+    """Write a track, or the chunks of one, as a GPX 1.1 file with a single track segment."""
+    with open(path, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<gpx version="1.1" creator="benchmarks" xmlns="http://www.topografix.com/GPX/1/1">\n'
+                '<trk><trkseg>\n')
+        for chunk in _chunks(track):
+            f.writelines(
+                f'<trkpt lat="{lat:.7f}" lon="{lon:.7f}"><ele>{ele:.1f}</ele><time>{ts}</time></trkpt>\n'
+                for lat, lon, ele, ts in zip(chunk.latitude.tolist(), chunk.longitude.tolist(),
+                                             chunk.elevation.tolist(), to_iso_strings(chunk.timestamp).tolist())
+            )
+        f.write('</trkseg></trk>\n</gpx>\n')
@@ -0,0 +1,435 @@
+"""
+Description:
+    Benchmarks of the ingest, query and render hot paths on synthetic tracks (see generators.py), against SQLite,
+    and of the startup time of the server in a fresh interpreter.
+    Every benchmark is a generator: the code before its yield is untimed setup, the yielded callable is timed,
+    the code after the yield cleans up. Each benchmark runs --repeat times per size; the median and the
+    fastest run are reported along with the throughput in points/sec.
+    Results can be saved as a baseline JSON file, and a later run can be compared against it: benchmarks
+    whose median got slower than the baseline by more than --threshold are reported as regressions and the
+    run exits with status 1.
+
+    Run from the src directory:
+        python -m benchmarks.run --sizes 10k,1m --save baseline.json
+        python -m benchmarks.run --sizes 10k,1m --compare baseline.json
+
+    Note: timings depend on the machine, only compare runs made on the same one.
+
+Dependencies:
+    - numpy, pandas, folium, Flask, SQLAlchemy (see requirements.txt)
+
+Docs:
+    - asv, which the baseline / compare workflow follows: https://asv.readthedocs.io/
+"""
+import gc
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Sequence
+
+from backend.datastore import Datastore, SQLiteBackend
+from backend.map import MapUtil
+from backend.track import Track
+from backend.webservice import WebService
+from .generators import iter_chunks, iter_random_walk, random_walk, write_csv, write_gpx
+
+SIZES = (10_000, 1_000_000, 10_000_000)
+DEFAULT_REPEAT = 3
+# A benchmark counts as regressed if its median is this much slower than the baseline
+DEFAULT_THRESHOLD = 0.2
+SIZE_SUFFIXES = {"k": 1_000, "m": 1_000_000}
+
+# The src directory, put on the path of the startup benchmark processes
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name -> (benchmark, largest size it runs at or None, whether it depends on the size)
+BENCHMARKS: Dict[str, tuple] = {}
+
+
+def benchmark(name: str, max_points: Optional[int] = None, sized: bool = True) -> Callable:
+    """
+    Register a benchmark. Sizes above max_points are skipped, e.g. where the result would not fit in memory.
+    Benchmarks that don't depend on the data (sized=False) only run once, and are reported with 0 points.
+    """
+    def register(func: Callable[['Workspace'], Iterator[Callable[[], Any]]]):
+        BENCHMARKS[name] = (func, max_points, sized)
+        return func
+    return register
+
+
+class Result(NamedTuple):
+    name: str
+    points: int
+    repeat: int
+    median_s: float
+    min_s: float
+
+    @property
+    def points_per_s(self) -> float:
+        return self.points / self.median_s if self.median_s > 0 else 0.0
+
+    def as_dict(self) -> dict:
+        return {**self._asdict(), "points_per_s": self.points_per_s}
+
+
+class Workspace:
+    """Synthetic data of one size, generated on first use and shared by the benchmarks of that size"""
+
+    def __init__(self, directory: str, points: int):
+        self.directory = directory
+        self.points = points
+        self._track: Optional[Track] = None
+        self._files: Dict[str, str] = {}
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    @property
+    def track(self) -> Track:
+        """The whole track in memory, only for benchmarks that need it; the files are written chunk by chunk."""
+        if self._track is None:
+            self._track = random_walk(self.points)
+        return self._track
+
+    def chunks(self) -> Iterator[Track]:
+        """The track in chunks, from memory if it was already generated."""
+        return iter_chunks(self._track) if self._track is not None else iter_random_walk(self.points)
+
+    def _file(self, name: str, write: Callable[[str], None]) -> str:
+        if name not in self._files:
+            write(self.path(name))
+            self._files[name] = self.path(name)
+        return self._files[name]
+
+    @property
+    def database(self) -> str:
+        """SQLite database holding the track; only read by the benchmarks."""
+        def write(path: str) -> None:
+            ds = open_datastore(path)
+            for chunk in self.chunks():
+                ds.insert_points(chunk)
+            ds.close()
+        return self._file("filled.db", write)
+
+    @property
+    def csv_file(self) -> str:
+        return self._file("track.csv", lambda path: write_csv(self.chunks(), path))
+
+    @property
+    def gpx_file(self) -> str:
+        return self._file("track.gpx", lambda path: write_gpx(self.chunks(), path))
+
+    def empty_database(self) -> str:
+        """Path of a new database with the schema but no points."""
+        path = self.path("empty.db")
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        SQLiteBackend(db_path=path).close_and_cleanup()
+        return path
+
+
+def open_datastore(path: str) -> Datastore:
+    return Datastore(lambda: SQLiteBackend(db_path=path), batch_size=100_000)
+
+
+@benchmark("datastore.insert_points")
+def bench_insert_points(work: Workspace) -> Iterator[Callable[[], Any]]:
+    track = work.track
+    ds = open_datastore(work.empty_database())
+
+    def run():
+        for chunk in iter_chunks(track):
+            ds.insert_points(chunk)
+        ds.flush()
+    yield run
+    ds.close()
+
+
+@benchmark("datastore.fetch_gps_data")
+def bench_fetch_gps_data(work: Workspace) -> Iterator[Callable[[], Any]]:
+    # A new datastore each time, so the points come from the database and not from the cache
+    ds = open_datastore(work.database)
+    yield ds.fetch_gps_data
+    ds.close()
+
+
+@benchmark("map.create_folium_map", max_points=1_000_000)
+def bench_create_folium_map(work: Workspace) -> Iterator[Callable[[], Any]]:
+    # Includes rendering to HTML, that is where folium spends most of its time
+    track = work.track
+    yield lambda: MapUtil.create_folium_map(track)._repr_html_()
+
+
+@benchmark("webservice.index")
+def bench_index(work: Workspace) -> Iterator[Callable[[], Any]]:
+    # Cold render: new datastore, simplification and render caches
+    ds = open_datastore(work.database)
+    client = WebService(ds, MapUtil()).app.test_client()
+
+    def run():
+        response = client.get("/")
+        assert response.status_code == 200, response.status
+    yield run
+    ds.close()
+
+
+@benchmark("webservice.track")
+def bench_track(work: Workspace) -> Iterator[Callable[[], Any]]:
+    # Cold encode and gzip of the full track, the compact alternative to the rendered map
+    ds = open_datastore(work.database)
+    client = WebService(ds, MapUtil()).app.test_client()
+
+    def run():
+        response = client.get("/api/track", headers={"Accept-Encoding": "gzip"})
+        assert response.status_code == 200, response.status
+    yield run
+    ds.close()
+
+
+@benchmark("import.csv")
+def bench_import_csv(work: Workspace) -> Iterator[Callable[[], Any]]:
+    from scripts.import_data_CSV import import_data
+    csv_file = work.csv_file
+    db_url = f"sqlite:///{work.empty_database()}"
+
+    def run():
+        imported, rejected = import_data(csv_file, db_url=db_url)
+        assert imported == work.points and rejected == 0, (imported, rejected)
+    yield run
+
+
+@benchmark("import.gpx")
+def bench_import_gpx(work: Workspace) -> Iterator[Callable[[], Any]]:
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import scoped_session, sessionmaker
+    from scripts import import_data_GPX
+    gpx_file = work.gpx_file
+    engine = create_engine(f"sqlite:///{work.empty_database()}")
+    session = scoped_session(sessionmaker(bind=engine))
+
+    def run():
+        imported = import_data_GPX.import_gpx(gpx_file, session=session)
+        assert imported == work.points, imported
+    yield run
+    session.remove()
+    engine.dispose()
+
+
+def run_python(code: str) -> None:
+    """Run code in a fresh interpreter with the backend on its path, like a restarted server."""
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, (SRC_DIR, os.environ.get("PYTHONPATH"))))}
+    subprocess.run([sys.executable, "-c", code], env=env, check=True)
+
+
+@benchmark("startup.import", sized=False)
+def bench_startup_import(work: Workspace) -> Iterator[Callable[[], Any]]:
+    # Interpreter start and import of the server entry point
+    yield lambda: run_python("import backend.main")
+
+
+@benchmark("startup.first_request")
+def bench_startup_first_request(work: Workspace) -> Iterator[Callable[[], Any]]:
+    # Time to the first rendered map of a restarted server: imports, opening the database, loading and rendering
+    code = (
+        "from backend.datastore import Datastore, SQLiteBackend\n"
+        "from backend.map import MapUtil\n"
+        "from backend.webservice import WebService\n"
+        f"ds = Datastore(lambda: SQLiteBackend(db_path={work.database!r}))\n"
+        "assert WebService(ds, MapUtil()).app.test_client().get('/').status_code == 200\n"
+        "ds.close()\n"
+    )
+    yield lambda: run_python(code)
+
+
+def measure(func: Callable[['Workspace'], Iterator[Callable[[], Any]]], work: Workspace, repeat: int) -> List[float]:
+    """Run a benchmark repeat times and return the durations of the timed parts in seconds."""
+    timings = []
+    for _ in range(repeat):
+        steps = func(work)
+        timed = next(steps)
+        gc.collect()
+        try:
+            start = time.perf_counter()
+            timed()
+            timings.append(time.perf_counter() - start)
+        finally:
+            # Run the cleanup after the yield, also if the timed call failed
+            next(steps, None)
+    return timings
+
+
+def run_benchmarks(sizes: Sequence[int] = SIZES, names: Optional[Sequence[str]] = None, repeat: int = DEFAULT_REPEAT,
+                   workdir: Optional[str] = None) -> List[Result]:
+    """Run the selected benchmarks (all by default) at every size, with synthetic data below workdir."""
+    log = logging.getLogger(__name__)
+    names = list(names or BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        raise ValueError(f"Unknown benchmarks: {', '.join(unknown)}")
+    results = []
+    for points in sizes:
+        directory = tempfile.mkdtemp(prefix=f"bench-{points}-", dir=workdir)
+        try:
+            work = Workspace(directory, points)
+            for name in names:
+                func, max_points, sized = BENCHMARKS[name]
+                if not sized and points != sizes[0]:
+                    continue
+                if max_points is not None and points > max_points:
+                    log.info(f"Skipping {name} at {points} points (limit {max_points})")
+                    continue
+                timings = measure(func, work, repeat)
+                result = Result(name, points if sized else 0, repeat, statistics.median(timings), min(timings))
+                log.info(f"{name} [{points}]: {result.median_s:.4f}s ({result.points_per_s:.0f} points/sec)")
+                results.append(result)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def save_results(results: Sequence[Result], path: str) -> None:
+    data = {
+        "created": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": [result.as_dict() for result in results],
+    }
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+
+
+def load_results(path: str) -> Dict[tuple, dict]:
+    """Results of a saved run, keyed by (name, points)."""
+    with open(path) as f:
+        return {(r["name"], r["points"]): r for r in json.load(f)["results"]}
+
+
+def compare(results: Sequence[Result], baseline: Dict[tuple, dict],
+            threshold: float = DEFAULT_THRESHOLD) -> List[Dict[str, Any]]:
+    """
+    Median of every result relative to the baseline (ratio > 1 is slower). Rows are marked as regressions
+    if the ratio exceeds 1 + threshold; results without a baseline have ratio None.
+    """
+    rows = []
+    for result in results:
+        base = baseline.get((result.name, result.points))
+        ratio = result.median_s / base["median_s"] if base and base["median_s"] > 0 else None
+        rows.append({"name": result.name, "points": result.points, "median_s": result.median_s,
+                     "baseline_s": base["median_s"] if base else None, "ratio": ratio,
+                     "regression": ratio is not None and ratio > 1 + threshold})
+    return rows
+
+
+def format_table(results: Sequence[Result], comparison: Optional[Sequence[Dict[str, Any]]] = None) -> str:
+    lines = [f"{'benchmark':<28} {'points':>10} {'median s':>10} {'min s':>10} {'points/s':>12}"
+             + (f" {'baseline s':>10} {'change':>8}" if comparison else "")]
+    for i, result in enumerate(results):
+        line = (f"{result.name:<28} {result.points:>10} {result.median_s:>10.4f} {result.min_s:>10.4f} "
+                f"{result.points_per_s:>12.0f}")
+        if comparison:
+            row = comparison[i]
+            if row["ratio"] is None:
+                line += f" {'-':>10} {'new':>8}"
+            else:
+                line += f" {row['baseline_s']:>10.4f} {row['ratio'] - 1:>+8.1%}" + ("  REGRESSION" if row["regression"] else "")
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def parse_size(value: str) -> int:
+    """Parse a point count like 10000, 10k or 1m."""
+    value = value.strip().lower()
+    factor = SIZE_SUFFIXES.get(value[-1:], 1)
+    number = value[:-1] if value[-1:] in SIZE_SUFFIXES else value
+    if not number.isdigit() or int(number) < 1:
+        raise ValueError(f"Invalid size '{value}'")
+    return int(number) * factor
+
+
+def validate_arguments(args: Sequence[str]) -> dict:
+    """Validate command-line arguments and return the options."""
+    options = {"sizes": list(SIZES), "names": None, "repeat": DEFAULT_REPEAT, "workdir": None, "save": None,
+               "compare": None, "threshold": DEFAULT_THRESHOLD, "verbose": False}
+    i = 1
+    while i < len(args):
+        arg = args[i].lower()
+        if arg == "--help":
+            print_help()
+            sys.exit(0)
+        elif arg == "--verbose":
+            options["verbose"] = True
+        elif arg in ("--sizes", "--only", "--repeat", "--workdir", "--save", "--compare", "--threshold"):
+            if i + 1 >= len(args):
+                logging.error(f"Error: {arg} requires a value.")
+                sys.exit(1)
+            value = args[i + 1]
+            try:
+                if arg == "--sizes":
+                    options["sizes"] = [parse_size(v) for v in value.split(",")]
+                elif arg == "--only":
+                    options["names"] = [v.strip() for v in value.split(",")]
+                elif arg == "--repeat":
+                    if not value.isdigit() or int(value) < 1:
+                        raise ValueError("must be a positive number")
+                    options["repeat"] = int(value)
+                elif arg == "--threshold":
+                    options["threshold"] = float(value)
+                else:
+                    options[arg[2:]] = value
+            except ValueError as e:
+                logging.error(f"Error: Invalid value for {arg}: {e}")
+                sys.exit(1)
+            i += 1
+        else:
+            logging.error(f"Error: Invalid argument '{args[i]}'.")
+            print_help()
+            sys.exit(1)
+        i += 1
+    return options
+
+
+def print_help():
+    """Display usage instructions."""
+    print("Usage: python -m benchmarks.run [--sizes <n,...>] [--only <name,...>] [--repeat <n>] [--workdir <dir>] "
+          "[--save <file>] [--compare <file>] [--threshold <fraction>] [--verbose] [--help]")
+    print("\nOptions:")
+    print("  --sizes      Track sizes to run at, e.g. 10k,1m (default: 10k,1m,10m).")
+    print(f"  --only       Run only these benchmarks: {', '.join(BENCHMARKS)}.")
+    print(f"  --repeat     Runs per benchmark and size (default: {DEFAULT_REPEAT}).")
+    print("  --workdir    Directory for the synthetic databases and files (default: the system temp directory).")
+    print("  --save       Save the results as a baseline JSON file.")
+    print("  --compare    Compare the results with a saved baseline, exit with status 1 on regressions.")
+    print(f"  --threshold  Slowdown of the median counted as regression (default: {DEFAULT_THRESHOLD}).")
+    print("  --verbose    Log every result as it is measured.")
+    print("  --help       Display this help message and exit.")
+
+
+def main(args: Sequence[str]) -> int:
+    options = validate_arguments(args)
+    logging.basicConfig(level=logging.INFO if options["verbose"] else logging.WARNING,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        results = run_benchmarks(options["sizes"], options["names"], options["repeat"], options["workdir"])
+    except ValueError as e:
+        logging.error(f"Error: {e}")
+        return 1
+    comparison = None
+    if options["compare"]:
+        comparison = compare(results, load_results(options["compare"]), options["threshold"])
+    print(format_table(results, comparison))
+    if options["save"]:
+        save_results(results, options["save"])
+    return 1 if comparison and any(row["regression"] for row in comparison) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
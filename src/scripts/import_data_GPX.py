@@ -1,22 +1,26 @@
 """
 Author: Frederik Sinniger
 Date Created: 23.02.2025
-Version: 0.0.1
+Version: 0.0.2
 
 Description:
     Data Import Script for GPX files.
     This script imports GPS data from one or more GPX files into a PostgreSQL database.
+    GPX files are parsed as a stream (iterparse), so memory use does not depend on the file size.
+    Multiple files are parsed in parallel by a process pool; the parsed points are passed in batches
+    through a bounded queue to a single database writer, which loads them with COPY (PostgreSQL)
+    or executemany (other databases).
     The script can be run from the command line with the following options:
     - Specify one or more GPX files to import.
     - Specify a folder containing GPX files to import all files in the folder and its subfolders.
     - Use the --override flag to delete existing data in the database before import.
     - Use the --dry-run flag to simulate the import without making changes to the database.
     - Use the --verbose flag to display detailed progress and debugging information.
+    - Use the --workers option to set the number of parser processes (default: number of CPUs).
+    - Use the --batch-size option to set the number of points written per database round trip.
     - Use the --help flag to display usage instructions.
 
 Dependencies:
-    - gpxpy:
-        pip install gpxpy
     - tqdm:
         pip install tqdm
     - SQLAlchemy:
@@ -24,15 +28,21 @@ Dependencies:
 
 Docs:
     - GPX file format: https://www.topografix.com/gpx.asp
-    - gpxpy documentation:
+    - iterparse: https://docs.python.org/3/library/xml.etree.elementtree.html#xml.etree.ElementTree.iterparse
 """
 
-import gpxpy
-import gpxpy.gpx
-from sqlalchemy import create_engine, text
+import xml.etree.ElementTree as ET
+import csv
+import io
+from sqlalchemy import create_engine, text, insert
+from sqlalchemy.sql import table, column
 from sqlalchemy.orm import scoped_session, sessionmaker
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import queue
 import sys
 import os
+import time
 import logging
 from tqdm import tqdm  # For progress bar
 
@@ -43,67 +53,241 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 engine = create_engine('postgresql://localhost/geolocation_db')
 db = scoped_session(sessionmaker(bind=engine))
 
-def import_gpx(file_path, override=False, dry_run=False, verbose=False):
+gps_data = table("gps_data", column("latitude"), column("longitude"), column("elevation"), column("timestamp"))
+
+DEFAULT_BATCH_SIZE = 5000
+# Maximum number of parsed batches waiting for the database writer
+QUEUE_SIZE = 32
+
+# Queue and stop flag shared with the parser processes, set by _init_worker
+_batch_queue = None
+_stop_event = None
+
+
+class MalformedGPXError(ValueError):
+    """A track point of a GPX file has a value that is not a number."""
+
+
+def _local_name(tag):
+    """Strip the XML namespace from a tag ('{http://www.topografix.com/GPX/1/1}trkpt' -> 'trkpt')."""
+    return tag.rsplit('}', 1)[-1]
+
+
+def iter_gpx_points(file_path, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Stream the track points of a GPX file.
+    Yields lists of up to batch_size dicts with latitude, longitude, elevation and timestamp.
+    Processed elements are dropped from the tree right away, so memory stays flat for large files.
+    Raises ET.ParseError for broken XML and MalformedGPXError for coordinates or elevations that are not numbers.
+    """
+    batch = []
+    parents = []
+    for event, elem in ET.iterparse(file_path, events=("start", "end")):
+        if event == "start":
+            parents.append(elem)
+            continue
+        parents.pop()
+        if _local_name(elem.tag) != "trkpt":
+            continue
+
+        elevation = None
+        timestamp = None
+        try:
+            for child in elem:
+                name = _local_name(child.tag)
+                if name == "ele" and child.text:
+                    elevation = float(child.text)
+                elif name == "time" and child.text:
+                    timestamp = child.text.strip()
+            point = {
+                "latitude": float(elem.get("lat")),
+                "longitude": float(elem.get("lon")),
+                "elevation": elevation,
+                "timestamp": timestamp
+            }
+        except (TypeError, ValueError) as e:
+            raise MalformedGPXError(f"Malformed track point in {file_path}: {e}") from e
+        batch.append(point)
+        # The point is the only remaining child of its segment, so removing it is cheap
+        if parents:
+            parents[-1].remove(elem)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def insert_batch(batch, session=None):
+    """
+    Write one batch of points in a single round trip: COPY on PostgreSQL, executemany elsewhere.
+    session is the SQLAlchemy session to write through, by default the module's db.
+    """
+    session = session or db
+    if session.get_bind().dialect.name == "postgresql":
+        buffer = io.StringIO()
+        # Unquoted empty fields are NULL in COPY's csv format
+        csv.writer(buffer).writerows((p["latitude"], p["longitude"], p["elevation"], p["timestamp"]) for p in batch)
+        buffer.seek(0)
+        # The session's connection, so the COPY is part of its transaction
+        cursor = session.connection().connection.cursor()
+        cursor.copy_expert("COPY gps_data (latitude, longitude, elevation, timestamp) FROM STDIN WITH (FORMAT csv)",
+                           buffer)
+    else:
+        session.execute(insert(gps_data), batch)
+
+
+def import_gpx(file_path, override=False, dry_run=False, verbose=False, batch_size=DEFAULT_BATCH_SIZE, session=None):
     """
     Import GPS data from a GPX file into the database.
     If override is True, existing data in the database will be deleted after confirmation.
     If dry_run is True, no changes will be made to the database.
     If verbose is True, detailed progress will be logged.
+    session is the SQLAlchemy session to write through, by default the module's db.
+    Like import_gpx_files, a malformed file keeps the points read before the error.
+    Returns the number of imported points.
     """
+    session = session or db
+    # Check if the GPX file exists
+    if not os.path.exists(file_path):
+        logging.error(f"GPX file not found: {file_path}")
+        return 0
+
+    count = 0
+    malformed = False
     try:
-        # Check if the GPX file exists
-        if not os.path.exists(file_path):
-            logging.error(f"GPX file not found: {file_path}")
-            return
-
-        # Open and parse the GPX file
-        with open(file_path, 'r') as gpx_file:
-            gpx = gpxpy.parse(gpx_file)
+        with tqdm(desc=f"Processing {os.path.basename(file_path)}", unit=" points", disable=not verbose) as progress:
+            try:
+                for batch in iter_gpx_points(file_path, batch_size):
+                    if not dry_run:
+                        insert_batch(batch, session)
+                    count += len(batch)
+                    progress.update(len(batch))
+            except (ET.ParseError, MalformedGPXError) as e:
+                logging.error(f"Malformed GPX file {file_path}, keeping the {count} points before the error: {e}")
+                malformed = True
+        if not dry_run:
+            session.commit()
     except Exception as e:
-        logging.error(f"Error parsing GPX file {file_path}: {e}")
-        return
+        logging.error(f"Error inserting data from {file_path} into the database: {e}")
+        session.rollback()  # Rollback in case of an error
+        return 0
 
-    # Prepare a list to hold all data points for batch insertion
-    data = []
+    if malformed:
+        return count
+    if count == 0:
+        logging.warning(f"No valid data points found in {file_path}.")
+    elif dry_run:
+        logging.info(f"Dry run: {count} data points would be imported from {file_path}.")
+    else:
+        logging.info(f"Successfully imported {count} data points from {file_path}.")
+    return count
+
+
+def _init_worker(batch_queue, stop_event):
+    global _batch_queue, _stop_event
+    _batch_queue = batch_queue
+    _stop_event = stop_event
 
-    try:
-        # Iterate through tracks, segments, and points
-        for track in gpx.tracks:
-            for segment in track.segments:
-                for point in tqdm(segment.points, desc=f"Processing {os.path.basename(file_path)}", disable=not verbose):
-                    # Extract latitude, longitude, elevation, and timestamp
-                    latitude = point.latitude
-                    longitude = point.longitude
-                    elevation = point.elevation if point.elevation else None
-                    timestamp = point.time.isoformat() if point.time else None
-
-                    # Append the data point to the list
-                    data.append({
-                        "latitude": latitude,
-                        "longitude": longitude,
-                        "elevation": elevation,
-                        "timestamp": timestamp
-                    })
-
-        # Perform batch insertion (if not in dry-run mode)
-        if data and not dry_run:
-            db.execute(
-                text("""
-                    INSERT INTO gps_data (latitude, longitude, elevation, timestamp)
-                    VALUES (:latitude, :longitude, :elevation, :timestamp)
-                """),
-                data
-            )
-            db.commit()
-            logging.info(f"Successfully imported {len(data)} data points from {file_path}.")
-        elif dry_run:
-            logging.info(f"Dry run: {len(data)} data points would be imported from {file_path}.")
-        else:
-            logging.warning(f"No valid data points found in {file_path}.")
 
+def _parse_worker(file_path, batch_size):
+    """Parser process: stream the points of one file into the shared queue, then report completion."""
+    count = 0
+    try:
+        for batch in iter_gpx_points(file_path, batch_size):
+            if _stop_event.is_set():
+                return
+            _batch_queue.put(("batch", file_path, batch))
+            count += len(batch)
+        _batch_queue.put(("done", file_path, count, None))
     except Exception as e:
-        logging.error(f"Error inserting data from {file_path} into the database: {e}")
-        db.rollback()  # Rollback in case of an error
+        _batch_queue.put(("done", file_path, count, str(e)))
+
+
+def _stop_workers(futures, batch_queue, stop_event):
+    """
+    Let the parser processes exit after the writer failed: files not started yet are cancelled, and the queue
+    is drained until the running ones, which may be blocked on the full queue, have seen the stop flag.
+    """
+    stop_event.set()
+    for future in futures:
+        future.cancel()
+    while not all(f.done() for f in futures):
+        try:
+            batch_queue.get(timeout=0.1)
+        except queue.Empty:
+            pass
+
+
+def import_gpx_files(gpx_files, dry_run=False, verbose=False, workers=None, batch_size=DEFAULT_BATCH_SIZE,
+                     session=None):
+    """
+    Import several GPX files: parser processes stream batches through a bounded queue
+    to this process, which is the only database writer and commits whenever a file is complete.
+    Points read before a parse error in a file are kept. A database error stops the parsers and is raised.
+    session is the SQLAlchemy session to write through, by default the module's db.
+    Logs the aggregate throughput in points/sec and MB/sec.
+    """
+    session = session or db
+    workers = workers or os.cpu_count() or 1
+    start = time.perf_counter()
+    total_bytes = sum(os.path.getsize(f) for f in gpx_files if os.path.exists(f))
+    total_points = 0
+
+    if workers == 1 or len(gpx_files) == 1:
+        for gpx_file in gpx_files:
+            total_points += import_gpx(gpx_file, dry_run=dry_run, verbose=verbose, batch_size=batch_size,
+                                       session=session)
+    else:
+        with multiprocessing.Manager() as manager:
+            batch_queue = manager.Queue(maxsize=QUEUE_SIZE)
+            stop_event = manager.Event()
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(batch_queue, stop_event)) as pool:
+                futures = [pool.submit(_parse_worker, f, batch_size) for f in gpx_files]
+                pending = len(gpx_files)
+                with tqdm(total=len(gpx_files), desc="Importing GPX files", unit=" files", disable=not verbose) as progress:
+                    while pending:
+                        try:
+                            message = batch_queue.get(timeout=1)
+                        except queue.Empty:
+                            # A crashed worker never reports back
+                            if all(f.done() for f in futures) and batch_queue.empty():
+                                logging.error("GPX parser processes exited unexpectedly.")
+                                break
+                            continue
+                        if message[0] == "batch":
+                            _, file_path, batch = message
+                            if not dry_run:
+                                try:
+                                    insert_batch(batch, session)
+                                except Exception as e:
+                                    logging.error(f"Error inserting data from {file_path} into the database: {e}")
+                                    session.rollback()
+                                    # Leaving the pool waits for the workers, which must not stay blocked on the queue
+                                    _stop_workers(futures, batch_queue, stop_event)
+                                    raise
+                            total_points += len(batch)
+                        else:
+                            _, file_path, count, error = message
+                            pending -= 1
+                            progress.update(1)
+                            if error:
+                                logging.error(f"Malformed GPX file {file_path}, keeping the {count} points before "
+                                              f"the error: {error}")
+                            if not dry_run:
+                                session.commit()
+                if not dry_run:
+                    session.commit()
+
+    elapsed = time.perf_counter() - start
+    if elapsed > 0:
+        logging.info(
+            f"{'Parsed' if dry_run else 'Imported'} {total_points} points from {len(gpx_files)} files in {elapsed:.2f}s "
+            f"({total_points / elapsed:.0f} points/sec, {total_bytes / elapsed / 1e6:.2f} MB/sec)"
+        )
+    return total_points
+
 
 def find_gpx_files(folder_path):
     """
@@ -119,13 +303,14 @@ def find_gpx_files(folder_path):
 def validate_arguments(args):
     """
     Validate command-line arguments.
-    Returns the GPX file paths, override flag, dry-run flag, verbose flag, and data folder.
+    Returns the GPX file paths, override flag, dry-run flag, verbose flag, worker count and batch size.
     """
-    valid_flags = {"--override", "--dry-run", "--verbose", "--help", "--data-folder"}
     override = False
     dry_run = False
     verbose = False
     data_folder = None
+    workers = None
+    batch_size = DEFAULT_BATCH_SIZE
     gpx_files = []
 
     i = 1
@@ -147,8 +332,17 @@ def validate_arguments(args):
                 sys.exit(1)
             data_folder = args[i + 1]
             i += 1  # Skip the next argument (folder path)
+        elif arg_lower in ("--workers", "--batch-size"):
+            if i + 1 >= len(args) or not args[i + 1].isdigit() or int(args[i + 1]) < 1:
+                logging.error(f"Error: {arg_lower} requires a positive number.")
+                sys.exit(1)
+            if arg_lower == "--workers":
+                workers = int(args[i + 1])
+            else:
+                batch_size = int(args[i + 1])
+            i += 1  # Skip the next argument (number)
         elif arg_lower.startswith("--"):
-            logging.error(f"Error: Invalid argument '{arg}'. Valid arguments are: --override, --dry-run, --verbose, --data-folder, --help")
+            logging.error(f"Error: Invalid argument '{arg}'. Valid arguments are: --override, --dry-run, --verbose, --data-folder, --workers, --batch-size, --help")
             sys.exit(1)
         else:
             gpx_files.append(arg)
@@ -166,21 +360,23 @@ def validate_arguments(args):
         print_help()
         sys.exit(1)
 
-    return gpx_files, override, dry_run, verbose
+    return gpx_files, override, dry_run, verbose, workers, batch_size
 
 def print_help():
     """Display usage instructions."""
-    print("Usage: python import_data.py <gpx_file> [<gpx_file> ...] [--data-folder <folder>] [--override] [--dry-run] [--verbose] [--help]")
+    print("Usage: python import_data.py <gpx_file> [<gpx_file> ...] [--data-folder <folder>] [--override] [--dry-run] [--verbose] [--workers <n>] [--batch-size <n>] [--help]")
     print("\nOptions:")
     print("  --override     Delete existing data in the database before import.")
     print("  --dry-run      Simulate the import without making changes to the database.")
     print("  --verbose      Display detailed progress and debugging information.")
     print("  --data-folder  Import all .gpx files from the specified folder and its subfolders.")
+    print("  --workers      Number of parser processes (default: number of CPUs).")
+    print(f"  --batch-size   Number of points per database write (default: {DEFAULT_BATCH_SIZE}).")
     print("  --help         Display this help message and exit.")
 
 if __name__ == '__main__':
     # Validate command-line arguments
-    gpx_files, override, dry_run, verbose = validate_arguments(sys.argv)
+    gpx_files, override, dry_run, verbose, workers, batch_size = validate_arguments(sys.argv)
 
     # Check if override is enabled (only once, before processing files)
     if override and not dry_run:
@@ -201,6 +397,5 @@ if __name__ == '__main__':
             db.rollback()
             sys.exit(1)
 
-    # Import each GPX file
-    for gpx_file in gpx_files:
-        import_gpx(gpx_file, override=False, dry_run=dry_run, verbose=verbose)
\ No newline at end of file
+    # Import all GPX files
+    import_gpx_files(gpx_files, dry_run=dry_run, verbose=verbose, workers=workers, batch_size=batch_size)
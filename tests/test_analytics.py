@@ -0,0 +1,67 @@
+import json
+
+import numpy as np
+
+from backend.analytics import analyze, haversine
+from backend.datastore import Datastore, SQLiteBackend
+from backend.map import MapUtil
+from backend.track import Track
+from backend.webservice import WebService
+
+
+def commute():
+    """Ride 6 km north in 20 minutes, park for an hour, ride back; one point every 10 seconds."""
+    ride = np.linspace(0.0, 6000.0 / 111_195, 121)
+    lat = 47.0 + np.r_[ride, np.full(360, ride[-1]), ride[::-1]]
+    ts = 1_700_000_000 + 10 * np.arange(len(lat), dtype=np.int64)
+    elevation = np.r_[np.linspace(400, 500, 121), np.full(360, 500.0), np.linspace(500, 400, 121)]
+    return Track(lat, np.full(len(lat), 8.0), elevation, ts)
+
+
+def test_haversine():
+    assert abs(haversine(0.0, 0.0, 0.0, 1.0) - 111_195) < 1
+    assert np.allclose(haversine(np.zeros(3), np.zeros(3), np.zeros(3), np.zeros(3)), 0)
+
+
+def test_analyze_finds_stop_and_trips():
+    result = analyze(commute())
+    summary = result["summary"]
+    assert abs(summary["distance_m"] - 12_000) < 10
+    assert summary["stops"] == 1 and summary["trips"] == 2
+    assert abs(summary["elevation_gain_m"] - 100) < 1e-6 and abs(summary["elevation_loss_m"] - 100) < 1e-6
+    assert abs(summary["avg_moving_speed_mps"] - 5.0) < 0.01
+    assert result["stops"][0]["duration_s"] >= 3600
+    assert abs(result["trips"][1]["distance_m"] - 6000) < 5
+
+    assert analyze(Track())["summary"]["points"] == 0
+
+
+def test_segments_without_elapsed_time_have_no_speed():
+    # A 200 m trip whose points all got the same timestamp
+    lat = 47.0 + np.array([0.0, 0.001, 0.002])
+    ts = np.full(3, 1_700_000_000, dtype=np.int64)
+    result = analyze(Track(lat, np.full(3, 8.0), None, ts), min_trip_meters=100)
+    summary = result["summary"]
+    assert summary["trips"] == 1 and summary["max_speed_mps"] == 0.0 and summary["avg_moving_speed_mps"] == 0.0
+    assert result["trips"][0]["max_speed_mps"] == 0.0
+    json.dumps(result, allow_nan=False)
+
+
+def test_dropped_short_trip_does_not_count_for_its_neighbours():
+    # 600 m at 10 m/s, a stop, a 50 m burst at 50 m/s (too short for a trip), a stop, 600 m at 5 m/s
+    meters = np.r_[np.linspace(0, 600, 7), np.full(40, 600.0), [650.0], np.full(40, 650.0), 650 + 50 * np.arange(1, 13)]
+    ts = np.r_[10 * np.arange(7), 70 + 10 * np.arange(40), [461], 470 + 10 * np.arange(40), 860 + 10 * np.arange(1, 13)]
+    track = Track(47.0 + meters / 111_195, np.full(len(meters), 8.0), None, 1_700_000_000 + ts.astype(np.int64))
+    result = analyze(track)
+    assert result["summary"]["trips"] == 2 and result["summary"]["stops"] == 2
+    assert [round(trip["max_speed_mps"], 1) for trip in result["trips"]] == [10.0, 5.0]
+
+
+def test_analytics_endpoint(tmp_path):
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "test.db")))
+    ds.insert_points(commute())
+    client = WebService(ds, MapUtil()).app.test_client()
+    summary = client.get("/api/analytics").get_json()["summary"]
+    assert summary["trips"] == 2
+    assert client.get("/api/analytics?start=2030-01-01T00:00:00Z").get_json()["summary"]["points"] == 0
+    ds.close()
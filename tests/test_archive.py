@@ -0,0 +1,99 @@
+import numpy as np
+
+import pytest
+
+from backend import archive as archive_module
+from backend.archive import ArchiveBackend
+from backend.datastore import Datastore, SQLiteBackend, UnsupportedQueryError
+from backend.track import Track, to_epoch_seconds
+from backend.util import BoundingBox, GeoPoint
+
+
+def make_track():
+    timestamps = [f"2024-0{1 + i % 3}-{1 + i % 28:02d}T12:{i // 60:02d}:{i % 60:02d}Z" for i in range(90)]
+    elevation = np.arange(90, dtype=np.float64)
+    elevation[5] = np.nan
+    return Track(np.linspace(47.0, 48.0, 90), np.linspace(8.0, 9.0, 90), elevation, to_epoch_seconds(timestamps))
+
+
+def test_archive_matches_sqlite_queries(tmp_path):
+    archive = Datastore(lambda: ArchiveBackend(archive_dir=str(tmp_path / "archive")))
+    sqlite = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "test.db")))
+    for ds in (archive, sqlite):
+        ds.insert_points(make_track()[:50], wait=True)
+        ds.insert_points(make_track()[50:])
+        ds.flush()
+
+    # One segment per month and insert, each with its own index entry
+    assert len(archive.db_worker.storage.segments) == 6
+    windows = [
+        dict(),
+        dict(start="2024-02-01T00:00:00Z", end="2024-02-29T23:59:59Z"),
+        dict(bbox=BoundingBox(47.2, 8.0, 47.6, 9.0)),
+        dict(bbox=BoundingBox(47.2, 8.0, 47.6, 9.0), start="2024-01-10T00:00:00Z", end="2024-03-05T00:00:00Z"),
+    ]
+    for window in windows:
+        expected = sqlite.query_gps_data(**window)
+        assert archive.query_gps_data(**window) == expected
+
+    archive_module.compact(archive)
+    assert len(archive.db_worker.storage.segments) == 3
+    february = archive.query_gps_data(start="2024-02-01T00:00:00Z", end="2024-02-29T23:59:59Z")
+    assert february == sqlite.query_gps_data(start="2024-02-01T00:00:00Z", end="2024-02-29T23:59:59Z")
+    # Served straight from the mapped column files
+    assert np.shares_memory(february.latitude, archive.db_worker.storage.segments[1].columns["latitude"])
+
+    archive.close()
+    sqlite.close()
+
+
+def test_archive_persists_and_deletes(tmp_path):
+    path = str(tmp_path / "archive")
+    ds = Datastore(lambda: ArchiveBackend(archive_dir=path))
+    ds.insert_points(make_track())
+    ds.close()
+
+    ds = Datastore(lambda: ArchiveBackend(archive_dir=path))
+    assert ds.first_gps_point() == (47.0, 8.0)
+    assert len(ds.fetch_gps_data()) == 90
+    with pytest.raises(UnsupportedQueryError):
+        ds.db_worker.storage.fetch_all_from_query("SELECT count(*) FROM gps_data")
+    ds.delete_gps_data()
+    ds.flush()
+    assert len(ds.query_gps_data(start="2024-01-01T00:00:00Z")) == 0
+    assert sorted(p.name for p in (tmp_path / "archive").iterdir()) == ["index.json"]
+    ds.close()
+
+
+def test_archive_keeps_lossy_timestamps_and_skips_undated_points(tmp_path):
+    ds = Datastore(lambda: ArchiveBackend(archive_dir=str(tmp_path / "archive")))
+    ds.insert_points([GeoPoint(46.0, 7.0, None, None), GeoPoint(47.0, 8.0, None, "2024-01-02T00:00:00.500Z")],
+                     wait=True)
+    ds.insert_points([GeoPoint(47.5, 8.5, None, "2024-01-01T02:00:00+02:00"),
+                      GeoPoint(47.7, 8.7, None, "2024-01-03T00:00:00Z")])
+    ds.flush()
+    assert ds.first_gps_point() == (47.5, 8.5)
+
+    archive_module.compact(ds)
+    track = ds.query_gps_data(start="2024-01-01T00:00:00Z")
+    assert list(track.timestamp_strings()) == ["2024-01-01T02:00:00+02:00", "2024-01-02T00:00:00.500Z",
+                                               "2024-01-03T00:00:00Z"]
+    ds.close()
+
+
+def test_archive_deletes_compacted_segments_after_their_readers(tmp_path):
+    ds = Datastore(lambda: ArchiveBackend(archive_dir=str(tmp_path / "archive")))
+    ds.insert_points(make_track()[:50], wait=True)
+    ds.insert_points(make_track()[50:])
+    ds.flush()
+    storage = ds.db_worker.storage
+    old = list(storage.segments)
+    assert len(old) == 6
+
+    chunks = storage.iter_gps_data(chunk_size=10)
+    first = next(chunks)
+    archive_module.compact(ds)
+    assert all(segment.path.exists() for segment in old)
+    assert len(first) + sum(len(chunk) for chunk in chunks) == 90
+    assert not any(segment.path.exists() for segment in old)
+    ds.close()
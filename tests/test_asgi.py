@@ -0,0 +1,97 @@
+import asyncio
+import json
+from backend.asgi import AsyncWebService
+from backend.datastore import SQLiteBackend, Datastore
+from backend.map import MapUtil
+from backend.util import GeoPoint
+from backend.webservice import WebService
+
+
+async def call(app, method, path, query=b"", headers=(), body=b""):
+    messages = []
+    received = []
+
+    async def receive():
+        if received:
+            # The client stays connected
+            await asyncio.Event().wait()
+        received.append(body)
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"type": "http", "method": method, "path": path, "query_string": query, "headers": list(headers)}
+    await app(scope, receive, send)
+    start, *body_messages = messages
+    return start["status"], dict(start["headers"]), b"".join(message["body"] for message in body_messages)
+
+
+def test_asgi_serves_concurrent_requests(tmp_path):
+    db_file = tmp_path / "test.db"
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(db_file)))
+    ds.insert_points([GeoPoint(1.0, 2.0, 3.0, "2024-01-01T00:00:00Z"), GeoPoint(1.1, 2.1, 3.0, "2024-01-01T00:01:00Z")])
+    ds.flush()
+    app = AsyncWebService(WebService(ds, MapUtil()))
+
+    async def scenario():
+        responses = await asyncio.gather(*(call(app, "GET", "/") for _ in range(50)))
+        assert {status for status, _, _ in responses} == {200}
+        etag = responses[0][1][b"etag"]
+        assert (await call(app, "GET", "/", headers=[(b"if-none-match", etag)]))[0] == 304
+
+        payload = json.dumps({"points": [{"latitude": 1.2, "longitude": 2.2, "timestamp": "2024-01-01T00:02:00Z"}]})
+        status, _, body = await call(app, "POST", "/save_manual_data", body=payload.encode())
+        assert status == 200 and json.loads(body)["status"] == "success"
+        assert (await call(app, "GET", "/", headers=[(b"if-none-match", etag)]))[0] == 200
+        assert (await call(app, "GET", "/tiles/0/0/0.mvt"))[0] == 200
+        assert (await call(app, "GET", "/", query=b"min_lat=1"))[0] == 400
+
+    asyncio.run(scenario())
+    app.close()
+    ds.close(timeout=1)
+
+
+def test_asgi_serves_every_flask_route(tmp_path):
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "test.db")))
+    ds.insert_points([GeoPoint(1.0, 2.0, 3.0, "2024-01-01T00:00:00Z"), GeoPoint(1.1, 2.1, 3.0, "2024-01-01T00:01:00Z")])
+    ds.flush()
+    app = AsyncWebService(WebService(ds, MapUtil()))
+    rules = {rule.rule for rule in app.ws.app.url_map.iter_rules()}
+    assert {"/api/points", "/api/track", "/api/export.<fmt>", "/api/analytics", "/api/route", "/events"} <= rules
+
+    async def scenario():
+        # Flask views run on the executor, streamed bodies are passed on chunk by chunk
+        status, headers, body = await call(app, "GET", "/api/points", query=b"limit=1")
+        assert status == 200 and headers[b"content-type"] == b"application/x-ndjson"
+        assert [json.loads(line)["latitude"] for line in body.splitlines()] == [1.0]
+        assert (await call(app, "GET", "/api/points", query=b"limit=0"))[0] == 400
+        status, headers, _ = await call(app, "GET", "/api/track")
+        assert status == 200
+        assert (await call(app, "GET", "/api/track", headers=[(b"if-none-match", headers[b"etag"])]))[0] == 304
+        status, _, body = await call(app, "GET", "/api/analytics")
+        assert status == 200 and json.loads(body)["summary"]["points"] == 2
+        assert (await call(app, "GET", "/api/route"))[0] == 404
+        assert (await call(app, "GET", "/api/export.xyz"))[0] == 404
+        assert (await call(app, "POST", "/api/points"))[0] == 405
+        assert (await call(app, "GET", "/nowhere"))[0] == 404
+
+        # HEAD gets the headers of GET without the body, streamed or not, and subscribes to nothing
+        status, headers, body = await call(app, "HEAD", "/api/analytics")
+        assert status == 200 and body == b"" and int(headers[b"content-length"]) > 0
+        status, headers, body = await call(app, "HEAD", "/api/points")
+        assert status == 200 and body == b"" and headers[b"content-type"] == b"application/x-ndjson"
+        status, _, body = await call(app, "HEAD", "/events")
+        assert status == 200 and body == b"" and len(app.ws.events) == 0
+
+        events = asyncio.ensure_future(call(app, "GET", "/events", query=b"since=0"))
+        await asyncio.sleep(0.3)
+        # The stream waits on the event loop, a client that leaves is unsubscribed
+        assert len(app.ws.events) == 1 and not events.done()
+        events.cancel()
+        assert (await call(app, "GET", "/events", query=b"start=2024-01-01"))[0] == 400
+
+    asyncio.run(scenario())
+    assert len(app.ws.events) == 0
+    app.close()
+    ds.close(timeout=1)
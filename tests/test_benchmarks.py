@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from benchmarks.generators import iter_random_walk, random_walk
+from benchmarks.run import Result, Workspace, compare, load_results, measure, parse_size, run_benchmarks, save_results
+
+
+def test_random_walk_is_deterministic():
+    track = random_walk(1000, seed=3)
+    assert len(track) == 1000
+    assert (track.latitude == random_walk(1000, seed=3).latitude).all()
+    assert (track.timestamp[1:] > track.timestamp[:-1]).all()
+    # Generated chunk by chunk, the same walk whatever the chunk size
+    chunks = list(iter_random_walk(1000, seed=3, chunk_size=300))
+    assert [len(chunk) for chunk in chunks] == [300, 300, 300, 100]
+    assert np.allclose(np.concatenate([chunk.latitude for chunk in chunks]), track.latitude)
+    assert np.allclose(np.concatenate([chunk.elevation for chunk in chunks]), track.elevation)
+    assert np.array_equal(np.concatenate([chunk.timestamp for chunk in chunks]), track.timestamp)
+
+
+def test_measure_cleans_up_after_a_failure(tmp_path):
+    cleaned = []
+
+    def failing(work):
+        def run():
+            raise RuntimeError("broken")
+        yield run
+        cleaned.append(True)
+
+    with pytest.raises(RuntimeError, match="broken"):
+        measure(failing, Workspace(str(tmp_path), 10), repeat=1)
+    assert cleaned == [True]
+
+
+def test_run_save_and_compare(tmp_path):
+    results = run_benchmarks(sizes=[500], names=["datastore.insert_points", "datastore.fetch_gps_data",
+                                                 "webservice.index", "webservice.track", "import.csv", "import.gpx"],
+                             repeat=1, workdir=str(tmp_path))
+    assert [r.points for r in results] == [500] * 6
+    assert all(r.median_s > 0 for r in results)
+
+    save_results(results, str(tmp_path / "baseline.json"))
+    baseline = load_results(str(tmp_path / "baseline.json"))
+    assert not any(row["regression"] for row in compare(results, baseline))
+
+    slower = [Result(r.name, r.points, r.repeat, r.median_s * 2, r.min_s) for r in results]
+    assert all(row["regression"] for row in compare(slower, baseline))
+    rows = compare([Result("new", 500, 1, 1.0, 1.0)], baseline)
+    assert rows[0]["ratio"] is None and not rows[0]["regression"]
+
+
+def test_parse_size():
+    assert [parse_size(v) for v in ("10k", "1M", "2500")] == [10_000, 1_000_000, 2500]
@@ -1,5 +1,9 @@
 from backend.datastore import SQLiteBackend, Datastore
-from backend.util import GeoPoint
+from backend.util import GeoPoint, BoundingBox
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import threading
+from backend.track import NO_TIMESTAMP, Track, to_epoch_seconds
 
 
 def test_insert_and_fetch(tmp_path):
@@ -19,3 +23,183 @@ def test_insert_and_fetch(tmp_path):
 
     ds.db_worker.stop()
     ds.db_worker.join(timeout=1)
+
+
+def test_insert_points_in_batches(tmp_path):
+    db_file = tmp_path / "test.db"
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(db_file)), batch_size=100)
+    points = [GeoPoint(float(i), 2.0, 3.0, f"2024-01-01T00:00:{i % 60:02d}Z") for i in range(250)]
+    # Quotes in values must be bound, not interpolated into the statement
+    points.append(GeoPoint(1.0, 2.0, 3.0, "2024-01-01T00:00:00Z'); DROP TABLE gps_data; --"))
+    ds.insert_points(points)
+    ds.db_worker.task_queue.join()
+
+    rows = ds.load_gps_data()
+    assert len(rows) == 251
+
+    ds.db_worker.stop()
+    ds.db_worker.join(timeout=1)
+
+
+def test_track_columns_slicing_and_append():
+    track = Track.from_points([
+        GeoPoint(1.0, 2.0, None, "2024-01-01T00:00:00Z"),
+        GeoPoint(3.0, 4.0, 5.0, "2024-01-01T01:00:00+01:00"),
+    ])
+    assert track.timestamp.tolist() == [1704067200, 1704067200]
+    assert track[0].elevation is None
+    # The epoch seconds are UTC, the point keeps the timestamp as given
+    assert track[1].timestamp == "2024-01-01T01:00:00+01:00"
+
+    view = track[1:]
+    assert view.latitude.base is not None  # zero-copy view of the column
+
+    track.append([GeoPoint(5.0, 6.0, 7.0, "")])
+    assert len(track) == 3 and len(view) == 1
+    assert track[2].timestamp == ""
+    assert list(track.iter_rows())[2] == (5.0, 6.0, 7.0, None)
+
+
+def test_timestamps_parse_per_value_and_round_trip(tmp_path):
+    naive, aware = "2024-01-01T10:00:00", "2024-01-01T10:00:00+02:00"
+    # Naive means UTC, whatever else is in the batch
+    assert to_epoch_seconds([naive]).tolist() == to_epoch_seconds([naive, aware])[:1].tolist() == [1704103200]
+    assert to_epoch_seconds([aware, naive]).tolist() == [1704096000, 1704103200]
+
+    timestamps = [naive, aware, "2024-01-01T10:00:00.250Z", "2024-01-01 10:00:00.123456+05:30",
+                  "01/02/2024 10:00", "2024-01-01T10:00:00Z", None]
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "test.db")))
+    ds.insert_points([GeoPoint(float(i), 2.0, 3.0, ts) for i, ts in enumerate(timestamps)])
+    ds.flush()
+    # Rows are ordered by timestamp, the latitude is the index
+    assert {row[0]: row[3] for row in ds.load_gps_data()} == dict(enumerate(timestamps))
+
+    track = ds.fetch_gps_data()
+    track = track[np.argsort(track.latitude)]
+    assert track.timestamp[:4].tolist() == [1704103200, 1704096000, 1704103200, 1704083400]
+    assert track.timestamp[4] == NO_TIMESTAMP
+    assert [p.timestamp for p in track] == timestamps[:-1] + [""]
+    # Writing the loaded track again keeps the timestamps too
+    assert [row[3] for row in track[2:4].iter_rows()] == timestamps[2:4]
+    ds.close()
+
+
+def test_reads_run_concurrently_and_see_prior_writes(tmp_path):
+    db_file = tmp_path / "test.db"
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(db_file)))
+    bbox = BoundingBox(0.0, 0.0, 10.0, 10.0)
+    for i in range(5):
+        # No join: the query must still wait for the insert submitted before it
+        ds.insert_points([GeoPoint(1.0, 2.0, 3.0, f"2024-01-01T00:00:0{i}Z")])
+        assert len(ds.query_gps_data(bbox=bbox)) == i + 1
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        counts = list(pool.map(lambda _: len(ds.query_gps_data(bbox=bbox)), range(20)))
+    assert counts == [5] * 20
+
+    stats = ds.stats()
+    assert stats["read_exec"]["count"] == 25
+    assert stats["queue_depth"] == 0
+
+    ds.close(timeout=1)
+
+
+def test_queued_inserts_share_one_commit(tmp_path):
+    db_file = tmp_path / "test.db"
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(db_file)))
+    release = threading.Event()
+    ds.db_worker.submit_and_forget(release.wait)  # hold the worker while the inserts queue up
+    for i in range(10):
+        ds.insert_points([GeoPoint(1.0, 2.0, 3.0, f"2024-01-01T00:00:0{i}Z")])
+    release.set()
+    ds.flush()
+
+    # The blocking task plus a single coalesced insert
+    assert ds.stats()["write_exec"]["count"] == 2
+    assert len(ds.load_gps_data()) == 10
+
+    ds.insert_points([GeoPoint(1.0, 2.0, 3.0, "2024-01-02T00:00:00Z")], wait=True)
+    assert len(ds.load_gps_data()) == 11
+
+    ds.close(timeout=1)
+
+
+def test_worker_starts_on_first_use(tmp_path):
+    db_file = tmp_path / "test.db"
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(db_file)))
+    assert not db_file.exists()
+    ds.close()
+
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(db_file)))
+    ds.insert_points([GeoPoint(1.0, 2.0, 3.0, "2024-01-01T00:00:00Z")], wait=True)
+    assert db_file.exists() and len(ds.fetch_gps_data()) == 1
+    ds.close()
+
+
+def test_read_connections_are_pooled(tmp_path):
+    backend = SQLiteBackend(db_path=str(tmp_path / "test.db"), max_read_connections=2)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(lambda _: backend.read_all_from_query("SELECT count(*) FROM gps_data"), range(50)))
+    # Threads come and go, the connections stay at the pool size
+    assert len(backend._idle_read_conns) <= 2
+    backend.close_and_cleanup()
+
+
+def test_load_racing_an_insert_is_not_cached(tmp_path):
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "test.db")))
+    ds.insert_points([GeoPoint(1.0, 2.0, 3.0, "2024-01-01T00:00:00Z")])
+    load = ds.load_gps_data
+
+    def load_then_insert(*args, **kwargs):
+        rows = load(*args, **kwargs)
+        # Committed after the rows were read, and no cache to extend yet
+        ds.insert_points([GeoPoint(1.1, 2.1, 3.0, "2024-01-01T00:00:01Z")], wait=True)
+        return rows
+
+    ds.load_gps_data = load_then_insert
+    assert len(ds.fetch_gps_data()) == 1
+    ds.load_gps_data = load
+    assert len(ds.fetch_gps_data()) == 2
+    ds.close()
+
+
+def test_inserts_replace_the_cached_track_instead_of_growing_it(tmp_path):
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "test.db")))
+    ds.insert_points([GeoPoint(1.0, 2.0, 3.0, "2024-01-01T00:00:00Z")], wait=True)
+    before = ds.fetch_gps_data()
+    for i in range(20):
+        ds.insert_points([GeoPoint(1.0 + i, 2.0, 3.0, f"2024-01-01T00:00:{i:02d}.5Z")], wait=True)
+    after = ds.fetch_gps_data()
+    # A reader of the old track keeps consistent columns while the writer extends the cache
+    assert len(before) == len(before.latitude) == len(before.longitude) == 1
+    assert len(after) == 21 and after[20].timestamp == "2024-01-01T00:00:19.5Z"
+    before.append([GeoPoint(9.0, 9.0, None, "")])
+    assert after[1].latitude == 1.0
+    ds.close()
+
+
+def test_failed_insert_in_a_group_commit_only_fails_itself(tmp_path):
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "test.db")), coalesce_window=0.2)
+    assert len(ds.fetch_gps_data()) == 0
+    events = []
+    ds.subscribe(lambda event, track, version: events.append(event))
+    storage = ds.db_worker.storage
+    insert_rows = storage.insert_rows
+
+    def reject_latitude_99(table, columns, rows):
+        if any(row[0] == 99.0 for row in rows):
+            raise ValueError("bad row")
+        insert_rows(table, columns, rows)
+
+    storage.insert_rows = reject_latitude_99
+    # Queued within the coalesce window, so they share one transaction that fails
+    ds.insert_points([GeoPoint(1.0, 2.0, 3.0, "2024-01-01T00:00:00Z")])
+    ds.insert_points([GeoPoint(99.0, 2.0, 3.0, "2024-01-01T00:00:01Z")])
+    ds.insert_points([GeoPoint(2.0, 2.0, 3.0, "2024-01-01T00:00:02Z")])
+    ds.flush()
+
+    assert sorted(row[0] for row in ds.load_gps_data()) == [1.0, 2.0]
+    # The failed points were already in the cache, it is dropped and reloaded. Only committed inserts are announced
+    assert events == ["insert", "invalidate", "insert"]
+    assert sorted(ds.fetch_gps_data().latitude.tolist()) == [1.0, 2.0]
+    ds.close()
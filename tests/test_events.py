@@ -0,0 +1,106 @@
+import json
+import threading
+
+import numpy as np
+
+from backend import events
+from backend.datastore import Datastore, SQLiteBackend
+from backend.events import EventBroker, decode_points, encode_points
+from backend.map import MapUtil
+from backend.track import Track
+from backend.util import BoundingBox
+from backend.webservice import WebService
+
+
+def parse(message):
+    fields = dict(line.split(": ", 1) for line in message.strip().split("\n"))
+    return fields["event"], json.loads(fields["data"]), fields.get("id")
+
+
+def test_delta_encoding_round_trip():
+    track = Track(np.array([47.3779, 47.37791, 47.3781]), np.array([8.5403, 8.54032, 8.5401]))
+    data = encode_points(track)
+    assert data["lat"][1:] == [10, 190]
+    lat, lon = decode_points(data)
+    assert np.allclose(lat, track.latitude, atol=1e-6) and np.allclose(lon, track.longitude, atol=1e-6)
+
+
+def test_broker_pushes_new_points_and_replays(tmp_path):
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "test.db")))
+    broker = EventBroker(ds)
+    everything = broker.subscribe(since=ds.version)
+    inside = broker.subscribe(since=ds.version, bbox=BoundingBox(0.0, 0.0, 10.0, 10.0))
+
+    ds.insert_points(Track(np.array([1.0, 50.0]), np.array([2.0, 50.0]), None, np.array([1, 2])), wait=True)
+    event, data, event_id = parse(everything.queue.get_nowait())
+    assert event == "points" and data["count"] == 2 and int(event_id) == ds.version
+    _, data, _ = parse(inside.queue.get_nowait())
+    assert data["count"] == 1
+
+    # A page rendered before the insert gets it replayed, one from before a restart has to reload
+    late = broker.subscribe(since=ds.version - 1)
+    assert parse(late.queue.get_nowait())[0] == "points"
+    assert parse(broker.subscribe(since=ds.version + 5).queue.get_nowait())[0] == "reset"
+    assert broker.subscribe(since=ds.version).queue.empty()
+
+    ds.delete_gps_data()
+    ds.flush()
+    assert parse(everything.queue.get_nowait())[0] == "reset"
+    ds.close()
+
+
+def test_inserts_are_published_once_committed(tmp_path):
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "test.db")))
+    broker = EventBroker(ds)
+    client = broker.subscribe(since=ds.version)
+    release = threading.Event()
+    ds.db_worker.submit_and_forget(release.wait)
+
+    # The insert is queued behind the blocked writer: the version is bumped, nothing is published yet
+    ds.insert_points(Track(np.array([1.0]), np.array([2.0]), None, np.array([1])))
+    version = ds.version
+    assert client.queue.empty()
+    # A page rendered now already shows the queued points, it neither resets nor gets them again
+    page = broker.subscribe(since=version)
+
+    release.set()
+    ds.flush()
+    event, _, event_id = parse(client.queue.get_nowait())
+    assert event == "points" and int(event_id) == version
+    assert page.queue.empty()
+    ds.close()
+
+
+def test_slow_subscriber_gets_reset(tmp_path, monkeypatch):
+    monkeypatch.setattr(events, "MAX_PENDING_EVENTS", 2)
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "test.db")))
+    broker = EventBroker(ds)
+    slow = broker.subscribe()
+    for i in range(3):
+        ds.insert_points(Track(np.array([1.0]), np.array([2.0]), None, np.array([i])))
+    ds.flush()
+    assert parse(slow.queue.get_nowait())[0] == "reset"
+    assert slow.queue.get_nowait() is None
+    assert len(broker) == 0
+    ds.close()
+
+
+def test_event_stream_endpoint(tmp_path):
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "test.db")))
+    ws = WebService(ds, MapUtil())
+    ds.insert_points(Track(np.array([1.0, 1.1]), np.array([2.0, 2.1]), None, np.array([1, 2])))
+
+    client = ws.app.test_client()
+    response = client.get("/events?since=0", buffered=False)
+    assert response.mimetype == "text/event-stream"
+    chunks = iter(response.response)
+    assert next(chunks).startswith(b"retry:")
+    event, data, _ = parse(next(chunks).decode())
+    assert event == "points" and data["count"] == 2
+    response.close()
+    assert client.get("/events?start=2024-01-01").status_code == 400
+
+    # The rendered map follows the stream from the version it shows
+    html = client.get("/").get_data(as_text=True)
+    assert "followPoints" in html and f"since={ds.version}" in html
+    ds.close()
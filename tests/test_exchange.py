@@ -0,0 +1,84 @@
+import io
+
+import numpy as np
+import pytest
+
+from backend.datastore import SQLiteBackend, Datastore
+from backend.exchange import export_gps_data, import_gps_data, read_tracks
+from backend.map import MapUtil
+from backend.track import Track, parse_timestamps
+from backend.webservice import WebService
+
+pytest.importorskip("pyarrow")
+
+
+def make_track(n):
+    strings = [f"2024-01-01T00:00:{i % 60:02d}Z" for i in range(n)]
+    strings[1] = None
+    strings[3] = "2024-01-01T00:00:03.250Z"
+    strings[4] = "2024-01-01T02:00:04+02:00"
+    timestamps, raw = parse_timestamps(strings)
+    elevation = np.arange(n, dtype=np.float64)
+    elevation[2] = np.nan
+    return Track(np.linspace(47.0, 48.0, n), np.linspace(8.0, 9.0, n), elevation, timestamps, raw_timestamp=raw)
+
+
+@pytest.mark.parametrize("suffix", [".parquet", ".arrow", ".fgb"])
+def test_export_import_round_trip(tmp_path, suffix):
+    if suffix == ".fgb":
+        pytest.importorskip("pyogrio")
+    track = make_track(250)
+    source = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "source.db")))
+    source.insert_points(track)
+    path = str(tmp_path / f"gps_data{suffix}")
+    assert export_gps_data(source, path, batch_size=100) == 250
+
+    target = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "target.db")))
+    assert import_gps_data(target, path, batch_size=64) == 250
+    imported = next(target.iter_gps_data())
+    assert imported == track
+    assert list(imported.timestamp_strings()[3:5]) == ["2024-01-01T00:00:03.250Z", "2024-01-01T02:00:04+02:00"]
+
+    source.close()
+    target.close()
+
+
+def test_import_raises_if_a_batch_fails(tmp_path):
+    source = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "source.db")))
+    source.insert_points(make_track(250))
+    path = str(tmp_path / "gps_data.parquet")
+    export_gps_data(source, path)
+
+    target = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "target.db")))
+    assert len(target.fetch_gps_data()) == 0
+    storage = target.db_worker.storage
+    insert_rows = storage.insert_rows
+    inserts = []
+
+    def fail_third_batch(table, columns, rows):
+        inserts.append(table)
+        if len(inserts) == 3:
+            raise ValueError("disk full")
+        insert_rows(table, columns, rows)
+
+    storage.insert_rows = fail_third_batch
+    with pytest.raises(ValueError, match="disk full"):
+        import_gps_data(target, path, batch_size=64)
+    assert len(target.load_gps_data()) == 128
+
+    source.close()
+    target.close()
+
+
+def test_export_endpoint_streams_parquet(tmp_path):
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "test.db")))
+    ds.insert_points(make_track(50))
+    client = WebService(ds, MapUtil()).app.test_client()
+
+    response = client.get("/api/export.parquet?min_lat=47&min_lon=8&max_lat=47.5&max_lon=9")
+    assert response.status_code == 200
+    tracks = list(read_tracks(io.BytesIO(response.get_data()), "parquet"))
+    assert sum(len(t) for t in tracks) == 25
+    assert client.get("/api/export.csv").status_code == 404
+
+    ds.close()
@@ -0,0 +1,65 @@
+import struct
+import zlib
+
+import numpy as np
+
+from backend.datastore import Datastore, SQLiteBackend
+from backend.heatmap import DensityPyramid, render_heat_tile
+from backend.map import MapUtil
+from backend.spatial import grid_cells
+from backend.track import Track
+from backend.webservice import WebService
+
+
+def random_track(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return Track(rng.normal(47.37, 0.02, n), rng.normal(8.54, 0.02, n))
+
+
+def decode_png(data):
+    assert data[:8] == b"\x89PNG\r\n\x1a\n"
+    width, height = struct.unpack(">II", data[16:24])
+    idat_length = struct.unpack(">I", data[33:37])[0]
+    raw = np.frombuffer(zlib.decompress(data[41:41 + idat_length]), dtype=np.uint8)
+    return raw.reshape(height, width * 4 + 1)[:, 1:].reshape(height, width, 4)
+
+
+def test_pyramid_blocks_count_every_point():
+    track = random_track(3000)
+    incremental, full = DensityPyramid(), DensityPyramid()
+    for first in range(0, 3000, 700):
+        incremental.add(track[first:first + 700])
+        if first == 700:
+            # Reading merges what was added so far, the rest is merged by the next read
+            assert len(incremental._pending) == 2 and incremental.max_count(0) == 1400
+    full.add(track)
+
+    zoom = 12
+    cx, cy = grid_cells(track.latitude[:1], track.longitude[:1], zoom)
+    x, y = int(cx[0]), int(cy[0])
+    block = full.block(zoom + 6, x * 64, y * 64, 64)
+    assert np.array_equal(block, incremental.block(zoom + 6, x * 64, y * 64, 64))
+    tx, ty = grid_cells(track.latitude, track.longitude, zoom)
+    assert block.sum() == np.count_nonzero((tx == x) & (ty == y))
+    assert full.block(0, 0, 0, 1).sum() == 3000
+
+    image = decode_png(render_heat_tile(full, zoom, x, y))
+    assert image.shape == (256, 256, 4)
+    assert image[..., 3].any()
+    assert not decode_png(render_heat_tile(full, zoom, 0, 0))[..., 3].any()
+
+
+def test_heatmap_endpoints(tmp_path):
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "test.db")))
+    ds.insert_points(random_track(500))
+    ws = WebService(ds, MapUtil())
+    client = ws.app.test_client()
+
+    cx, cy = grid_cells(np.array([47.37]), np.array([8.54]), 10)
+    response = client.get(f"/heatmap/10/{int(cx[0])}/{int(cy[0])}.png")
+    assert response.status_code == 200 and response.mimetype == "image/png"
+    assert decode_png(response.get_data())[..., 3].any()
+    assert client.get("/heatmap/1/5/5.png").status_code == 404
+    assert client.get("/?view=heatmap&zoom=10").status_code == 200
+    assert len(ws.heatmap.heat_points(10)) > 0
+    ds.close()
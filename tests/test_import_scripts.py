@@ -0,0 +1,154 @@
+import sqlite3
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from backend.datastore import SQLiteBackend
+from benchmarks.generators import random_walk, write_csv, write_gpx
+from scripts import import_data_CSV, import_data_GPX
+
+
+class FakeConnection:
+    """Stands in for a PostgreSQL connection, and its DBAPI connection and cursor, recording COPYs."""
+
+    def __init__(self):
+        self.dialect = SimpleNamespace(name="postgresql")
+        self.connection = self
+        self.copies = []
+
+    def cursor(self):
+        return self
+
+    def copy_expert(self, sql, buffer):
+        self.copies.append((sql, buffer.read()))
+
+
+def empty_database(tmp_path):
+    path = str(tmp_path / "test.db")
+    SQLiteBackend(db_path=path).close_and_cleanup()
+    return path
+
+
+def count_rows(path):
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT count(*) FROM gps_data").fetchone()[0]
+
+
+@pytest.fixture
+def gpx_database(tmp_path):
+    path = empty_database(tmp_path)
+    engine = create_engine(f"sqlite:///{path}")
+    session = scoped_session(sessionmaker(bind=engine))
+    yield path, session
+    session.remove()
+    engine.dispose()
+
+
+def test_gpx_import_with_executemany(tmp_path, gpx_database):
+    path, session = gpx_database
+    write_gpx(random_walk(120), str(tmp_path / "a.gpx"))
+    write_gpx(random_walk(80, seed=1), str(tmp_path / "b.gpx"))
+    assert import_data_GPX.import_gpx(str(tmp_path / "a.gpx"), batch_size=50, session=session) == 120
+    assert import_data_GPX.import_gpx_files([str(tmp_path / "a.gpx"), str(tmp_path / "b.gpx")],
+                                            workers=2, batch_size=50, session=session) == 200
+    assert count_rows(path) == 320
+
+
+def test_gpx_malformed_file_keeps_the_points_before_the_error(tmp_path, gpx_database, caplog):
+    path, session = gpx_database
+    write_gpx(random_walk(30), str(tmp_path / "bad.gpx"))
+    text = (tmp_path / "bad.gpx").read_text()
+    (tmp_path / "bad.gpx").write_text(text.replace("</trkseg>", '<trkpt lat="north" lon="8.5"></trkpt>\n</trkseg>'))
+    write_gpx(random_walk(20, seed=1), str(tmp_path / "good.gpx"))
+
+    # Both paths keep the points read before the bad value, and report the file as malformed
+    assert import_data_GPX.import_gpx(str(tmp_path / "bad.gpx"), batch_size=10, session=session) == 30
+    assert import_data_GPX.import_gpx_files([str(tmp_path / "bad.gpx"), str(tmp_path / "good.gpx")],
+                                            workers=2, batch_size=10, session=session) == 50
+    assert count_rows(path) == 80
+    malformed = [r.message for r in caplog.records if r.message.startswith("Malformed GPX file")]
+    assert len(malformed) == 2 and all("bad.gpx" in message for message in malformed)
+    assert not any("into the database" in r.message for r in caplog.records)
+
+
+def test_gpx_batches_are_copied_on_postgresql():
+    conn = FakeConnection()
+    session = SimpleNamespace(get_bind=lambda: conn, connection=lambda: conn)
+    import_data_GPX.insert_batch([
+        {"latitude": 1.0, "longitude": 2.0, "elevation": None, "timestamp": "2024-01-01T00:00:00Z"},
+        {"latitude": 3.0, "longitude": 4.0, "elevation": 5.0, "timestamp": None},
+    ], session)
+    sql, data = conn.copies[0]
+    assert sql.startswith("COPY gps_data (latitude, longitude, elevation, timestamp) FROM STDIN")
+    assert data.splitlines() == ["1.0,2.0,,2024-01-01T00:00:00Z", "3.0,4.0,5.0,"]
+
+
+def test_gpx_insert_error_stops_the_parsers(tmp_path, gpx_database, monkeypatch):
+    path, session = gpx_database
+    files = []
+    for i in range(3):
+        files.append(str(tmp_path / f"{i}.gpx"))
+        write_gpx(random_walk(500, seed=i), files[-1])
+
+    def fail(batch, session):
+        raise RuntimeError("database gone")
+
+    # Parsers fill the small queue and block on it while the writer fails
+    monkeypatch.setattr(import_data_GPX, "QUEUE_SIZE", 1)
+    monkeypatch.setattr(import_data_GPX, "insert_batch", fail)
+    with pytest.raises(RuntimeError, match="database gone"):
+        import_data_GPX.import_gpx_files(files, workers=2, batch_size=10, session=session)
+    assert count_rows(path) == 0
+
+
+def test_csv_import_with_executemany(tmp_path):
+    write_csv(random_walk(300), str(tmp_path / "points.csv"))
+    path = empty_database(tmp_path)
+    imported, rejected = import_data_CSV.import_data(str(tmp_path / "points.csv"), db_url=f"sqlite:///{path}",
+                                                     chunk_size=100)
+    assert (imported, rejected) == (300, 0)
+    assert count_rows(path) == 300
+
+
+def test_csv_timestamps_are_stored_as_written():
+    chunk = pd.DataFrame({"latitude": ["1", "2", "3", "4"], "longitude": ["1", "2", "3", "4"],
+                          "timestamp": [" 2024-01-01T00:00:00.250Z", "2024-01-01T02:00:00+02:00", None, "noon"]})
+    cleaned, rejected = import_data_CSV.clean_chunk(chunk, {name: name for name in import_data_CSV.COLUMNS})
+    assert rejected == 1
+    assert cleaned["timestamp"].tolist()[:2] == ["2024-01-01T00:00:00.250Z", "2024-01-01T02:00:00+02:00"]
+    assert pd.isna(cleaned["timestamp"].iloc[2])
+
+
+def test_csv_chunks_are_copied_on_postgresql():
+    conn = FakeConnection()
+    df = pd.DataFrame({"latitude": [1.0], "longitude": [2.0], "elevation": [float("nan")],
+                       "timestamp": ["2024-01-01T00:00:00Z"]})
+    import_data_CSV.load_chunk(conn, df)
+    sql, data = conn.copies[0]
+    assert sql.startswith("COPY gps_data (latitude, longitude, elevation, timestamp) FROM STDIN")
+    assert data.splitlines() == ["1.0,2.0,,2024-01-01T00:00:00Z"]
+
+
+def test_csv_load_error_rolls_back_the_import(tmp_path, monkeypatch):
+    write_csv(random_walk(300), str(tmp_path / "points.csv"))
+    path = empty_database(tmp_path)
+    import_data_CSV.import_data(str(tmp_path / "points.csv"), db_url=f"sqlite:///{path}")
+    load_chunk = import_data_CSV.load_chunk
+    loaded = []
+
+    def fail_second_chunk(conn, df):
+        if loaded:
+            raise RuntimeError("database gone")
+        loaded.append(len(df))
+        load_chunk(conn, df)
+
+    monkeypatch.setattr(import_data_CSV, "load_chunk", fail_second_chunk)
+    monkeypatch.setattr(import_data_CSV, "RANGE_SIZE", 1024)
+    with pytest.raises(RuntimeError, match="database gone"):
+        import_data_CSV.import_data(str(tmp_path / "points.csv"), db_url=f"sqlite:///{path}", workers=2,
+                                    override=True)
+    # The delete and the first chunk are rolled back with the transaction
+    assert loaded and count_rows(path) == 300
@@ -0,0 +1,128 @@
+import asyncio
+import gzip
+import io
+import json
+
+import numpy as np
+
+from backend import ingest
+from backend.asgi import AsyncWebService
+from backend.datastore import Datastore, SQLiteBackend
+from backend.ingest import iter_lines
+from backend.map import MapUtil
+from backend.util import GeoPoint
+from backend.webservice import WebService
+
+
+def ndjson(points):
+    return "".join(json.dumps(p) + "\n" for p in points).encode()
+
+
+def test_iter_lines_across_chunks(monkeypatch):
+    monkeypatch.setattr(ingest, "MAX_LINE_BYTES", 8)
+    chunks = [b'{"a"', b':1}\n{"b":2}\n' + b"x" * 6, b"x" * 6 + b"\n", b"last"]
+    assert list(iter_lines(chunks)) == [b'{"a":1}', b'{"b":2}', None, b"last"]
+
+
+def test_ingest_endpoint(tmp_path):
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "test.db")))
+    client = WebService(ds, MapUtil()).app.test_client()
+    points = [{"latitude": 47.0 + i / 1000, "longitude": 8.0, "elevation": 400.0,
+               "timestamp": f"2024-01-01T00:{i:02d}:00Z"} for i in range(25)]
+    body = ndjson(points) + b'\n["not an object"]\n{"lat": 95, "lng": 8}\n{"lat": 47, "lng": 8, "timestamp": "soon"}\n'
+    body += b'{"lat": 47.1, "lng": 8.1}'
+
+    response = client.post("/api/ingest?batch_size=10", data=gzip.compress(body),
+                           headers={"Content-Type": "application/x-ndjson", "Content-Encoding": "gzip"})
+    summary = response.get_json()
+    assert response.status_code == 200
+    assert summary["accepted"] == 26 and summary["rejected"] == 3 and summary["batches"] == 3
+    assert summary["errors"][0].startswith("line 27:") and "invalid timestamp" in summary["errors"][2]
+
+    track = ds.fetch_gps_data()
+    assert len(track) == 26 and np.isnan(track.elevation).sum() == 1
+    assert sum(p.timestamp.startswith("2024-01-01T00:00:00") for p in track) == 1
+
+    # A cut off upload keeps what was read
+    truncated = gzip.compress(ndjson(points[:5]))[:-10]
+    response = client.post("/api/ingest", data=truncated, headers={"Content-Encoding": "gzip"})
+    assert response.status_code == 400 and response.get_json()["complete"] is False
+    # So does an uncompressed upload the client broke off before its Content-Length
+    body = ndjson(points[:5])
+    response = client.post("/api/ingest", input_stream=io.BytesIO(body),
+                           environ_overrides={"CONTENT_LENGTH": str(len(body) + 100)})
+    summary = response.get_json()
+    assert response.status_code == 400 and summary["complete"] is False and summary["accepted"] == 5
+    assert client.post("/api/ingest", data=b"", headers={"Content-Encoding": "br"}).status_code == 415
+    assert client.post("/api/ingest?batch_size=0", data=b"").status_code == 400
+    assert client.post("/api/ingest?batch_size=1000000000", data=b"").status_code == 400
+    ds.close()
+
+
+def test_ingest_counts_failed_inserts_as_rejected(tmp_path):
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "test.db")))
+    assert len(ds.fetch_gps_data()) == 0
+    storage = ds.db_worker.storage
+    insert_rows = storage.insert_rows
+
+    def reject_longitude_99(table, columns, rows):
+        if any(row[1] == 99.0 for row in rows):
+            raise ValueError("bad row")
+        insert_rows(table, columns, rows)
+
+    storage.insert_rows = reject_longitude_99
+    points = [{"lat": 1.0 + i, "lng": 2.0} for i in range(4)] + [{"lat": 5.0, "lng": 99.0}]
+    summary = ingest.ingest_ndjson(ds, io.BytesIO(ndjson(points)), batch_size=3)
+    assert summary.accepted == 3 and summary.rejected == 2 and summary.batches == 1
+    assert summary.errors == ["lines 4-5: insert failed: bad row"]
+    assert len(ds.load_gps_data()) == 3
+    ds.close()
+
+
+def test_ingest_asgi_streams_body(tmp_path):
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "test.db")))
+    app = AsyncWebService(WebService(ds, MapUtil()))
+    body = gzip.compress(ndjson([{"lat": 1.0 + i / 100, "lng": 2.0} for i in range(100)]))
+    messages = [{"type": "http.request", "body": body[i:i + 50], "more_body": i + 50 < len(body)}
+                for i in range(0, len(body), 50)]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "POST", "path": "/api/ingest", "query_string": b"",
+             "headers": [(b"content-encoding", b"gzip")]}
+    asyncio.run(app(scope, receive, send))
+    assert sent[0]["status"] == 200 and json.loads(sent[1]["body"])["accepted"] == 100
+    assert not messages and len(ds.fetch_gps_data()) == 100
+    app.close()
+    ds.close()
+
+
+def test_ingest_asgi_client_disconnect_keeps_the_points_read(tmp_path):
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "test.db")))
+    app = AsyncWebService(WebService(ds, MapUtil()))
+    messages = [{"type": "http.request", "body": ndjson([{"lat": 1.0, "lng": 2.0}]), "more_body": True},
+                {"type": "http.disconnect"}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "POST", "path": "/api/ingest", "query_string": b"", "headers": []}
+    asyncio.run(app(scope, receive, send))
+    summary = json.loads(sent[1]["body"])
+    assert sent[0]["status"] == 400 and summary["complete"] is False and summary["accepted"] == 1
+    app.close()
+    ds.close()
+
+
+def test_geopoint_from_editor_dict():
+    point = GeoPoint.from_dict({"lat": 1.5, "lng": 2.5, "timestamp": "2024-01-01T00:00:00Z"})
+    assert (point.latitude, point.longitude) == (1.5, 2.5)
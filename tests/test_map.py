@@ -13,3 +13,10 @@ def test_create_folium_map_returns_map():
 
 def test_create_folium_map_empty():
     assert MapUtil.create_folium_map([]) is None
+
+
+def test_simplify_drops_collinear_points():
+    data = [(47.0 + i * 1e-4, 8.0, 0, "") for i in range(1000)]
+    data[500] = (data[500][0], 8.01, 0, "")  # one clearly visible detour
+    simplified = MapUtil().simplify(data, zoom=13)
+    assert [p[1] for p in simplified] == [8.0, 8.0, 8.01, 8.0, 8.0]
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from backend import mapmatch
+from backend.mapmatch import MapMatcher, MatchStore
+from backend.routing import RoadGraph
+from backend.track import NO_TIMESTAMP, Track
+from test_routing import STEP, write_osm
+
+
+def noisy_track(rng, n=40):
+    # East along row 0 (latitude 47), then north along column 3, ~10 m of noise; both ends away from crossings
+    t = np.linspace(0, 1, n)
+    lat = np.where(t < 0.5, 47.0, 47 + (t - 0.5) * 2 * 1.5 * STEP)
+    lon = np.where(t < 0.5, 8 + (0.5 + t * 2 * 2.5) * STEP, 8 + 3 * STEP)
+    lat = lat + rng.normal(0, 0.00008, n)
+    lon = lon + rng.normal(0, 0.00008, n)
+    return Track(lat, lon, None, 1_700_000_000 + np.arange(n) * 5)
+
+
+def test_match_snaps_onto_roads(tmp_path, monkeypatch):
+    graph = RoadGraph.load(write_osm(tmp_path / "grid.osm"))
+    track = noisy_track(np.random.default_rng(1))
+    matched = MapMatcher(graph, "car").match(track)
+
+    fixes = matched[matched.timestamp != NO_TIMESTAMP]
+    assert len(fixes) == len(track)
+    assert np.array_equal(fixes.timestamp, track.timestamp)
+    # Every snapped fix lies on row 0 or on column 3
+    on_row = np.abs(fixes.latitude - 47.0) < 1e-9
+    on_column = np.abs(fixes.longitude - (8 + 3 * STEP)) < 1e-9
+    assert np.all(on_row | on_column)
+    # The corner node is inserted where the track turns
+    assert np.any(np.isclose(matched.latitude, 47.0) & np.isclose(matched.longitude, 8 + 3 * STEP))
+
+    # Chunks matched in worker processes give the same geometry, the overlap joins them along the roads
+    monkeypatch.setattr(mapmatch, "CHUNK_POINTS", 12)
+    monkeypatch.setattr(mapmatch, "CHUNK_OVERLAP", 6)
+    parallel = MapMatcher(graph, "car").match(track, workers=2)
+    assert np.array_equal(parallel.timestamp, matched.timestamp)
+    assert np.allclose(parallel.latitude, matched.latitude) and np.allclose(parallel.longitude, matched.longitude)
+
+
+def test_match_store_persists(tmp_path):
+    graph = RoadGraph.load(write_osm(tmp_path / "grid.osm"))
+    track = noisy_track(np.random.default_rng(2))
+    store = MatchStore(graph, str(tmp_path / "matches"), workers=1)
+    first = store.get_or_match(track)
+    assert len(list((tmp_path / "matches").glob("*.npz"))) == 1
+
+    # A fresh store finds the persisted result instead of matching again
+    store = MatchStore(graph, str(tmp_path / "matches"), workers=1)
+    store.matcher("car").match = lambda *args, **kwargs: pytest.fail("matched twice")
+    second = store.get_or_match(track)
+    assert np.array_equal(first.latitude, second.latitude)
+    assert np.array_equal(first.timestamp, second.timestamp)
+
+
+def test_match_store_keys_and_eviction(tmp_path):
+    graph = RoadGraph.load(write_osm(tmp_path / "grid.osm"))
+    rng = np.random.default_rng(3)
+    tracks = [noisy_track(rng) for _ in range(3)]
+    store = MatchStore(graph, str(tmp_path / "matches"), workers=2)
+    store.get_or_match(tracks[0])
+    size = next((tmp_path / "matches").glob("*.npz")).stat().st_size
+
+    # A graph with the same number of nodes but other coordinates has other matches
+    moved = RoadGraph(graph.latitude + 0.001, graph.longitude, graph.graphs)
+    assert MatchStore(moved, str(tmp_path / "matches")).key(tracks[0], "car") != store.key(tracks[0], "car")
+
+    store.max_bytes = 2 * size + size // 2
+    for track in tracks[1:]:
+        store.get_or_match(track)
+    names = {path.name for path in (tmp_path / "matches").glob("*.npz")}
+    assert names == {f"{store.key(track, 'car')}.npz" for track in tracks[1:]}
+    store.close()
@@ -0,0 +1,70 @@
+import sys
+
+import pytest
+
+from backend.datastore import Datastore, SQLiteBackend, TimingStats
+from backend.map import MapUtil
+from backend.metrics import Registry, RequestProfiler
+from backend.util import GeoPoint
+from backend.webservice import WebService
+
+
+def test_registry_renders_prometheus_text():
+    registry = Registry()
+    requests = registry.counter("app_requests", "Requests.", ("status",))
+    requests.labels(200).inc()
+    requests.labels(200).inc(2)
+    depth = registry.gauge("app_depth", "Depth.")
+    depth.set(4)
+    latency = registry.histogram("app_latency_seconds", "Latency.", buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5.0):
+        latency.observe(value)
+    assert registry.counter("app_requests", "Requests.", ("status",)) is requests
+
+    text = registry.render()
+    assert '# TYPE app_requests counter\napp_requests_total{status="200"} 3\n' in text
+    assert "app_depth 4\n" in text
+    assert 'app_latency_seconds_bucket{le="0.1"} 1\n' in text
+    assert 'app_latency_seconds_bucket{le="1"} 2\n' in text
+    assert 'app_latency_seconds_bucket{le="+Inf"} 3\n' in text
+    assert "app_latency_seconds_sum 5.55\napp_latency_seconds_count 3\n" in text
+
+
+def test_timing_stats_feed_histogram():
+    histogram = Registry().histogram("stats_seconds", "Stats.")
+    stats = TimingStats(histogram)
+    stats.record(0.002)
+    assert stats.snapshot()["count"] == 1 and histogram.count == 1
+
+
+def test_metrics_endpoint_and_slow_request_profiles(tmp_path):
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "test.db")))
+    ds.insert_points([GeoPoint(1.0, 2.0, 3.0, "2024-01-01T00:00:00Z"), GeoPoint(1.1, 2.1, 3.0, "2024-01-01T00:01:00Z")])
+    profiler = RequestProfiler(str(tmp_path / "profiles"), threshold=0.0)
+    client = WebService(ds, MapUtil(), profiler=profiler).app.test_client()
+    assert client.get("/").status_code == 200
+
+    response = client.get("/metrics")
+    text = response.get_data(as_text=True)
+    assert response.content_type.startswith("text/plain; version=0.0.4")
+    assert 'geolocation_map_build_seconds_count{view="map"}' in text
+    assert 'geolocation_map_serialize_seconds_count{view="map"}' in text
+    assert 'geolocation_http_requests_total{endpoint="/",status="200"}' in text
+    assert 'geolocation_db_exec_seconds_count{path="worker"}' in text
+    assert 'geolocation_query_rows_count{query="all"}' in text
+    assert "geolocation_db_queue_depth" in text
+    assert any(path.suffix == ".prof" for path in (tmp_path / "profiles").iterdir())
+    ds.close()
+
+
+def test_profiler_stops_when_a_handler_raises(tmp_path):
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "test.db")))
+    ws = WebService(ds, MapUtil(), profiler=RequestProfiler(str(tmp_path / "profiles"), threshold=0.0))
+    ws.app.route("/fail")(lambda: 1 / 0)
+    # Propagated exceptions skip after_request
+    ws.app.testing = True
+    with pytest.raises(ZeroDivisionError):
+        ws.app.test_client().get("/fail")
+    assert sys.getprofile() is None
+    assert any(path.name.endswith("GET_fail.prof") for path in (tmp_path / "profiles").iterdir())
+    ds.close()
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from backend import webservice
+from backend.datastore import Datastore, SQLiteBackend
+from backend.map import MapUtil
+from backend.routing import RoadGraph, Router
+from backend.track import Track
+from backend.webservice import WebService
+
+# 4 x 4 street grid, ~111 m between neighbouring nodes
+STEP = 0.001
+
+
+def write_osm(path):
+    nodes = [f'<node id="{10 + 4 * r + c}" lat="{47 + r * STEP}" lon="{8 + c * STEP}"/>'
+             for r in range(4) for c in range(4)]
+    ways = []
+    for r in range(4):
+        refs = "".join(f'<nd ref="{10 + 4 * r + c}"/>' for c in range(4))
+        # Row 1 is a oneway going east, row 3 a footway
+        tags = {1: '<tag k="highway" v="residential"/><tag k="oneway" v="yes"/>',
+                3: '<tag k="highway" v="footway"/>'}.get(r, '<tag k="highway" v="residential"/>')
+        ways.append(f'<way id="{100 + r}">{refs}{tags}</way>')
+    for c in range(4):
+        refs = "".join(f'<nd ref="{10 + 4 * r + c}"/>' for r in range(3))
+        ways.append(f'<way id="{200 + c}">{refs}<tag k="highway" v="residential"/></way>')
+    path.write_text(f'<?xml version="1.0"?><osm version="0.6">{"".join(nodes)}{"".join(ways)}</osm>')
+    return str(path)
+
+
+def test_graph_modes_and_oneways(tmp_path):
+    graph = RoadGraph.load(write_osm(tmp_path / "grid.osm"))
+    assert len(graph) == 16
+    assert (tmp_path / "grid.osm.npz").exists()
+
+    west, east = graph.nearest_node(47 + STEP, 8.0, "car"), graph.nearest_node(47 + STEP, 8 + 3 * STEP, "car")
+    # East along the oneway, back west it takes a detour over row 0 or 2
+    _, _, forward = graph.astar(west, east, "car")
+    _, _, backward = graph.astar(east, west, "car")
+    assert forward == pytest.approx(3 * 76, rel=0.05)
+    assert backward > forward + 100
+
+    # Row 3 is a footway: cars can't snap onto it
+    assert graph.nearest_node(47 + 3 * STEP, 8.0, "car") != graph.nearest_node(47 + 3 * STEP, 8.0, "foot")
+    assert graph.nearest_node(10.0, 10.0, "car") is None
+
+
+def test_router_batches_and_caches_legs(tmp_path, monkeypatch):
+    router = Router.from_file(write_osm(tmp_path / "grid.osm"))
+    lat = np.array([47.0, 47.00001, 47 + 2 * STEP, 47.0])
+    lon = np.array([8.0, 8.00001, 8 + 3 * STEP, 8.0])
+    route = router.route(lat, lon, "car")
+    assert route.legs == 2 and route.unroutable == 0
+    assert route.meters > 0 and route.latitude[0] == pytest.approx(47.0)
+    assert len(router._legs) == 2
+    router.route(lat, lon, "car")
+    assert len(router._legs) == 2
+
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "test.db")))
+    ds.insert_points(Track(lat, lon, None, 1_700_000_000 + np.arange(4) * 60))
+    client = WebService(ds, MapUtil(), router=router).app.test_client()
+    result = client.get("/api/route?mode=foot").get_json()
+    assert result["legs"] == 2 and len(result["coordinates"]) > 2
+    assert client.get("/api/route?mode=plane").status_code == 400
+    # Every point is snapped separately, so large windows are refused
+    monkeypatch.setattr(webservice, "MAX_ROUTE_WAYPOINTS", 3)
+    assert client.get("/api/route").status_code == 400
+    ds.close()
+
+
+def test_heuristic_speed_covers_maxspeed(tmp_path):
+    path = tmp_path / "motorway.osm"
+    path.write_text('<?xml version="1.0"?><osm version="0.6"><node id="1" lat="47.0" lon="8.0"/>'
+                    '<node id="2" lat="47.0" lon="8.01"/><way id="3"><nd ref="1"/><nd ref="2"/>'
+                    '<tag k="highway" v="motorway"/><tag k="maxspeed" v="130"/></way></osm>')
+    graph = RoadGraph.from_osm(str(path))
+    # Above the 110 km/h motorway default, the A* heuristic must not overestimate
+    assert graph.as_lists("car")[-1] * 3.6 == pytest.approx(130)
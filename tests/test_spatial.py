@@ -0,0 +1,63 @@
+import numpy as np
+
+from backend.datastore import Datastore, SQLiteBackend
+from backend.map import MapUtil
+from backend.spatial import DatastoreIndex, SpatialIndex
+from backend.track import Track
+from backend.util import BoundingBox
+from backend.webservice import WebService
+
+
+def random_track(n, seed=0):
+    rng = np.random.default_rng(seed)
+    timestamps = 1_700_000_000 + np.arange(n, dtype=np.int64)
+    return Track(rng.uniform(46.0, 48.0, n), rng.uniform(7.0, 9.0, n), rng.uniform(0, 1000, n), timestamps)
+
+
+def test_bbox_query_matches_brute_force():
+    track = random_track(5000)
+    index = SpatialIndex()
+    index.add(track[:3000])
+    index.add(track[3000:])
+    # Merged once, by the first query
+    assert len(index) == 5000 and len(index._pending) == 2
+    for bbox in (BoundingBox(46.5, 7.5, 47.0, 8.0), BoundingBox(47.9, 8.9, 48.0, 9.0), BoundingBox(0, 0, 1, 1)):
+        lat, lon = track.latitude, track.longitude
+        expected = np.flatnonzero((lat >= bbox.min_lat) & (lat <= bbox.max_lat)
+                                  & (lon >= bbox.min_lon) & (lon <= bbox.max_lon))
+        assert np.array_equal(index.query(bbox), expected)
+
+
+def test_incremental_clusters_match_a_full_build():
+    track = random_track(2000, seed=1)
+    incremental, full = SpatialIndex(), SpatialIndex()
+    for first in range(0, 2000, 300):
+        incremental.add(track[first:first + 300])
+    full.add(track)
+    for zoom in (0, 8, 14):
+        a, b = incremental.clusters(zoom), full.clusters(zoom)
+        assert a.count.sum() == 2000
+        assert np.array_equal(a.count, b.count) and np.array_equal(a.start, b.start)
+        assert np.allclose(a.latitude, b.latitude) and np.array_equal(a.end, b.end)
+    assert len(full.clusters(0)) == 1
+    assert full.clusters(0).start[0] == track.timestamp[0]
+
+
+def test_datastore_index_follows_inserts(tmp_path):
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "test.db")))
+    ds.insert_points(random_track(100))
+    index = DatastoreIndex(ds)
+    bbox = BoundingBox(46.0, 7.0, 47.0, 8.0)
+    before = len(index.query(bbox))
+
+    ds.insert_points(Track(np.array([46.5]), np.array([7.5])))
+    assert len(index.query(bbox)) == before + 1
+    assert index.clusters(0).count.sum() == 101
+    ds.delete_gps_data()
+    assert len(index.query(bbox)) == 0
+
+    client = WebService(ds, MapUtil()).app.test_client()
+    ds.insert_points(random_track(100))
+    assert client.get("/?view=clusters&zoom=10").status_code == 200
+    assert client.get("/?view=clusters&start=2024-01-01").status_code == 400
+    ds.close()
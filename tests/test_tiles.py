@@ -0,0 +1,91 @@
+import threading
+
+import numpy as np
+from backend.datastore import SQLiteBackend, Datastore
+from backend.geometry import mercator_project
+from backend.map import MapUtil
+from backend.tiles import render_tile, MVT_EXTENT, VectorTileCache
+from backend.util import GeoPoint
+from backend.webservice import WebService
+
+
+def read_varints(data):
+    values, value, shift = [], 0, 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            values.append(value)
+            value, shift = 0, 0
+    return values
+
+
+def test_render_tile_encodes_clipped_line():
+    # A line through the middle of the world tile, extending past its right edge
+    x0, y0 = np.array([128.0, 300.0]), np.array([128.0, 128.0])
+    tile = render_tile(x0, y0, 0, 0, 0)
+    assert b"track" in tile and b"points" not in tile
+
+    geometry = tile[tile.index(b"\x22") + 1:]  # feature field 4 (packed geometry)
+    length, commands = geometry[0], read_varints(geometry[1:geometry[0] + 1])
+    assert length == len(geometry[1:length + 1])
+    # MoveTo(1) to the tile center, LineTo(1) to the buffered right edge
+    assert commands == [9, MVT_EXTENT, MVT_EXTENT, 10, 2 * (MVT_EXTENT // 2 + 64), 0]
+
+
+def test_tile_endpoint_uses_disk_cache(tmp_path):
+    db_file = tmp_path / "test.db"
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(db_file)))
+    ds.insert_points([GeoPoint(1.0, 2.0, 3.0, "2024-01-01T00:00:00Z"), GeoPoint(1.1, 2.1, 3.0, "2024-01-01T00:01:00Z")])
+    ds.db_worker.task_queue.join()
+    client = WebService(ds, MapUtil(), tile_cache_dir=str(tmp_path / "tiles")).app.test_client()
+
+    response = client.get("/tiles/0/0/0.mvt")
+    assert response.status_code == 200
+    assert response.mimetype == "application/vnd.mapbox-vector-tile"
+    assert list((tmp_path / "tiles").glob("gen-*/0/0/0.mvt"))
+    assert client.get("/tiles/1/2/0.mvt").status_code == 404
+
+    ds.delete_gps_data()
+    ds.db_worker.task_queue.join()
+    assert client.get("/tiles/0/0/0.mvt").data == b""
+
+    ds.db_worker.stop()
+    ds.db_worker.join(timeout=1)
+
+
+def test_disk_purges_run_one_at_a_time_for_the_newest_version(tmp_path):
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "test.db")))
+    tiles = VectorTileCache(ds, cache_dir=str(tmp_path / "tiles"))
+    started, release, kept, threads = threading.Event(), threading.Event(), [], set()
+
+    def slow_purge(keep):
+        threads.add(threading.current_thread())
+        started.set()
+        release.wait(5)
+        kept.append(keep)
+
+    tiles._purge = slow_purge
+    tiles.on_write("insert", None, 3)
+    started.wait(5)
+    for version in (5, 7, 4):
+        tiles.on_write("insert", None, version)
+    release.set()
+    thread = next(iter(threads))
+    thread.join(5)
+    assert len(threads) == 1
+    assert kept == [tiles._generation_dir(3), tiles._generation_dir(7)]
+    ds.close()
+
+
+def test_tile_view_is_centered_without_loading_the_track(tmp_path):
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "test.db")))
+    ws = WebService(ds, MapUtil())
+    assert ws.default_center() == [37.7749, -122.4194]
+    ds.insert_points([GeoPoint(1.0, 2.0, 3.0, "2024-01-01T00:00:00Z"), GeoPoint(1.1, 2.1, 3.0, "2024-01-01T00:01:00Z")],
+                     wait=True)
+
+    assert ws.default_center() == [1.0, 2.0]
+    assert ds.cached_gps_data() is None
+    assert "[1.0, 2.0]" in ws.app.test_client().get("/?view=tiles").get_data(as_text=True)
+    ds.close()
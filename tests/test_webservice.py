@@ -1,5 +1,7 @@
+import json
+
 from backend.datastore import SQLiteBackend, Datastore
-from backend.util import GeoPoint
+from backend.util import GeoPoint, BoundingBox
 from backend.webservice import WebService
 from backend.map import MapUtil
 
@@ -11,9 +13,89 @@ def test_index_returns_html(tmp_path):
     ds.db_worker.task_queue.join()
 
     ws = WebService(ds, MapUtil())
-    with ws.app.app_context():
-        html = ws.index()
+    with ws.app.test_request_context("/"):
+        html = ws.index().get_data(as_text=True)
     assert "<div" in html
 
     ds.db_worker.stop()
     ds.db_worker.join(timeout=1)
+
+
+def test_index_filters_by_viewport_and_time(tmp_path):
+    db_file = tmp_path / "test.db"
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(db_file)))
+    ds.insert_points([
+        GeoPoint(1.0, 2.0, 3.0, "2024-01-01T00:00:00Z"),
+        GeoPoint(1.5, 2.5, 3.0, "2024-01-02T00:00:00Z"),
+        GeoPoint(40.0, 50.0, 3.0, "2024-01-03T00:00:00Z"),
+    ])
+    ds.db_worker.task_queue.join()
+
+    points = ds.query_gps_data(bbox=BoundingBox(0.0, 0.0, 10.0, 10.0), start="2024-01-02T00:00:00Z")
+    assert [p.latitude for p in points] == [1.5]
+
+    client = WebService(ds, MapUtil()).app.test_client()
+    assert client.get("/?min_lat=0&min_lon=0&max_lat=10&max_lon=10").status_code == 200
+    assert client.get("/?min_lat=0&min_lon=0").status_code == 400
+
+    ds.db_worker.stop()
+    ds.db_worker.join(timeout=1)
+
+
+def test_index_is_cached_per_dataset_version(tmp_path):
+    db_file = tmp_path / "test.db"
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(db_file)))
+    ds.insert_points([GeoPoint(1.0, 2.0, 3.0, "2024-01-01T00:00:00Z")])
+    ds.db_worker.task_queue.join()
+    client = WebService(ds, MapUtil()).app.test_client()
+
+    first = client.get("/")
+    etag = first.headers["ETag"]
+    assert client.get("/", headers={"If-None-Match": etag}).status_code == 304
+
+    ds.insert_points([GeoPoint(1.1, 2.1, 3.0, "2024-01-01T00:01:00Z")])
+    ds.db_worker.task_queue.join()
+    second = client.get("/", headers={"If-None-Match": etag})
+    assert second.status_code == 200
+    assert second.headers["ETag"] != etag
+
+    ds.db_worker.stop()
+    ds.db_worker.join(timeout=1)
+
+
+def test_api_points_pages_through_all_points(tmp_path):
+    db_file = tmp_path / "test.db"
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(db_file)))
+    ds.insert_points([GeoPoint(1.0 + i / 100, 2.0, 3.0, f"2024-01-01T00:{i // 2:02d}:00Z") for i in range(25)])
+    client = WebService(ds, MapUtil()).app.test_client()
+
+    seen = []
+    after = ""
+    while True:
+        response = client.get(f"/api/points?limit=10&after={after}")
+        assert response.mimetype == "application/x-ndjson"
+        page = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        seen.extend(point["id"] for point in page)
+        if len(page) < 10:
+            break
+        after = f"{page[-1]['timestamp']},{page[-1]['id']}"
+    assert sorted(seen) == seen and len(set(seen)) == 25
+
+    document = client.get("/api/points?format=json&limit=5&max_lat=1.1&min_lat=0&min_lon=0&max_lon=10").get_json()
+    assert len(document["points"]) == 5
+    assert document["next"] == f"{document['points'][-1]['timestamp']},{document['points'][-1]['id']}"
+    assert client.get("/api/points?after=garbage").status_code == 400
+
+    ds.db_worker.stop()
+    ds.db_worker.join(timeout=1)
+
+
+def test_warmup_prerenders_default_map(tmp_path):
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "test.db")))
+    ds.insert_points([GeoPoint(1.0, 2.0, 3.0, "2024-01-01T00:00:00Z")])
+    ws = WebService(ds, MapUtil())
+    ws.warmup()
+    key, _ = ws.map_request({})
+    assert ws.render_cache.get(key) is not None
+    assert ws.app.test_client().get("/").get_data(as_text=True) == ws.render_cache.get(key)
+    ds.close()
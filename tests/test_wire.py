@@ -0,0 +1,66 @@
+import gzip
+import json
+
+import numpy as np
+import pytest
+
+from benchmarks.generators import random_walk
+from backend.datastore import Datastore, SQLiteBackend
+from backend.map import MapUtil
+from backend.webservice import WebService
+from backend.wire import decode_polyline, decode_varint, encode_polyline, encode_varint
+
+
+def test_polyline_matches_reference():
+    # Example of the encoded polyline algorithm documentation
+    lat, lon = np.array([38.5, 40.7, 43.252]), np.array([-120.2, -120.95, -126.453])
+    assert encode_polyline(lat, lon) == "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+    decoded = decode_polyline("_p~iF~ps|U_ulLnnqC_mqNvxq`@")
+    assert np.allclose(decoded[0], lat) and np.allclose(decoded[1], lon)
+
+
+def test_varint_round_trip_and_size():
+    track = random_walk(100_000)
+    data = encode_varint(track.latitude, track.longitude, precision=6)
+    lat, lon = decode_varint(data)
+    assert np.abs(lat - track.latitude).max() <= 5e-7 and np.abs(lon - track.longitude).max() <= 5e-7
+    with pytest.raises(ValueError):
+        decode_varint(data[:-1])
+
+    # An order of magnitude below the coordinate literals of the folium map
+    literals = len(json.dumps(np.column_stack((track.latitude, track.longitude)).tolist()))
+    assert len(gzip.compress(encode_varint(track.latitude, track.longitude))) * 10 < literals
+
+
+def test_track_endpoint(tmp_path):
+    ds = Datastore(lambda: SQLiteBackend(db_path=str(tmp_path / "test.db")))
+    track = random_walk(1_000)
+    ds.insert_points(track)
+    ws = WebService(ds, MapUtil())
+    client = ws.app.test_client()
+
+    response = client.get("/api/track", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200 and response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    lat, lon = decode_varint(gzip.decompress(response.data))
+    assert len(lat) == 1_000 and np.allclose(lon, track.longitude, atol=1e-5)
+    assert client.get("/api/track", headers={"Accept-Encoding": "gzip",
+                                             "If-None-Match": response.headers["ETag"]}).status_code == 304
+
+    polyline = client.get("/api/track?format=polyline&zoom=10").get_data(as_text=True)
+    assert "Content-Encoding" not in client.get("/api/track?format=polyline").headers
+    assert 1 < len(decode_polyline(polyline)[0]) < 1_000
+    assert client.get("/api/track?precision=9").status_code == 400
+
+    html = client.get("/?view=track&zoom=12").get_data(as_text=True)
+    assert "loadTrack" in html and "/api/track?zoom=12" in html
+    # The page decodes the format it asks for
+    html = client.get("/?view=track&format=polyline&precision=6").get_data(as_text=True)
+    assert 'precision=6", "polyline", 6)' in html
+    assert client.get("/?view=track&format=geojson").status_code == 400
+
+    # Payloads beyond the byte limit of the cache are served but not kept
+    ws.track_cache.clear()
+    ws.track_cache.max_bytes = 100
+    assert client.get("/api/track").status_code == 200 and len(ws.track_cache) == 0
+    ds.close()